@@ -0,0 +1,73 @@
+# scaling benchmark for the all-pairs private sequence distance. Random
+# presence/absence matrices are generated for an increasing number of isolates,
+# and the matrix engine is timed. For small sizes the result is checked against
+# the original per-pair loop.
+
+import argparse
+import pathlib
+import sys
+import time
+import numpy as np
+from itertools import combinations
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1] / "scripts"))
+from private_seq_utils import private_seq_matrix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 10000],
+        help="number of isolates",
+    )
+    parser.add_argument("--n_blocks", type=int, default=5000, help="n. of blocks")
+    parser.add_argument(
+        "--max_loop", type=int, default=200, help="max size for the per-pair loop"
+    )
+    return parser.parse_args()
+
+
+def random_presence_absence(N, B, rng):
+    """random presence/absence matrix with a core fraction of blocks, and block
+    lengths drawn from a log-normal distribution"""
+    freq = rng.uniform(size=B)
+    freq[: B // 4] = 1.0
+    PA = rng.uniform(size=(N, B)) < freq
+    Ls = np.rint(rng.lognormal(mean=7, sigma=1.5, size=B)).astype(np.int64) + 1
+    return PA, Ls
+
+
+def private_seq_loop(PA, Ls):
+    """reference implementation: one xor per pair"""
+    N = PA.shape[0]
+    D = np.zeros((N, N), dtype=np.int64)
+    for i, j in combinations(range(N), 2):
+        D[i, j] = D[j, i] = np.sum((PA[i] ^ PA[j]) * Ls)
+    return D
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    rng = np.random.default_rng(42)
+
+    print("n_isolates\tn_blocks\tt_matrix (s)\tt_loop (s)")
+    for N in args.sizes:
+        PA, Ls = random_presence_absence(N, args.n_blocks, rng)
+
+        out = np.empty((N, N), dtype=np.int32)
+        t0 = time.perf_counter()
+        D = private_seq_matrix(PA, Ls, out=out)
+        t_matrix = time.perf_counter() - t0
+
+        t_loop = np.nan
+        if N <= args.max_loop:
+            t0 = time.perf_counter()
+            D_ref = private_seq_loop(PA, Ls)
+            t_loop = time.perf_counter() - t0
+            assert np.array_equal(D, D_ref), "mismatch with per-pair loop"
+
+        print(f"{N}\t{args.n_blocks}\t{t_matrix:.3f}\t{t_loop:.3f}")
@@ -0,0 +1,200 @@
+# scaling benchmark for the analysis scripts. Synthetic pangraphs and trees are
+# generated for an increasing number of isolates, and the core functions of
+# each script are timed (and optionally memory-profiled with tracemalloc) on
+# them. Results are printed as a table and saved as a json file with one
+# record per (function, size).
+
+import argparse
+import json
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+import matplotlib
+
+matplotlib.use("Agg")
+
+import numpy as np
+import pandas as pd
+from Bio import Phylo
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1] / "scripts"))
+import bla_structural_diversity as bla
+import plot_private_seq as pps
+import shared_paths_vs_coretree as spc
+from clustering_utils import clustering_order
+from matrix_utils import upper_triangle_df
+from pangraph_cache import build_cache, load_pangraph
+from private_seq_utils import PresenceAbsence, sparse_private_seq_matrix
+from shared_path_utils import AnchorSharedPaths
+from tree_utils import FlatTree
+
+from synthetic_pangraph import generate, write
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[20, 100, 500],
+        help="number of isolates",
+    )
+    parser.add_argument("--n_blocks", type=int, default=500, help="n. of blocks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="also measure peak memory, re-running each function under tracemalloc",
+    )
+    parser.add_argument("--out", type=str, default=None, help="output json file")
+    return parser.parse_args()
+
+
+def measure(fn, memory):
+    """runs a function and returns its result, the running time (s) and the
+    peak memory allocated during a second run (MB), if requested"""
+    t0 = time.perf_counter()
+    res = fn()
+    t = time.perf_counter() - t0
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return res, t, peak
+
+
+def stages(wd, anchor):
+    """list of (script, function, callable) for the benchmarked functions. Each
+    callable receives a dictionary with the results of the previous stages,
+    and returns a dictionary of new results."""
+    pan_json = str(wd / "pangraph.json")
+    tree_file = str(wd / "tree.nwk")
+
+    def __cache(r):
+        build_cache(pan_json)
+        return {}
+
+    def __load(r):
+        pan = load_pangraph(pan_json)
+        tree = Phylo.read(tree_file, "newick")
+        names = [p.name for p in pan.paths]
+        colors = {n: "C0" for n in names}
+        return {"pan": pan, "tree": tree, "names": names, "colors": colors}
+
+    def __pa(r):
+        pa = PresenceAbsence.from_pangraph(r["pan"])
+        return {"ps_names": r["pan"].strains(), "pa": pa}
+
+    def __private_seq(r):
+        N = len(r["ps_names"])
+        D = sparse_private_seq_matrix(r["pa"], out=np.empty((N, N), np.float32))
+        return {"D": D}
+
+    def __lce_index(r):
+        pan = r["pan"]
+        Ls = pan.to_blockstats_df()["len"].to_numpy()
+        enc = [(p.block_idx, p.block_strands) for p in pan.paths]
+        return {"sp": AnchorSharedPaths(enc, pan.block_idx[anchor], Ls)}
+
+    def __shared_len(r):
+        N = len(r["names"])
+        S = r["sp"].shared_length_matrix(out=np.empty((N, N), np.float32))
+        return {"S": S}
+
+    def __clustering(r):
+        order = clustering_order(r["S"])
+        return {"path_order": pd.Index(r["names"])[order]}
+
+    def __plot_paths(r):
+        args = (r["pan"], r["path_order"], r["colors"], anchor)
+        bla.plot_paths(*args, str(wd / "paths.png"))
+        return {}
+
+    def __plot_shared_len(r):
+        S, names = r["S"], r["names"]
+        fig = str(wd / "shared_len.png")
+        if len(names) > 500:
+            bla.pooled_shared_length_matrix(
+                S, names, r["path_order"], r["colors"], fig, 500, "mean"
+            )
+        else:
+            S = pd.DataFrame(S, index=names, columns=names)
+            bla.plot_shared_length_matrix(S, r["path_order"], r["colors"], fig)
+        return {}
+
+    def __tree_dist(r):
+        df = upper_triangle_df(r["names"], r["S"], "shared_L")
+        ftree = FlatTree(r["tree"])
+        df["tree_dist"] = ftree.distance(df["p1"], df["p2"])
+        return {"df_l": df}
+
+    def __tree_plot(r):
+        spc.tree_plot(r["tree"], r["df_l"], r["colors"], str(wd / "tree.png"))
+        return {}
+
+    def __private_seq_plots(r):
+        names, D, tree = r["ps_names"], r["D"], r["tree"]
+        df = pps.add_tree_distances(tree, upper_triangle_df(names, D, "private_seq"))
+        pps.scatterplot(df, str(wd / "scatter.png"))
+        fig = str(wd / "private_seq.png")
+        if len(names) > 500:
+            pps.pooled_matrixplot(tree, names, D, fig, 500, "mean", 20)
+        else:
+            M = pd.DataFrame(D, index=names, columns=names)
+            pps.matrixplot(tree, M, fig)
+        return {}
+
+    return [
+        ("pangraph_cache", "build_cache", __cache),
+        ("pangraph_cache", "load_pangraph", __load),
+        ("pairwise_private_seq", "PresenceAbsence", __pa),
+        ("pairwise_private_seq", "sparse_private_seq_matrix", __private_seq),
+        ("bla_structural_diversity", "AnchorSharedPaths", __lce_index),
+        ("bla_structural_diversity", "shared_length_matrix", __shared_len),
+        ("bla_structural_diversity", "clustering_order", __clustering),
+        ("bla_structural_diversity", "plot_paths", __plot_paths),
+        ("bla_structural_diversity", "plot_shared_length_matrix", __plot_shared_len),
+        ("shared_paths_vs_coretree", "tree_distances", __tree_dist),
+        ("shared_paths_vs_coretree", "tree_plot", __tree_plot),
+        ("plot_private_seq", "plots", __private_seq_plots),
+    ]
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    results = []
+    print("script\tfunction\tn_isolates\tn_blocks\ttime (s)\tpeak mem (MB)")
+    for N in args.sizes:
+        with tempfile.TemporaryDirectory() as wd:
+            wd = pathlib.Path(wd)
+            pan, tree, anchor = generate(N, args.n_blocks, seed=args.seed)
+            write(pan, tree, wd / "pangraph.json", wd / "tree.nwk")
+            del pan
+
+            r = {}
+            for script, fn_name, fn in stages(wd, anchor):
+                res, t, peak = measure(lambda: fn(r), args.memory)
+                r.update(res)
+                results.append(
+                    {
+                        "script": script,
+                        "function": fn_name,
+                        "n_isolates": N,
+                        "n_blocks": args.n_blocks,
+                        "time_s": t,
+                        "peak_mem_mb": peak,
+                    }
+                )
+                mem = "-" if peak is None else f"{peak:.1f}"
+                print(f"{script}\t{fn_name}\t{N}\t{args.n_blocks}\t{t:.3f}\t{mem}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
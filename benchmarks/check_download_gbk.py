@@ -0,0 +1,104 @@
+# offline check of the genbank downloader against a local HTTP stand-in. The
+# server serves small genbank files, answers the first request for each
+# accession with a server error (to exercise the retries) and returns 404 for
+# unknown accessions. The check verifies the downloaded files, that cached and
+# repeated accessions are never fetched again, and that failures are reported.
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1] / "scripts"))
+import requests
+from download_gbk import GenbankCache, download, fetch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_acc", type=int, default=8, help="n. of accessions")
+    parser.add_argument("--threads", type=int, default=3, help="max n. of requests")
+    return parser.parse_args()
+
+
+def genbank(acc):
+    """content of a small genbank file for an accession"""
+    return f"LOCUS       {acc}  12 bp  DNA\nORIGIN\n        1 acgtacgtacgt\n//\n"
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """serves /gbk/<acc> for the known accessions. The first request for each
+    accession fails with status 503. Requests are counted per accession."""
+
+    accs, counts, lock = set(), Counter(), threading.Lock()
+
+    def do_GET(self):
+        acc = self.path.rsplit("/", 1)[-1]
+        with self.lock:
+            self.counts[acc] += 1
+            n = self.counts[acc]
+        if acc not in self.accs:
+            self.send_response(404)
+            body = b"not found"
+        elif n == 1:
+            self.send_response(503)
+            body = b"busy"
+        else:
+            self.send_response(200)
+            body = genbank(acc).encode()
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    accs = [f"NZ_TEST{n:04d}" for n in range(args.n_acc)]
+    StandIn.accs = set(accs)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/gbk/{{acc}}"
+    opts = dict(threads=args.threads, retries=2, backoff=0.01, timeout=5.0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        cache = GenbankCache(tmp / "cache")
+
+        # first download, with a repeated accession: each accession is fetched
+        # twice (one failure, one retry)
+        download(accs + accs[:1], tmp / "out1", cache, endpoint, **opts)
+        for acc in accs:
+            assert (tmp / "out1" / f"{acc}.gbk").read_text() == genbank(acc)
+        assert all(StandIn.counts[acc] == 2 for acc in accs), StandIn.counts
+        print(f"downloaded {len(accs)} accessions with one retry each")
+
+        # second download in another folder, entirely from the cache
+        download(accs, tmp / "out2", GenbankCache(tmp / "cache"), endpoint, **opts)
+        for acc in accs:
+            assert (tmp / "out2" / f"{acc}.gbk").read_text() == genbank(acc)
+        assert sum(StandIn.counts.values()) == 2 * len(accs), StandIn.counts
+        print("cached accessions are not fetched again")
+
+        # unknown accessions fail without retries, and so does a server error
+        # when retries are exhausted
+        StandIn.accs.add("NZ_TEST_NEW")
+        with requests.Session() as session:
+            for acc, retries in [("NZ_MISSING", 2), ("NZ_TEST_NEW", 0)]:
+                try:
+                    fetch(session, endpoint.format(acc=acc), retries, 0.01, 5.0)
+                    raise AssertionError(f"{acc} should fail")
+                except requests.HTTPError:
+                    pass
+            assert StandIn.counts["NZ_MISSING"] == 1
+        print("failed requests are reported")
+
+    server.shutdown()
+    print("ok")
@@ -0,0 +1,244 @@
+# Generator of synthetic pangraphs and phylogenetic trees, used to benchmark the
+# analysis scripts without downloading real data. Files are written in the same
+# json format as pangraph, and can be loaded with `pypangraph`.
+#
+# A random coalescent tree is generated for the isolates. Core blocks are present
+# once in every isolate. Each accessory block is gained on a random branch of
+# the tree (with probability proportional to branch length), so that it is
+# present in all isolates below it, and is then lost independently in each
+# isolate with a fixed probability. Blocks are arranged in the same ancestral
+# order in all isolates, then a fraction of accessory blocks is duplicated and
+# random inversions are applied to each path.
+
+import argparse
+import json
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="generate a synthetic pangraph json file and newick tree"
+    )
+    parser.add_argument("--json", type=str, required=True, help="output pangraph")
+    parser.add_argument("--tree", type=str, required=True, help="output tree")
+    parser.add_argument("--n_isolates", type=int, default=100)
+    parser.add_argument("--n_blocks", type=int, default=500)
+    parser.add_argument("--core_frac", type=float, default=0.3)
+    parser.add_argument(
+        "--len_mu", type=float, default=7.0, help="mean of log block length"
+    )
+    parser.add_argument(
+        "--len_sigma", type=float, default=1.0, help="std of log block length"
+    )
+    parser.add_argument(
+        "--dup_rate", type=float, default=0.05, help="fraction of duplicated blocks"
+    )
+    parser.add_argument(
+        "--inv_rate", type=float, default=0.5, help="mean n. of inversions per path"
+    )
+    parser.add_argument(
+        "--loss_rate", type=float, default=0.1, help="accessory block loss probability"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def random_tree(N, rng):
+    """random coalescent tree with N leaves. Returns the list of children of
+    each node (leaves are 0..N-1, the root is the last node) and the branch
+    length of each node."""
+    children = [[] for _ in range(N)]
+    height = [0.0] * N
+    active = list(range(N))
+    t = 0.0
+    while len(active) > 1:
+        k = len(active)
+        t += rng.exponential(2.0 / (k * (k - 1)))
+        # remove two random active nodes (swap with the last element)
+        merged = []
+        for _ in range(2):
+            i = rng.integers(len(active))
+            active[i], active[-1] = active[-1], active[i]
+            merged.append(active.pop())
+        children.append(merged)
+        height.append(t)
+        active.append(len(children) - 1)
+    parent = np.full(len(children), -1)
+    for n, ch in enumerate(children):
+        parent[ch] = n
+    height = np.array(height)
+    branch = np.where(parent >= 0, height[parent] - height, 0.0)
+    return children, branch
+
+
+def leaf_order(children, N):
+    """order of the leaves in a depth-first visit, and for each node the
+    interval [start, end) of positions of the leaves of its subtree"""
+    root = len(children) - 1
+    order = []
+    rng_lo = np.zeros(len(children), dtype=int)
+    rng_hi = np.zeros(len(children), dtype=int)
+    stack = [(root, False)]
+    while stack:
+        n, visited = stack.pop()
+        if visited:
+            rng_hi[n] = len(order)
+            continue
+        rng_lo[n] = len(order)
+        if n < N:
+            order.append(n)
+            rng_hi[n] = len(order)
+            continue
+        stack.append((n, True))
+        for c in reversed(children[n]):
+            stack.append((c, False))
+    return np.array(order), rng_lo, rng_hi
+
+
+def newick(children, branch, names):
+    """newick string of the tree"""
+    root = len(children) - 1
+    out = []
+    stack = [(root, 0)]
+    while stack:
+        n, k = stack.pop()
+        if n < len(names):
+            out.append(f"{names[n]}:{branch[n]:.6f}")
+        elif k == 0:
+            out.append("(")
+            stack.append((n, 1))
+            stack.append((children[n][0], 0))
+        elif k < len(children[n]):
+            out.append(",")
+            stack.append((n, k + 1))
+            stack.append((children[n][k], 0))
+        else:
+            out.append(")" if n == root else f"):{branch[n]:.6f}")
+    return "".join(out) + ";"
+
+
+def random_sequence(L, rng):
+    """random nucleotide sequence of length L"""
+    return np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, L)].tobytes()
+
+
+def generate(
+    n_isolates,
+    n_blocks,
+    core_frac=0.3,
+    len_mu=7.0,
+    len_sigma=1.0,
+    dup_rate=0.05,
+    inv_rate=0.5,
+    loss_rate=0.1,
+    seed=0,
+):
+    """generates a synthetic pangraph. Returns the pangraph json dictionary,
+    the newick string of the tree and the id of a core block that can be used
+    as an anchor."""
+    rng = np.random.default_rng(seed)
+    N, B = n_isolates, n_blocks
+    names = [f"iso{n:05d}" for n in range(N)]
+    block_ids = [f"B{b:06d}" for b in range(B)]
+    Ls = np.rint(rng.lognormal(len_mu, len_sigma, size=B)).astype(int) + 1
+    n_core = max(1, int(core_frac * B))
+
+    # tree, and range of leaves below each node
+    children, branch = random_tree(N, rng)
+    order, lo, hi = leaf_order(children, N)
+
+    # presence/absence matrix (rows in leaf order)
+    PA = np.zeros((N, B), dtype=bool)
+    PA[:, :n_core] = True
+    p_branch = branch / branch.sum()
+    gain = rng.choice(len(branch), size=B - n_core, p=p_branch)
+    for b, node in zip(range(n_core, B), gain):
+        PA[lo[node] : hi[node], b] = True
+    PA[:, n_core:] &= rng.random((N, B - n_core)) >= loss_rate
+    PA[order] = PA.copy()
+
+    # ancestral order of blocks, and duplicated blocks
+    anc = rng.permutation(B)
+    dup = np.zeros(B, dtype=bool)
+    dup[n_core:] = rng.random(B - n_core) < dup_rate
+
+    paths, occurrences = [], [[] for _ in range(B)]
+    for n, name in enumerate(names):
+        bl = anc[PA[n, anc]]
+        st = np.ones(len(bl), dtype=bool)
+        # duplications: insert a second copy at a random position
+        for b in bl[dup[bl]]:
+            i = rng.integers(len(bl) + 1)
+            bl = np.insert(bl, i, b)
+            st = np.insert(st, i, rng.random() < 0.5)
+        # inversions of random segments
+        for _ in range(rng.poisson(inv_rate)):
+            i, j = np.sort(rng.integers(0, len(bl) + 1, size=2))
+            bl[i:j] = bl[i:j][::-1]
+            st[i:j] = ~st[i:j][::-1]
+
+        pos = np.concatenate([[0], np.cumsum(Ls[bl])])
+        count = {}
+        blocks = []
+        for k, (b, s) in enumerate(zip(bl.tolist(), st.tolist())):
+            num = count.get(b, 0)
+            count[b] = num + 1
+            occ = {"name": name, "number": num, "strand": s}
+            blocks.append({"id": block_ids[b], **occ})
+            occurrences[b].append((occ, [int(pos[k]), int(pos[k + 1])]))
+        paths.append(
+            {
+                "name": name,
+                "offset": 0,
+                "circular": True,
+                "position": pos.tolist(),
+                "blocks": blocks,
+            }
+        )
+
+    blocks = []
+    for b in range(B):
+        occ = occurrences[b]
+        if len(occ) == 0:
+            continue
+        blocks.append(
+            {
+                "id": block_ids[b],
+                "sequence": random_sequence(Ls[b], rng).decode(),
+                "gaps": {},
+                "mutate": [[o, []] for o, _ in occ],
+                "insert": [[o, []] for o, _ in occ],
+                "delete": [[o, []] for o, _ in occ],
+                "positions": [[o, p] for o, p in occ],
+            }
+        )
+
+    pan = {"paths": paths, "blocks": blocks}
+    return pan, newick(children, branch, names), block_ids[0]
+
+
+def write(pan, tree, json_file, tree_file):
+    """saves the pangraph json file and the newick tree"""
+    with open(json_file, "w") as f:
+        json.dump(pan, f)
+    with open(tree_file, "w") as f:
+        f.write(tree + "\n")
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    pan, tree, anchor = generate(
+        args.n_isolates,
+        args.n_blocks,
+        core_frac=args.core_frac,
+        len_mu=args.len_mu,
+        len_sigma=args.len_sigma,
+        dup_rate=args.dup_rate,
+        inv_rate=args.inv_rate,
+        loss_rate=args.loss_rate,
+        seed=args.seed,
+    )
+    write(pan, tree, args.json, args.tree)
+    print(f"anchor block: {anchor}")
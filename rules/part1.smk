@@ -9,7 +9,10 @@ rule map_bla:
         "../config/conda_env.yml"
     shell:
         """
-        minimap2 -x asm5 {input.bla} {input.fa} > {output}
+        python3 scripts/profile_cmd.py \
+            --name minimap2 --inputs {input} --outputs {output} \
+            --stdout {output} \
+            -- minimap2 -x asm5 {input.bla} {input.fa}
         """
 
 
@@ -18,32 +21,37 @@ rule extract_window:
         paf=rules.map_bla.output,
         fa=rules.map_bla.input.fa,
     output:
-        "results/bla15/extracted_window_{w}.fa",
+        window=f"results/bla15/extracted_window_{config['window-size']}.fa",
+        aln="results/bla15/extracted_window_0.fa",
     conda:
         "../config/conda_env.yml"
     params:
         L=int(config["bla-len"] * 0.95),
+        w=config["window-size"],
     shell:
         """
         python3 scripts/extract_matches.py \
             --in_fa {input.fa} \
             --paf {input.paf} \
-            --window {wildcards.w} \
+            --window {params.w} 0 \
             --length {params.L} \
-            --out {output}
+            --out {output.window} {output.aln}
         """
 
 
 rule build_window_pangraph:
     input:
-        expand(rules.extract_window.output, w=config["window-size"]),
+        rules.extract_window.output.window,
     output:
         "results/bla15/pangraph_window.json",
     conda:
         "../config/conda_env.yml"
     shell:
         """
-        pangraph build -l 50 -a 10 -b 10 -s 5 {input} > {output}
+        python3 scripts/profile_cmd.py \
+            --name "pangraph build" --inputs {input} --outputs {output} \
+            --stdout {output} \
+            -- pangraph build -l 50 -a 10 -b 10 -s 5 {input}
         """
 
 
@@ -56,23 +64,28 @@ rule export_window_pangraph:
         "../config/conda_env.yml"
     shell:
         """
-        pangraph export \
+        python3 scripts/profile_cmd.py \
+            --name "pangraph export" --inputs {input} --outputs {output} \
+            -- pangraph export \
             -nd \
             --edge-minimum-length 0 \
-            -o {output} {input} 
+            -o {output} {input}
         """
 
 
 rule extract_alignment:
     input:
-        expand(rules.extract_window.output, w=0),
+        rules.extract_window.output.aln,
     output:
         "results/bla15/bla_alignment.fa",
     conda:
         "../config/conda_env.yml"
     shell:
         """
-        mafft --auto --adjustdirection {input} > {output}
+        python3 scripts/profile_cmd.py \
+            --name mafft --inputs {input} --outputs {output} \
+            --stdout {output} \
+            -- mafft --auto --adjustdirection {input}
         """
 
 
@@ -105,22 +118,28 @@ rule find_bla_block:
         "../config/conda_env.yml"
     shell:
         """
-        minimap2 {input.fa} {input.exp}/pangraph.fa \
-            | head -1 | awk '{{print $1}}' \
-            > {output}
+        python3 scripts/profile_cmd.py \
+            --name minimap2 --inputs {input} --outputs {output} \
+            --stdout {output} \
+            -- bash -c "minimap2 {input.fa} {input.exp}/pangraph.fa | head -1 | cut -f1"
         """
 
 
 rule bla_structural_diversity:
     input:
         pan=rules.build_window_pangraph.output,
+        cache="results/bla15/pangraph_window.cache",
         block=rules.find_bla_block.output,
         leaves_col=rules.bla_assign_color_to_isolate.output.color,
     output:
-        shared_L="results/bla15/shared_bla_length.csv",
+        shared_L="results/bla15/shared_bla_length.npy",
+        shared_L_labels="results/bla15/shared_bla_length.labels.txt",
         colors="results/bla15/block_colors.csv",
         fig_paths="figs/bla_paths_drawing.png",
         fig_matrix="figs/bla_paths_shared_len.png",
+    params:
+        state="results/incremental/bla_shared_length",
+    threads: 32
     conda:
         "../config/conda_env.yml"
     shell:
@@ -132,7 +151,9 @@ rule bla_structural_diversity:
             --fig_paths {output.fig_paths} \
             --fig_matrix {output.fig_matrix} \
             --block_colors {output.colors} \
-            --shared_len_df {output.shared_L}
+            --shared_len_mat {output.shared_L} \
+            --incremental {params.state} \
+            --threads {threads}
         """
 
 
@@ -144,16 +165,21 @@ rule bla_structure_vs_coretree:
     output:
         fig_scatter="figs/bla_shared_len_vs_coretree_scatter.png",
         fig_tree="figs/bla_shared_len_vs_coretree.png",
+    params:
+        state="results/incremental/bla_tree_distance",
+    threads: 32
     conda:
         "../config/conda_env.yml"
     shell:
         """
         python3 scripts/shared_paths_vs_coretree.py \
-            --shared_len_df {input.shared_L} \
+            --shared_len_mat {input.shared_L} \
             --tree {input.tree} \
             --leaves_colors {input.leaves_col} \
             --fig_scatter {output.fig_scatter} \
-            --fig_tree {output.fig_tree}
+            --fig_tree {output.fig_tree} \
+            --incremental {params.state} \
+            --threads {threads}
         """
 
 
@@ -9,7 +9,10 @@ rule build_subset_pangraph:
     shell:
         """
         JULIA_NUM_THREADS=3
-        pangraph build --circular -a 20 -b 5 -s 20 {input.fa} > {output}
+        python3 scripts/profile_cmd.py \
+            --name "pangraph build" --inputs {input} --outputs {output} \
+            --stdout {output} \
+            -- pangraph build --circular -a 20 -b 5 -s 20 {input.fa}
         """
 
 
@@ -22,22 +25,27 @@ rule export_subset_pangraph:
         "../config/conda_env.yml"
     shell:
         """
-        pangraph export -nd -o {output} -ell 0 {input} 
+        python3 scripts/profile_cmd.py \
+            --name "pangraph export" --inputs {input} --outputs {output} \
+            -- pangraph export -nd -o {output} -ell 0 {input}
         """
 
 
 rule plot_block_distr:
     input:
-        rules.build_subset_pangraph.output,
+        pan=rules.build_subset_pangraph.output,
+        cache="results/pangraph/subset.cache",
     output:
-        "figs/block_distr.png",
+        fig="figs/block_distr.png",
+        summary="results/pangraph/block_distr_summary.tsv",
     conda:
         "../config/conda_env.yml"
     shell:
         """
         python3 scripts/plot_block_distr.py \
-            --pangraph {input} \
-            --fig {output}
+            --pangraph {input.pan} \
+            --fig {output.fig} \
+            --summary {output.summary}
         """
 
 
@@ -48,7 +56,9 @@ rule plot_bandage_subset:
         "figs/bandage_subset.png",
     shell:
         """
-        bandage image {input}/pangraph.gfa {output} \
+        python3 scripts/profile_cmd.py \
+            --name bandage --inputs {input} --outputs {output} \
+            -- bandage image {input}/pangraph.gfa {output} \
             --nodewidth 5 \
             --iter 4 \
             --colour depth \
@@ -59,22 +69,54 @@ rule plot_bandage_subset:
 
 rule private_seq_distance:
     input:
-        rules.build_subset_pangraph.output,
+        pan=rules.build_subset_pangraph.output,
+        cache="results/pangraph/subset.cache",
+    output:
+        mat="results/pangraph/private_seq_distance.npy",
+        labels="results/pangraph/private_seq_distance.labels.txt",
+    params:
+        state="results/incremental/private_seq_distance",
+    threads: 32
+    conda:
+        "../config/conda_env.yml"
+    shell:
+        """
+        python3 scripts/pairwise_private_seq.py \
+            --pangraph {input.pan} \
+            --dist_mat {output.mat} \
+            --incremental {params.state} \
+            --threads {threads}
+        """
+
+
+rule private_seq_sketch_validation:
+    input:
+        pan=rules.build_subset_pangraph.output,
+        cache="results/pangraph/subset.cache",
     output:
-        "results/pangraph/private_seq_distance.csv",
+        mat="results/pangraph/private_seq_distance_approx.npy",
+        labels="results/pangraph/private_seq_distance_approx.labels.txt",
+        val="results/pangraph/private_seq_sketch_validation.tsv",
+    params:
+        n_hashes=128,
+    threads: 32
     conda:
         "../config/conda_env.yml"
     shell:
         """
         python3 scripts/pairwise_private_seq.py \
-            --pangraph {input} \
-            --dist_df {output}
+            --pangraph {input.pan} \
+            --dist_mat {output.mat} \
+            --approx \
+            --n_hashes {params.n_hashes} \
+            --validate {output.val} \
+            --threads {threads}
         """
 
 
 rule plot_private_seq:
     input:
-        dist_df=rules.private_seq_distance.output,
+        dist_mat=rules.private_seq_distance.output.mat,
         tree=config["coregenome-tree"],
     output:
         fig_scatter="figs/private_seq_scatter.png",
@@ -84,7 +126,7 @@ rule plot_private_seq:
     shell:
         """
         python3 scripts/plot_private_seq.py \
-            --dist_df {input.dist_df} \
+            --dist_mat {input.dist_mat} \
             --tree {input.tree} \
             --fig_scatter {output.fig_scatter} \
             --fig_matrix {output.fig_matrix}
@@ -10,9 +10,12 @@ rule marginalize:
         s2=strain_pair[1],
     shell:
         """
-        pangraph marginalize \
+        python3 scripts/profile_cmd.py \
+            --name "pangraph marginalize" --inputs {input} --outputs {output} \
+            --stdout {output} \
+            -- pangraph marginalize \
             --strains {params.s1},{params.s2} \
-            {input} > {output}
+            {input}
         """
 
 
@@ -25,13 +28,16 @@ rule export_marginal_graph:
         "../config/conda_env.yml"
     shell:
         """
-        pangraph export -nd -ell 0 -o {output} {input} 
+        python3 scripts/profile_cmd.py \
+            --name "pangraph export" --inputs {input} --outputs {output} \
+            -- pangraph export -nd -ell 0 -o {output} {input}
         """
 
 
 rule plot_graph_projection:
     input:
-        rules.marginalize.output,
+        pan=rules.marginalize.output,
+        cache="results/pangraph/marginalized.cache",
     output:
         "figs/graph_projection.png",
     conda:
@@ -39,11 +45,34 @@ rule plot_graph_projection:
     shell:
         """
         python3 scripts/plot_graph_projection.py \
-            --pangraph {input} \
+            --pangraph {input.pan} \
             --fig {output}
         """
 
 
+rule pairwise_projection_stats:
+    input:
+        pan=rules.build_subset_pangraph.output,
+        cache="results/pangraph/subset.cache",
+    output:
+        stats="results/pangraph/projection_stats.tsv",
+        figs=directory("figs/projections"),
+    params:
+        n_figs=5,
+    threads: 32
+    conda:
+        "../config/conda_env.yml"
+    shell:
+        """
+        python3 scripts/pairwise_projection.py \
+            --pangraph {input.pan} \
+            --stats {output.stats} \
+            --fig_dir {output.figs} \
+            --n_figs {params.n_figs} \
+            --threads {threads}
+        """
+
+
 rule plot_bandage_marginal:
     input:
         rules.export_marginal_graph.output,
@@ -53,7 +82,9 @@ rule plot_bandage_marginal:
         "../config/conda_env.yml"
     shell:
         """
-        bandage image {input}/pangraph.gfa {output} \
+        python3 scripts/profile_cmd.py \
+            --name bandage --inputs {input} --outputs {output} \
+            -- bandage image {input}/pangraph.gfa {output} \
             --iter 4 \
             --colour depth \
             --depvallow 1 \
@@ -5,6 +5,8 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 from Bio import Phylo
 
+from profiling import Profiler
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -48,8 +50,10 @@ def plot_tree(tree, selected, colors, fig_name):
 if __name__ == "__main__":
 
     args = parse_args()
+    prof = Profiler(inputs=[args.tree, args.paf], outputs=[args.color_csv, args.fig])
 
     # load newick tree
+    prof.stage("load")
     tree = Phylo.read(args.tree, "newick")
 
     # get list of isolates containing the bla gene
@@ -60,9 +64,13 @@ if __name__ == "__main__":
     colors = {l.name: next(cg) for l in tree.get_terminals() if l.name in selected}
 
     # plot the tree, with selected leaves in corresponding colors
+    prof.stage("plot")
     plot_tree(tree, selected, colors, args.fig)
 
     # save colors to csv file
+    prof.stage("write")
     selected_colors = {l: mpl.colors.to_hex(v) for l, v in colors.items()}
     cdf = pd.Series(selected_colors, name="color")
     cdf.to_csv(args.color_csv, index_label="isolate")
+
+    prof.save()
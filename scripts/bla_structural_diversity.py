@@ -3,12 +3,23 @@ import pandas as pd
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-import scipy.cluster.hierarchy as spc
-
-
-from itertools import product
-
-import pypangraph as pp
+from matplotlib.collections import LineCollection
+
+from pangraph_cache import cache_dir, load_pangraph
+from matrix_utils import (
+    copy_from_state,
+    create_matrix,
+    create_pair_tensor,
+    export_csv,
+    fingerprint,
+    incremental_plan,
+    load_state,
+    pooled_matrix,
+    save_state,
+)
+from shared_path_utils import AnchorSharedPaths, MultiAnchorSharedPaths
+from clustering_utils import clustering_order
+from profiling import Profiler
 
 
 def parse_args():
@@ -19,85 +30,164 @@ def parse_args():
     args.add_argument("--fig_paths", type=str, required=True)
     args.add_argument("--fig_matrix", type=str, required=True)
     args.add_argument("--block_colors", type=str, required=True)
-    args.add_argument("--shared_len_df", type=str, required=True)
-    return args.parse_args()
-
-
-def shared_path_from_anchor(p1, p2, Ls, anchor):
-    """given two paths, a dictionary of block lengths and an anchor block,
-    return the length of shared co-path starting from the anchor block"""
-    # list of block ids and strandedness
-    B1, B2 = [list(p.block_ids) for p in [p1, p2]]
-    S1, S2 = [list(p.block_strands) for p in [p1, p2]]
-
-    # index of anchor block in each path
-    a1, a2 = [l.index(anchor) for l in [B1, B2]]
-
-    # flip paths if anchor block is on the reverse strand
-    if not S1[a1]:
-        B1 = B1[::-1]
-        S1 = [not s for s in reversed(S1)]
-        a1 = B1.index(anchor)
-    if not S2[a2]:
-        B2 = B2[::-1]
-        S2 = [not s for s in reversed(S2)]
-        a2 = B2.index(anchor)
-
-    shared_L = 0
-
-    # rev comparison, move backward from anchor block
-    for k in range(0, min(a1, a2) + 1):
-        i1, i2 = a1 - k, a2 - k
-        if (B1[i1] == B2[i2]) and (S1[i1] == S2[i2]):
-            shared_L += Ls[B1[i1]]
-        else:
-            break
-    # fwd comparison, move forward from anchor block
-    for k in range(1, min(len(B1) - a1, len(B2) - a2)):
-        i1, i2 = a1 + k, a2 + k
-        if (B1[i1] == B2[i2]) and (S1[i1] == S2[i2]):
-            shared_L += Ls[B1[i1]]
-        else:
-            break
-
-    return shared_L
-
-
-def hierarchical_clustering_order(shared_L):
-    """given the dataframe of shared lengths performs hierarchical clustering
-    and returns the order of the paths"""
-    # compute distance matrix
-    S = shared_L.pivot(index="p1", columns="p2", values="shared_L")
-
-    # dictionary of self-similarity
-    diag = {c: S.loc[c, c] for c in S.columns}
-
-    # divide element i,j by the minimum of the diagonal elements of i and j
-    # and transform into a distance matrix
-    D = S / S.apply(
-        lambda x: np.minimum(diag[x.name], [diag[i] for i in x.index]),
-        axis=1,
-        result_type="broadcast",
+    args.add_argument("--shared_len_mat", type=str, required=True)
+    args.add_argument("--shared_len_df", type=str, default=None)
+    args.add_argument("--linkage_method", type=str, default="complete")
+    args.add_argument(
+        "--max_exact",
+        type=int,
+        default=10000,
+        help="max n. of paths for exact clustering, above which the order is approximated",
     )
-    D = 1 - D.to_numpy()
-
-    # perform hierarchical clustering
-    linkage = spc.linkage(spc.distance.squareform(D), method="complete")
-    # order of paths
-    order = spc.leaves_list(linkage)
-    path_order = S.index[order]
-
-    return path_order
+    args.add_argument(
+        "--n_landmarks",
+        type=int,
+        default=2000,
+        help="n. of landmark paths for the approximate clustering order",
+    )
+    args.add_argument(
+        "--optimal_ordering",
+        action="store_true",
+        help="reorder the leaves to minimize the distance between successive paths",
+    )
+    args.add_argument(
+        "--max_optimal",
+        type=int,
+        default=2000,
+        help="max n. of leaves for the optimal leaf ordering",
+    )
+    args.add_argument(
+        "--no_lod",
+        action="store_true",
+        help="draw all blocks, without merging blocks smaller than a pixel",
+    )
+    args.add_argument(
+        "--max_matrix_size",
+        type=int,
+        default=500,
+        help="above this n. of paths the matrix is downsampled to this size",
+    )
+    args.add_argument("--pool", choices=["mean", "max"], default="mean")
+    args.add_argument("--threads", type=int, default=1, help="n. of processes")
+    args.add_argument(
+        "--anchor_tensor",
+        type=str,
+        default=None,
+        help="optional output (anchor x pair) tensor of shared lengths, see --anchors",
+    )
+    args.add_argument(
+        "--anchors",
+        type=str,
+        nargs="+",
+        default=["core"],
+        help="anchor blocks for the tensor, 'core' stands for all core blocks",
+    )
+    args.add_argument(
+        "--max_core_anchors",
+        type=int,
+        default=None,
+        help="random sample of at most this n. of core blocks",
+    )
+    args.add_argument("--seed", type=int, default=0)
+    args.add_argument(
+        "--incremental",
+        type=str,
+        default=None,
+        help="state directory, to only evaluate the rows of new or changed paths",
+    )
+    return args.parse_args()
 
 
-def plot_paths(pan, paths_order, leaves_colors, core_anchor, fig_savename):
+def path_fingerprints(pan):
+    """fingerprint of each path: sequence of blocks, strands and lengths"""
+    fps = []
+    for p in pan.paths:
+        ids, ls = pan.block_ids[p.block_idx], pan.block_len[p.block_idx]
+        fps.append(fingerprint(ids, p.block_strands, ls))
+    return fps
+
+
+def select_anchors(bdf, anchors, max_core=None, seed=0):
+    """list of anchor blocks, given a list of block ids in which 'core' stands
+    for all core blocks, or a random sample of `max_core` of them. Duplicates
+    are removed."""
+    core = bdf.index[bdf["core"]].to_numpy()
+    if max_core is not None and len(core) > max_core:
+        rng = np.random.default_rng(seed)
+        core = core[np.sort(rng.choice(len(core), max_core, replace=False))]
+    res = []
+    for a in anchors:
+        res += list(core) if a == "core" else [a]
+    return list(dict.fromkeys(res))
+
+
+def hierarchical_clustering_order(S, names, **kwargs):
+    """given the matrix of shared lengths and the corresponding path names,
+    performs hierarchical clustering and returns the order of the paths.
+    Keyword arguments are passed to `clustering_order`."""
+    order = clustering_order(S, **kwargs)
+    return pd.Index(names)[order]
+
+
+def path_segments(pan, paths_order, core_anchor, Ls):
+    """returns arrays (row, start, end, block index) with one entry per block
+    occurrence, for all paths in the given order. Paths are oriented so that the
+    anchor block is on the forward strand."""
+    a = pan.block_idx[core_anchor]
+    rows, bidx = [], []
+    for n, p_name in enumerate(paths_order):
+        p = pan.paths[p_name]
+        idx = p.block_idx
+        cid = np.flatnonzero(idx == a)[0]
+        if not p.block_strands[cid]:
+            idx = idx[::-1]
+        rows.append(np.full(len(idx), n))
+        bidx.append(idx)
+    rows, bidx = np.concatenate(rows), np.concatenate(bidx)
+    ends = np.cumsum(Ls[bidx])
+    # restart the cumulative sum at the beginning of each path
+    first = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    offset = ends[first] - Ls[bidx[first]]
+    ends = ends - np.repeat(offset, np.diff(np.r_[first, len(rows)]))
+    return rows, ends - Ls[bidx], ends, bidx
+
+
+def merge_segments(rows, x0, x1, col, px=0):
+    """level of detail: consecutive segments on the same row that fall within
+    the same pixel (of width px in data units) are merged into a single
+    segment, with the color of the longest of them. Consecutive segments with
+    the same color are then joined. Colors are given as an integer color id
+    per segment."""
+    if px > 0:
+        p0, p1 = np.floor(x0 / px), np.floor(x1 / px)
+        # sub-pixel segments are labeled by (row, pixel), the others by -1
+        key = np.where(p0 == p1, rows * (p1.max() + 1) + p0, -1)
+        new_group = np.r_[True, (key[1:] != key[:-1]) | (key[1:] < 0)]
+        g = np.cumsum(new_group) - 1
+        # index of the longest segment in each group
+        longest = np.lexsort((x0 - x1, g))[np.flatnonzero(new_group)]
+        first = np.flatnonzero(new_group)
+        last = np.r_[first[1:], len(rows)] - 1
+        rows, x0, x1, col = rows[first], x0[first], x1[last], col[longest]
+    # join adjacent segments with the same color
+    new_seg = np.r_[True, (rows[1:] != rows[:-1]) | (col[1:] != col[:-1])]
+    first = np.flatnonzero(new_seg)
+    last = np.r_[first[1:], len(rows)] - 1
+    return rows[first], x0[first], x1[last], col[first]
+
+
+def plot_paths(
+    pan, paths_order, leaves_colors, core_anchor, fig_savename, lod=True, dpi=300
+):
     """given a pangraph, a path order, a dictionary of leaves colors and a core
     block to be used as an anchor, plots all of the paths in a linear representation,
-    assigning colors to blocks occurring multiple times."""
+    assigning colors to blocks occurring multiple times. All blocks are drawn
+    as a single collection of segments. If `lod` is True, blocks that are
+    smaller than a pixel are merged."""
 
     # dictionary of block lengths
-    df = pan.to_blockstats_df().sort_values("count", ascending=False)
-    Ls = df["len"].to_dict()
+    bdf = pan.to_blockstats_df()
+    df = bdf.sort_values("count", ascending=False)
 
     # generate colors for blocks
     def __color_generator():
@@ -106,7 +196,8 @@ def plot_paths(pan, paths_order, leaves_colors, core_anchor, fig_savename):
         colors.pop(15)  # remove light gray
         i = 0
         while True:
-            yield colors[i]
+            # cycle through colors if there are many repeated blocks
+            yield colors[i % len(colors)]
             i += 1
 
     cg = __color_generator()
@@ -114,17 +205,29 @@ def plot_paths(pan, paths_order, leaves_colors, core_anchor, fig_savename):
         b: next(cg) if df["count"][b] > 1 else "lightgray" for b in df.index
     }
 
+    # segments for all block occurrences, with a color id per segment, so that
+    # adjacent blocks with the same color (e.g. singletons) can be joined
+    Ls = bdf["len"].to_numpy()
+    rows, x0, x1, bidx = path_segments(pan, paths_order, core_anchor, Ls)
+    rgba = mpl.colors.to_rgba_array([block_colors[b] for b in bdf.index])
+    palette, block_cid = np.unique(rgba, axis=0, return_inverse=True)
+    cid = block_cid.reshape(-1)[bidx]
+
     fig, ax = plt.subplots(1, 1, figsize=(12, 7))
+
+    # size of a pixel in data units in the saved figure
+    px = 0
+    if lod:
+        width_px = ax.get_position().width * fig.get_figwidth() * dpi
+        px = x1.max() / width_px
+    rows, x0, x1, cid = merge_segments(rows, x0, x1, cid, px)
+
+    segs = np.stack([x0, rows, x1, rows], axis=1).reshape(-1, 2, 2)
+    lc = LineCollection(segs, colors=palette[cid], linewidths=5, capstyle="projecting")
+    ax.add_collection(lc)
+    ax.autoscale_view()
+
     for n, p_name in enumerate(paths_order):
-        p = pan.paths[p_name]
-        l = 0
-        cid = list(p.block_ids).index(core_anchor)
-        s = p.block_strands[cid]
-        bids = list(p.block_ids) if s else list(reversed(p.block_ids))
-        for b in bids:
-            lb = Ls[b]
-            plt.plot([l, l + lb], [n, n], color=block_colors[b], lw=5)
-            l += lb
         # add isolate name, with color extracted from leaves_colors
         strain = p_name.split("-")[0]
         plt.text(
@@ -140,18 +243,17 @@ def plot_paths(pan, paths_order, leaves_colors, core_anchor, fig_savename):
     for sp in ["top", "right", "left"]:
         ax.spines[sp].set_visible(False)
     plt.tight_layout()
-    plt.savefig(fig_savename, dpi=300)
+    plt.savefig(fig_savename, dpi=dpi)
     plt.close(fig)
 
     return block_colors
 
 
-def plot_shared_length_matrix(df, path_order, leaves_colors, fig_savename):
+def plot_shared_length_matrix(S, path_order, leaves_colors, fig_savename):
     """Plots the matrix of pairwise shared path length"""
 
     # create matrix with entries in selected order
-    M = df.pivot(index="p1", columns="p2", values="shared_L")
-    M = M.loc[path_order, path_order].to_numpy() / 1000
+    M = S.loc[path_order, path_order].to_numpy() / 1000
 
     N = M.shape[0]
 
@@ -183,12 +285,64 @@ def plot_shared_length_matrix(df, path_order, leaves_colors, fig_savename):
     plt.close(fig)
 
 
+def pooled_shared_length_matrix(
+    S, names, path_order, leaves_colors, fig_savename, size, how
+):
+    """Plots a downsampled version of the matrix of pairwise shared path length,
+    for a large number of paths. The matrix is pooled over bins of paths in the
+    clustering order, and per-path labels are replaced by a bar colored
+    according to the isolate colors, aggregating runs of equal color."""
+
+    row = {n: i for i, n in enumerate(names)}
+    order = [row[n] for n in path_order]
+    N = len(order)
+    M, _ = pooled_matrix(S, order, size, how=how)
+
+    # runs of consecutive paths with the same color
+    colors = [leaves_colors[p.split("-")[0]] for p in path_order]
+    start = [0] + [i for i in range(1, N) if colors[i] != colors[i - 1]]
+    end = start[1:] + [N]
+
+    # plot the matrix in path coordinates
+    fig, ax = plt.subplots(1, 1, figsize=(7, 4))
+    g = ax.matshow(M / 1000, extent=(-0.5, N - 0.5, N - 0.5, -0.5))
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.vlines(
+        [-0.02 * N] * len(start),
+        np.array(start) - 0.5,
+        np.array(end) - 0.5,
+        colors=[colors[i] for i in start],
+        lw=5,
+        clip_on=False,
+    )
+
+    for sp in ["top", "right", "left", "bottom"]:
+        ax.spines[sp].set_visible(False)
+    plt.colorbar(g, ax=ax, fraction=0.046, pad=0.04, label="shared length (kbp)")
+    plt.tight_layout()
+    plt.savefig(fig_savename, dpi=300)
+    plt.close(fig)
+
+
 if __name__ == "__main__":
 
     args = parse_args()
+    prof = Profiler(
+        inputs=[args.pangraph, cache_dir(args.pangraph), args.leaves_colors],
+        outputs=[
+            args.shared_len_mat,
+            args.shared_len_df,
+            args.anchor_tensor,
+            args.block_colors,
+            args.fig_paths,
+            args.fig_matrix,
+        ],
+    )
 
-    # load pangraph
-    pan = pp.Pangraph.load_json(args.pangraph)
+    # load pangraph (from its binary cache)
+    prof.stage("load")
+    pan = load_pangraph(args.pangraph)
 
     # block stats dataframe
     bdf = pan.to_blockstats_df()
@@ -197,32 +351,95 @@ if __name__ == "__main__":
     anchor = args.anchor_block
     assert bdf["core"][anchor], "the anchor block must be core"
 
-    # diciotnary of block lengths
-    Ls = bdf["len"].to_dict()
-
-    # evaluate pairwise shared length from anchor block for all path pairs
-    shared_L_df = []
-    for p1, p2 in product(pan.paths, repeat=2):
-        shared_L = shared_path_from_anchor(p1, p2, Ls, anchor)
-        shared_L_df.append([p1.name, p2.name, shared_L])
-    shared_L_df = pd.DataFrame(shared_L_df, columns=["p1", "p2", "shared_L"])
-
-    # save shared length dataframe
-    shared_L_df.to_csv(args.shared_len_df, index=False)
+    # vector of block lengths, in the same order as block indices
+    Ls = bdf["len"].to_numpy()
+
+    # paths encoded as arrays of block indices and strands
+    enc_paths = [(p.block_idx, p.block_strands) for p in pan.paths]
+
+    # build the longest-common-extension index of the anchor-oriented paths.
+    # Identical paths are collapsed, and shared lengths are only evaluated
+    # between distinct paths.
+    prof.stage("compute")
+    sp_index = AnchorSharedPaths(enc_paths, pan.block_idx[anchor], Ls)
+    print(f"{sp_index.U} distinct anchor-oriented paths out of {sp_index.N}")
+
+    # in incremental mode, only the rows of new or changed paths are evaluated
+    # and the rest is copied from the previous result
+    names = [p.name for p in pan.paths]
+    rows = None
+    if args.incremental is not None:
+        fps = path_fingerprints(pan)
+        params = {"anchor": anchor}
+        plan = incremental_plan(load_state(args.incremental), names, fps, params)
+        if plan is not None:
+            src, rows = plan
+            print(f"incremental update: {len(rows)} of {len(names)} paths evaluated")
+
+    # evaluate pairwise shared length from anchor block for all path pairs,
+    # and save it in a memory-mapped matrix
+    S = create_matrix(args.shared_len_mat, names)
+    if rows is not None:
+        copy_from_state(args.incremental, S, src)
+    sp_index.shared_length_matrix(out=S, threads=args.threads, rows=rows)
+    S.flush()
+    if args.incremental is not None:
+        save_state(args.incremental, args.shared_len_mat, names, fps, params)
+
+    # optionally, shared length from multiple anchors. Paths are encoded once
+    # for all anchors, and the result is saved in a memory-mapped tensor
+    if args.anchor_tensor is not None:
+        anchors = select_anchors(bdf, args.anchors, args.max_core_anchors, args.seed)
+        ma_index = MultiAnchorSharedPaths(enc_paths, Ls)
+        T = create_pair_tensor(args.anchor_tensor, anchors, names)
+        anchor_idx = [pan.block_idx[a] for a in anchors]
+        ma_index.shared_length_tensor(anchor_idx, out=T, threads=args.threads)
+        T.flush()
+
+    # optionally export shared length dataframe
+    if args.shared_len_df is not None:
+        prof.stage("write")
+        export_csv(args.shared_len_mat, args.shared_len_df, "shared_L", as_int=True)
 
     # perform hierarchical clustering and find optial path order
-    path_order = hierarchical_clustering_order(shared_L_df)
+    prof.stage("cluster")
+    path_order = hierarchical_clustering_order(
+        S,
+        names,
+        method=args.linkage_method,
+        max_exact=args.max_exact,
+        n_landmarks=args.n_landmarks,
+        optimal_ordering=args.optimal_ordering,
+        max_optimal=args.max_optimal,
+    )
 
     # load leaves colors
     leaves_colors = pd.read_csv(args.leaves_colors, index_col=0)["color"].to_dict()
 
     # plot paths in linear representation
-    block_colors = plot_paths(pan, path_order, leaves_colors, anchor, args.fig_paths)
+    prof.stage("plot")
+    block_colors = plot_paths(
+        pan, path_order, leaves_colors, anchor, args.fig_paths, lod=not args.no_lod
+    )
 
     # plot shared length matrix
-    plot_shared_length_matrix(shared_L_df, path_order, leaves_colors, args.fig_matrix)
+    if len(names) > args.max_matrix_size:
+        pooled_shared_length_matrix(
+            S,
+            names,
+            path_order,
+            leaves_colors,
+            args.fig_matrix,
+            args.max_matrix_size,
+            args.pool,
+        )
+    else:
+        S = pd.DataFrame(S, index=names, columns=names)
+        plot_shared_length_matrix(S, path_order, leaves_colors, args.fig_matrix)
 
     # save block colors
     hex_colors = {k: mpl.colors.to_hex(v) for k, v in block_colors.items()}
     hex_colors = pd.Series(hex_colors, name="Colour")
     hex_colors.to_csv(args.block_colors, index_label="Name")
+
+    prof.save()
@@ -0,0 +1,118 @@
+# Utilities to order the paths of a pangraph by hierarchical clustering of a
+# similarity matrix of shared lengths S. The similarity of two paths is
+# normalized by the minimum of their self-similarities (diagonal elements), and
+# transformed into a distance d_ij = 1 - S_ij / min(S_ii, S_jj).
+#
+# The normalization is evaluated in blocks of rows, directly into the condensed
+# distance vector used by scipy, so that no dense N x N copy of the matrix is
+# created (the matrix can be memory-mapped). For very large N, when even the
+# condensed vector would not fit in memory, an approximate ordering is
+# obtained by clustering a random subset of landmark paths and placing every
+# other path next to its closest landmark. The number of landmarks is bounded
+# independently of N, so that the approximation stays cheap.
+
+import numpy as np
+import scipy.cluster.hierarchy as spc
+
+
+def self_similarity(S):
+    """vector of diagonal elements of the similarity matrix"""
+    return np.array(np.diagonal(S), dtype=float)
+
+
+def normalized_distance(S_block, diag_rows, diag_cols):
+    """distance 1 - S_ij / min(S_ii, S_jj) for a block of the matrix, given the
+    diagonal elements corresponding to its rows and columns"""
+    norm = np.minimum(diag_rows[:, None], diag_cols[None, :])
+    return 1.0 - np.asarray(S_block, dtype=float) / norm
+
+
+def condensed_distance(S, block_size=1024):
+    """returns the condensed distance vector (upper triangle, row-major, as in
+    `scipy.spatial.distance.pdist`) of the normalized similarity matrix S. The
+    matrix is read in blocks of rows."""
+    N = S.shape[0]
+    diag = self_similarity(S)
+    y = np.empty(N * (N - 1) // 2, dtype=float)
+    for i0 in range(0, N, block_size):
+        i1 = min(i0 + block_size, N)
+        # only columns j > i0 are needed for the upper triangle
+        D = normalized_distance(S[i0:i1, i0:], diag[i0:i1], diag[i0:])
+        for i in range(i0, i1):
+            # start of row i in the condensed vector
+            k = i * N - i * (i + 1) // 2
+            y[k : k + N - i - 1] = D[i - i0, i - i0 + 1 :]
+    # remove negative values due to rounding
+    np.clip(y, 0, None, out=y)
+    return y
+
+
+def exact_order(S, method="complete", optimal_ordering=False):
+    """order of the leaves of the hierarchical clustering of the normalized
+    similarity matrix. Scipy uses the nearest-neighbor-chain algorithm for the
+    complete, average, weighted and ward methods, with O(N^2) time and memory
+    for the condensed vector. If `optimal_ordering` is True the leaves are
+    reordered to minimize the distance between successive leaves."""
+    if S.shape[0] < 2:
+        return np.arange(S.shape[0])
+    y = condensed_distance(S)
+    Z = spc.linkage(y, method=method)
+    if optimal_ordering:
+        Z = spc.optimal_leaf_ordering(Z, y)
+    return spc.leaves_list(Z)
+
+
+def approximate_order(
+    S, n_landmarks, method="complete", optimal_ordering=False, block_size=1024, seed=0
+):
+    """approximate clustering order for large matrices. A random subset of
+    landmark paths is ordered by exact hierarchical clustering. Every other
+    path is then assigned to its closest landmark, and paths are ordered by
+    landmark and by increasing distance from it. Memory scales as
+    O(n_landmarks^2 + N)."""
+    N = S.shape[0]
+    rng = np.random.default_rng(seed)
+    lm = np.sort(rng.choice(N, size=n_landmarks, replace=False))
+    diag = self_similarity(S)
+
+    # order of landmarks
+    lm_order = exact_order(S[np.ix_(lm, lm)], method, optimal_ordering)
+    lm_rank = np.empty(n_landmarks, dtype=int)
+    lm_rank[lm_order] = np.arange(n_landmarks)
+
+    # closest landmark for each path, evaluated in blocks of rows
+    closest = np.empty(N, dtype=int)
+    dist = np.empty(N, dtype=float)
+    for i0 in range(0, N, block_size):
+        i1 = min(i0 + block_size, N)
+        D = normalized_distance(S[i0:i1][:, lm], diag[i0:i1], diag[lm])
+        closest[i0:i1] = np.argmin(D, axis=1)
+        dist[i0:i1] = D[np.arange(i1 - i0), closest[i0:i1]]
+
+    # sort by landmark rank, then by distance to the landmark
+    return np.lexsort((dist, lm_rank[closest]))
+
+
+def clustering_order(
+    S,
+    method="complete",
+    max_exact=10000,
+    optimal_ordering=False,
+    max_optimal=2000,
+    n_landmarks=2000,
+):
+    """returns the indices of the rows of the similarity matrix S, ordered
+    according to hierarchical clustering. Exact clustering is used for up to
+    `max_exact` rows, and above this size the landmark approximation with (at
+    most) `n_landmarks` landmarks. The optimal leaf ordering, which requires
+    O(N^2) memory and O(N^3) time, is applied only to at most `max_optimal`
+    leaves (landmarks included)."""
+    N = S.shape[0]
+    exact = N <= max_exact
+    n = N if exact else min(n_landmarks, max_exact)
+    if optimal_ordering and n > max_optimal:
+        print(f"warning: optimal leaf ordering skipped for {n} > {max_optimal} leaves")
+        optimal_ordering = False
+    if exact:
+        return exact_order(S, method, optimal_ordering)
+    return approximate_order(S, n, method, optimal_ordering)
@@ -0,0 +1,161 @@
+# Download genbank files for a list of accession numbers, with a bounded number
+# of concurrent requests over a pooled http session. Failed requests are
+# retried with exponential backoff.
+#
+# Downloaded files are stored in a content-addressed cache shared across
+# checkouts: the content is saved in `objects/<hash[:2]>/<hash>` (sha256) and
+# `refs/<acc>` contains the hash of the file for a given accession. Accessions
+# that are already in the cache are never downloaded again. The endpoint is a
+# url template containing `{acc}`, so that it can be pointed to a local server.
+
+import argparse
+import hashlib
+import os
+import pathlib
+import shutil
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+from profiling import Profiler
+
+NCBI_ENDPOINT = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=nuccore&id={acc}&rettype=gbwithparts&retmode=text"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="download genbank files, using a content-addressed cache"
+    )
+    parser.add_argument("--acc", type=str, nargs="*", default=[], help="accessions")
+    parser.add_argument("--acc_list", type=str, help="file with list of accessions")
+    parser.add_argument("--out_dir", type=str, required=True, help="output folder")
+    parser.add_argument("--cache_dir", type=str, required=True, help="cache folder")
+    parser.add_argument("--endpoint", type=str, default=NCBI_ENDPOINT)
+    parser.add_argument("--threads", type=int, default=3, help="max n. of requests")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--backoff", type=float, default=1.0, help="base delay (s)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout (s)")
+    args = parser.parse_args()
+    if args.retries < 0:
+        parser.error("--retries must be non-negative")
+    return args
+
+
+class GenbankCache:
+    """Content-addressed cache of downloaded genbank files"""
+
+    def __init__(self, cache_dir):
+        self.root = pathlib.Path(cache_dir).expanduser()
+        (self.root / "objects").mkdir(parents=True, exist_ok=True)
+        (self.root / "refs").mkdir(parents=True, exist_ok=True)
+
+    def object_path(self, digest):
+        return self.root / "objects" / digest[:2] / digest
+
+    def lookup(self, acc):
+        """path of the cached file for an accession, or None if absent"""
+        ref = self.root / "refs" / acc
+        if not ref.exists():
+            return None
+        obj = self.object_path(ref.read_text().strip())
+        return obj if obj.exists() else None
+
+    def store(self, acc, content):
+        """store the content of a file and register it for the accession"""
+        digest = hashlib.sha256(content).hexdigest()
+        obj = self.object_path(digest)
+        if not obj.exists():
+            obj.parent.mkdir(exist_ok=True)
+            atomic_write(obj, content)
+        atomic_write(self.root / "refs" / acc, digest.encode())
+        return obj
+
+
+def atomic_write(fname, content):
+    """write a file through a temporary file, so that it is never incomplete"""
+    tmp = fname.with_name(f"{fname.name}.tmp-{os.getpid()}-{time.monotonic_ns()}")
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, fname)
+
+
+def fetch(session, url, retries, backoff, timeout):
+    """download the content of a url, retrying with exponential backoff on
+    connection errors, server errors and rate limiting"""
+    if retries < 0:
+        raise ValueError("the number of retries must be non-negative")
+    for attempt in range(retries + 1):
+        try:
+            r = session.get(url, timeout=timeout)
+            if r.status_code == 200:
+                if not r.content.startswith(b"LOCUS"):
+                    raise ValueError(f"invalid genbank file from {url}")
+                return r.content
+            if r.status_code != 429 and r.status_code < 500:
+                r.raise_for_status()
+            error = requests.HTTPError(f"status {r.status_code} for {url}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt)
+    raise error
+
+
+def download(accs, out_dir, cache, endpoint, threads, retries, backoff, timeout):
+    """download the genbank files for a list of accessions, skipping those
+    already present in the cache, and place them in the output folder. Repeated
+    accessions are downloaded once."""
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # connection pool shared by all workers
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=threads)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def __get(acc):
+        obj = cache.lookup(acc)
+        if obj is None:
+            url = endpoint.format(acc=acc)
+            obj = cache.store(acc, fetch(session, url, retries, backoff, timeout))
+            print(f"downloaded {acc}")
+        # copy from the cache to the output folder
+        out = out_dir / f"{acc}.gbk"
+        tmp = out.with_name(f"{out.name}.tmp-{os.getpid()}-{threading.get_ident()}")
+        shutil.copyfile(obj, tmp)
+        os.replace(tmp, out)
+
+    with session, ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(__get, dict.fromkeys(accs)))
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    # list of accession numbers
+    accs = list(args.acc)
+    if args.acc_list is not None:
+        with open(args.acc_list, "r") as f:
+            accs += [l.strip() for l in f if l.strip()]
+
+    accs = list(dict.fromkeys(accs))
+    out_files = [pathlib.Path(args.out_dir) / f"{acc}.gbk" for acc in accs]
+    prof = Profiler(outputs=out_files)
+    prof.stage("download")
+
+    cache = GenbankCache(args.cache_dir)
+    download(
+        accs,
+        args.out_dir,
+        cache,
+        args.endpoint,
+        args.threads,
+        args.retries,
+        args.backoff,
+        args.timeout,
+    )
+
+    prof.save()
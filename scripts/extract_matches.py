@@ -1,69 +1,123 @@
 # script to extract sequences from a fasta file around matches identified by a
-# paf file
+# paf file. Several window sizes can be extracted in a single pass over the
+# genomes. Hits are grouped by the name of the sequence they were mapped to
+# (e.g. the resistance gene), so that several genes can be processed at once.
 
 import argparse
 import pathlib
+from collections import defaultdict
 from Bio import SeqIO
+from Bio.Seq import Seq
+
+from fasta_index import FastaIndex
+from profiling import Profiler
 
 parser = argparse.ArgumentParser(
     description="Extract sequences from a fasta file around matches identified by a paf file"
 )
 parser.add_argument("--in_fa", type=str, nargs="+", help="input fasta file(s)")
 parser.add_argument("--paf", help="paf file")
-parser.add_argument("--out", help="output fasta file")
+parser.add_argument(
+    "--out",
+    nargs="+",
+    help="""output fasta file, or one file per window size (in the same order
+    as --window). It can contain the placeholders {window} and {query}, which
+    are replaced by the window size and by the name of the sequence to which
+    genomes are mapped. With a single file, {window} is required if more than
+    one window is requested. Without {query} hits from all sequences are saved
+    in the same file.""",
+)
 parser.add_argument(
     "-l", "--length", type=int, default=10, help="minimum length of matches"
 )
 parser.add_argument(
-    "-w", "--window", type=int, default=0, help="window size around matches"
+    "-w",
+    "--window",
+    type=int,
+    nargs="+",
+    default=[0],
+    help="window size(s) around matches",
 )
 
 args = parser.parse_args()
+prof = Profiler(inputs=args.in_fa + [args.paf])
 
-# read paf file
+windows = args.window
+if len(args.out) == 1:
+    if len(windows) > 1 and "{window}" not in args.out[0]:
+        parser.error("--out must contain {window} when multiple windows are requested")
+    out_templates = {w: args.out[0] for w in windows}
+elif len(args.out) == len(windows):
+    out_templates = dict(zip(windows, args.out))
+else:
+    parser.error("--out must be a single file or one file per window size")
+split_query = any("{query}" in o for o in args.out)
+
+# read and filter paf file, streaming line by line. Hits are grouped by
+# sequence id
+prof.stage("load")
+pafs = defaultdict(list)
 with open(args.paf, "r") as f:
-    paf_lines = f.readlines()
+    for n_paf, paf in enumerate(f):
+        paf = paf.strip().split("\t")
+        seq_id = paf[0]
+        match_len = int(paf[10])
+        if match_len >= args.length:
+            pafs[seq_id].append(
+                {
+                    "seq_id": seq_id,
+                    "match_id": n_paf,
+                    "match_len": match_len,
+                    "start": int(paf[2]),
+                    "end": int(paf[3]),
+                    "L": int(paf[1]),
+                    "query": paf[5],
+                }
+            )
+
+# input fasta files, indexed by file name
+fa_files = {pathlib.Path(in_file).stem: in_file for in_file in args.in_fa}
 
-# filter paf file
-pafs = []
-for n_paf, paf in enumerate(paf_lines):
-    paf = paf.strip().split("\t")
-    seq_id = paf[0]
-    match_len = int(paf[10])
-    if match_len >= args.length:
-        pafs.append(
-            {
-                "seq_id": seq_id,
-                "match_id": n_paf,
-                "match_len": match_len,
-                "start": int(paf[2]),
-                "end": int(paf[3]),
-                "L": int(paf[1]),
-            }
-        )
+# extract relevant part of the fasta files. Only genomes with at least one
+# hit are opened. For each hit the largest window is read once from disk, and
+# smaller windows are extracted from it.
+prof.stage("compute")
+W = max(windows)
+records = defaultdict(list)
+for sid, hits in pafs.items():
+    with FastaIndex(fa_files[sid]) as fa:
+        # the fasta file is expected to contain a single record
+        assert len(fa.names) == 1, f"{fa_files[sid]} must contain a single record"
+        rec_name = fa.names[0]
+        for paf in hits:
+            L = paf["L"]
+            b, e = paf["start"], paf["end"]
+            B_max = max(b - W, 0)
+            seq_max = fa.fetch(rec_name, B_max, min(e + W, L))
+            query = paf["query"] if split_query else None
+            for w in windows:
+                B, E = b - w, e + w
+                if B < 0:
+                    B = 0
+                if E > L:
+                    E = L
+                seq = Seq(seq_max[B - B_max : E - B_max])
+                rec = SeqIO.SeqRecord(seq, id=f"{sid}-[{b}:{e}]", description="")
+                records[(query, w)].append((paf["match_id"], rec))
 
-# read input fasta files
-fa_in = {}
-for in_file in args.in_fa:
-    seq = SeqIO.read(in_file, format="fasta").seq
-    fa_in[pathlib.Path(in_file).stem] = seq
+# output files: one per window size and (optionally) query sequence
+prof.stage("write")
+out_files = []
+queries = {q for q, _ in records} if split_query else {None}
+for query in sorted(queries, key=str):
+    for w in windows:
+        # restore the order of the paf file
+        recs = [rec for _, rec in sorted(records[(query, w)], key=lambda x: x[0])]
 
-# extract relevant part of the fasta file
-records = []
-for paf in pafs:
-    sid = paf["seq_id"]
-    nid = paf["match_id"]
-    L = paf["L"]
-    b, e = paf["start"], paf["end"]
-    B, E = b - args.window, e + args.window
-    if B < 0:
-        B = 0
-    if E > L:
-        E = L
-    seq = fa_in[sid]
-    rec = SeqIO.SeqRecord(seq[B:E], id=f"{sid}-[{b}:{e}]", description="")
-    records.append(rec)
+        # write output fasta file
+        out = out_templates[w].format(window=w, query=query)
+        out_files.append(out)
+        with open(out, "w") as f:
+            SeqIO.write(recs, f, format="fasta")
 
-# write output fasta file
-with open(args.out, "w") as f:
-    SeqIO.write(records, f, format="fasta")
+prof.save(outputs=out_files)
@@ -0,0 +1,106 @@
+# Indexed access to fasta files. The index has the same format as the `.fai`
+# files produced by `samtools faidx` (name, length, offset, line bases, line
+# width), it is built once by streaming over the file and cached next to it.
+# Sub-sequences are then read from a memory-mapped view of the file, without
+# loading the full sequence in memory.
+
+import mmap
+import os
+import pathlib
+
+
+def fai_file(fa_file):
+    """name of the index file of a fasta file"""
+    return pathlib.Path(str(fa_file) + ".fai")
+
+
+def build_fai(fa_file):
+    """streams over a fasta file and returns the list of index entries
+    (name, length, offset, line bases, line width) for each record. Raises an
+    error if the lines of a record do not have a uniform width."""
+    entries = []
+    offset = 0
+    with open(fa_file, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                name = line[1:].split()[0].decode()
+                entries.append([name, 0, offset + len(line), 0, 0])
+                short_line = False
+            elif len(entries) > 0:
+                bases = len(line.rstrip(b"\r\n"))
+                e = entries[-1]
+                if bases > 0:
+                    # only the last line of a record can be shorter
+                    if e[3] == 0:
+                        e[3], e[4] = bases, len(line)
+                    elif short_line or bases > e[3]:
+                        raise ValueError(f"non-uniform line length in {fa_file}")
+                    short_line = bases < e[3]
+                    e[1] += bases
+            offset += len(line)
+    return [tuple(e) for e in entries]
+
+
+def load_fai(fa_file):
+    """loads the index of a fasta file. The index is built and saved if it does
+    not exist or is older than the fasta file."""
+    fai = fai_file(fa_file)
+    if not fai.exists() or os.path.getmtime(fai) < os.path.getmtime(fa_file):
+        entries = build_fai(fa_file)
+        tmp = fai.with_name(f"{fai.name}.tmp-{os.getpid()}")
+        with open(tmp, "w") as f:
+            for e in entries:
+                f.write("\t".join(str(x) for x in e) + "\n")
+        os.replace(tmp, fai)
+        return entries
+    with open(fai, "r") as f:
+        entries = [l.split("\t") for l in f.read().splitlines()]
+    return [(n, int(L), int(o), int(lb), int(lw)) for n, L, o, lb, lw in entries]
+
+
+class FastaIndex:
+    """Indexed fasta file. Records are accessed by name with `fetch`, which
+    reads only the requested interval from the memory-mapped file."""
+
+    def __init__(self, fa_file):
+        self.fa_file = fa_file
+        entries = load_fai(fa_file)
+        self.names = [e[0] for e in entries]
+        self.entries = {e[0]: e[1:] for e in entries}
+        self._file = None
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap, self._file = None, None
+
+    def length(self, name):
+        """length of a record"""
+        return self.entries[name][0]
+
+    def _byte_offset(self, name, pos):
+        L, offset, lb, lw = self.entries[name]
+        return offset + (pos // lb) * lw + pos % lb
+
+    def fetch(self, name, start, end):
+        """returns the sequence of record `name` in the interval [start, end)
+        (0-based, end excluded), as a string"""
+        L = self.entries[name][0]
+        start, end = max(start, 0), min(end, L)
+        if end <= start:
+            return ""
+        if self._mmap is None:
+            self._file = open(self.fa_file, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        b = self._byte_offset(name, start)
+        e = self._byte_offset(name, end - 1) + 1
+        raw = self._mmap[b:e]
+        return raw.replace(b"\n", b"").replace(b"\r", b"").decode()
@@ -1,44 +1,59 @@
 # This script convers a genbank file to a fasta file. Only the record with the longes
 # sequence is saved. The fasta record id is the same as the genbank filename.
 # The script checks that the original sequence id is compatible with this name.
+#
+# Records are parsed one at a time without features, keeping in memory only the
+# longest one. Input and output files can be gzip-compressed (.gz extension).
+# In batch mode (--gbk_dir / --fa_dir) a whole directory or list of accession
+# numbers is converted in a single process, using a pool of workers.
 
 from Bio import SeqIO
+from Bio.GenBank.Scanner import GenBankScanner
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import gzip
+import pathlib
 import re
-import numpy as np
+
+from profiling import Profiler
 
 
 def accnum(fname):
     """Extract the .gbk file name without extension"""
-    p = re.compile("/?([^/]+)\.gbk$")
-    return re.search(p, fname).groups()[0]
+    p = re.compile(r"/?([^/]+)\.gbk(\.gz)?$")
+    return re.search(p, str(fname)).groups()[0]
 
 
-if __name__ == "__main__":
+def open_file(fname, mode):
+    """open a text file, transparently handling gzip compression"""
+    if str(fname).endswith(".gz"):
+        return gzip.open(fname, mode + "t")
+    return open(fname, mode)
 
-    # parse arguments
-    parser = argparse.ArgumentParser(
-        description="convert a genbank file to a fasta file. Only the record with the longes sequence is saved."
-    )
-    parser.add_argument("--gbk", help="input genbank file.", type=str)
-    parser.add_argument("--fa", help="output fasta file.", type=str)
-    args = parser.parse_args()
 
-    # read reacords in the input genbank file
-    records = list(SeqIO.parse(args.gbk, "genbank"))
+def longest_record(gbk):
+    """streams over the records of a genbank file, skipping feature parsing, and
+    returns the record with the longest sequence and the number of records"""
+    best, NR = None, 0
+    with open_file(gbk, "r") as f:
+        for r in GenBankScanner().parse_records(f, do_features=False):
+            NR += 1
+            if best is None or len(r.seq) > len(best.seq):
+                best = r
+    return best, NR
+
+
+def gbk_to_fa(gbk, fa):
+    """convert a genbank file to a fasta file, keeping only the longest record"""
 
     # pick the longest record
-    idx = 0
-    NR = len(records)
+    r, NR = longest_record(gbk)
     if NR > 1:
         print(f"{NR} records found. Picking the longest.")
-        Ls = [len(r.seq) for r in records]
-        idx = np.argmax(Ls)
-        print(f"Picked record {records[idx].id} with length {Ls[idx]//1000} kbp")
-    r = records[idx]
+        print(f"Picked record {r.id} with length {len(r.seq)//1000} kbp")
 
     # check that id of the read is compatible with filename
-    acc = accnum(args.gbk)
+    acc = accnum(gbk)
     assert r.id.startswith(acc), f"read id {r.id} and filename {acc} are incompatible."
 
     # use only name of the file as id of the read
@@ -47,4 +62,66 @@ if __name__ == "__main__":
     r.description = ""
 
     # write the fasta file
-    SeqIO.write([r], args.fa, "fasta")
+    with open_file(fa, "w") as f:
+        SeqIO.write([r], f, "fasta")
+
+
+def batch_files(gbk_dir, fa_dir, acc_list=None, compress=False):
+    """list of (genbank, fasta) file pairs to convert in batch mode. If a file
+    with a list of accession numbers is given, only these are converted."""
+    gbk_dir, fa_dir = pathlib.Path(gbk_dir), pathlib.Path(fa_dir)
+    if acc_list is not None:
+        with open(acc_list, "r") as f:
+            accs = [l.strip() for l in f if l.strip()]
+        gbks = []
+        for acc in accs:
+            gbk = gbk_dir / f"{acc}.gbk"
+            gbks.append(gbk if gbk.exists() else gbk_dir / f"{acc}.gbk.gz")
+    else:
+        gbks = sorted(list(gbk_dir.glob("*.gbk")) + list(gbk_dir.glob("*.gbk.gz")))
+    ext = ".fa.gz" if compress else ".fa"
+    return [(gbk, fa_dir / f"{accnum(gbk)}{ext}") for gbk in gbks]
+
+
+def __convert_pair(pair):
+    gbk_to_fa(*pair)
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    parser = argparse.ArgumentParser(
+        description="convert a genbank file to a fasta file. Only the record with the longes sequence is saved."
+    )
+    parser.add_argument("--gbk", help="input genbank file.", type=str)
+    parser.add_argument("--fa", help="output fasta file.", type=str)
+    parser.add_argument("--gbk_dir", help="batch mode: input genbank folder.", type=str)
+    parser.add_argument("--fa_dir", help="batch mode: output fasta folder.", type=str)
+    parser.add_argument(
+        "--acc_list",
+        help="batch mode: optional file with the list of accession numbers.",
+        type=str,
+    )
+    parser.add_argument(
+        "--compress", help="batch mode: gzip output files.", action="store_true"
+    )
+    parser.add_argument(
+        "--threads", help="batch mode: n. of worker processes.", type=int, default=1
+    )
+    args = parser.parse_args()
+
+    if args.gbk_dir is None:
+        # single file conversion
+        prof = Profiler(inputs=[args.gbk], outputs=[args.fa])
+        prof.stage("compute")
+        gbk_to_fa(args.gbk, args.fa)
+    else:
+        # batch conversion
+        pairs = batch_files(args.gbk_dir, args.fa_dir, args.acc_list, args.compress)
+        prof = Profiler(inputs=[g for g, _ in pairs], outputs=[f for _, f in pairs])
+        prof.stage("compute")
+        pathlib.Path(args.fa_dir).mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor(max_workers=args.threads) as executor:
+            list(executor.map(__convert_pair, pairs))
+
+    prof.save()
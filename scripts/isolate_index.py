@@ -0,0 +1,361 @@
+# Persistent nearest-neighbor index over the block content of isolates, for the
+# private sequence distance d(A, B) = L(A) + L(B) - 2 L(A & B), where L is the
+# total length of a set of blocks.
+#
+# The index is an inverted list block -> isolates. For each block only the
+# shorter of the two lists is stored: the isolates in which the block is present
+# (rare blocks) or the isolates from which it is absent (frequent blocks, e.g.
+# core blocks). For a query path Q, the distance to an isolate X is
+#
+#     d(Q, X) = L(Q) + L(X) - 2 C + delta(X)
+#
+# where C is the total length of the frequent blocks of Q, and delta collects
+# the corrections from the lists of the blocks of Q: -2 L(b) if X contains a
+# rare block b, +2 L(b) if X lacks a frequent block b. Only isolates appearing
+# in these lists are visited: all other isolates have delta = 0, and among them
+# the closest are the ones with the smallest L(X), kept in sorted order. Queries
+# are exact, and their cost scales with the size of the lists of the query
+# blocks, not with the number of isolates.
+#
+# New isolates are inserted incrementally, and the index is saved as a directory
+# of .npy columns. Blocks are identified by their id, which must be consistent
+# between the indexed and the query graphs. Block ids are assigned at random by
+# `pangraph build`, so a graph built separately shares no block with the index,
+# and all distances would be d = L(Q) + L(X). The signature of the block-id set
+# of the index is saved in its metadata. Paths of a graph with a different
+# block-id set are checked: inserting a path with less than `--min_known` of its
+# length in blocks known to the index is refused, and queries of such paths are
+# reported with a warning.
+#
+# The script updates the index with the paths of a pangraph and optionally
+# reports the k closest isolates of a set of query paths.
+
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+from array import array
+
+from pangraph_cache import cache_dir, load_pangraph
+from profiling import Profiler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="nearest-neighbor index of isolates by private sequence"
+    )
+    parser.add_argument("--index", type=str, required=True, help="index directory")
+    parser.add_argument("--pangraph", type=str, required=True, help="pangraph file")
+    parser.add_argument(
+        "--insert",
+        action="store_true",
+        help="insert the paths of the pangraph that are not in the index",
+    )
+    parser.add_argument(
+        "--query",
+        type=str,
+        nargs="+",
+        default=None,
+        help="names of the query paths, or 'all' for all paths of the pangraph",
+    )
+    parser.add_argument("--k", type=int, default=5, help="n. of neighbors")
+    parser.add_argument(
+        "--min_known",
+        type=float,
+        default=0.5,
+        help="min. fraction of the length of a path in blocks known to the index",
+    )
+    parser.add_argument(
+        "--neighbors", type=str, default=None, help="output neighbors table (.tsv)"
+    )
+    return parser.parse_args()
+
+
+class IsolateIndex:
+    """Inverted index block -> isolates, with length-weighted scoring for the
+    private sequence distance (see above). A block switches from the presence
+    to the absence list when it is present in more than `hi` of the isolates,
+    and back when it is present in less than `lo` of them."""
+
+    lo, hi = 0.4, 0.6
+
+    def __init__(self, min_known=0.5):
+        self.min_known = min_known
+        self.names, self.tot = [], []
+        self.name_idx = {}
+        self.block_ids, self.block_len, self.block_count = [], [], []
+        self.block_idx = {}
+        # per block: isolates list, and whether it is the absence list
+        self.lists, self.frequent = [], []
+        # indices of the frequent blocks
+        self.freq_blocks = set()
+        # total lengths as an array, and isolates sorted by total length
+        self._tot, self._by_len = None, None
+
+    @property
+    def N(self):
+        return len(self.names)
+
+    def _block(self, block_id, length):
+        """index of a block, added if not present"""
+        b = self.block_idx.get(block_id)
+        if b is None:
+            b = len(self.block_ids)
+            self.block_idx[block_id] = b
+            self.block_ids.append(block_id)
+            self.block_len.append(int(length))
+            self.block_count.append(0)
+            self.lists.append(array("i"))
+            self.frequent.append(False)
+        return b
+
+    def _switch(self, b):
+        """replaces the list of block b with its complement"""
+        lst = np.frombuffer(self.lists[b], dtype=np.int32)
+        others = np.setdiff1d(np.arange(self.N, dtype=np.int32), lst)
+        self.lists[b] = array("i", others.tobytes())
+        self.frequent[b] = not self.frequent[b]
+        if self.frequent[b]:
+            self.freq_blocks.add(b)
+        else:
+            self.freq_blocks.discard(b)
+
+    def known_fraction(self, block_ids, block_len):
+        """fraction of the length of a path in blocks known to the index, given
+        the ids and lengths of its blocks. It is 1 for an empty index."""
+        blocks = dict(zip(block_ids, block_len))
+        L = sum(blocks.values())
+        if self.N == 0 or L == 0:
+            return 1.0
+        return sum(l for b, l in blocks.items() if b in self.block_idx) / L
+
+    def signature(self):
+        """signature of the set of block ids of the index"""
+        return block_signature(self.block_ids)
+
+    def insert(self, name, block_ids, block_len):
+        """adds an isolate, given the ids and lengths of its blocks. Raises a
+        ValueError if less than `min_known` of its length is in known blocks,
+        e.g. if it comes from a graph with different block ids."""
+        assert name not in self.name_idx, f"isolate {name} already in the index"
+        f = self.known_fraction(block_ids, block_len)
+        if f < self.min_known:
+            raise ValueError(
+                f"isolate {name} has only {f:.0%} of its length in blocks known "
+                "to the index: block ids of the graph are not consistent"
+            )
+        blocks = dict(zip(block_ids, block_len))
+        n = self.N
+        self.name_idx[name] = n
+        self.names.append(name)
+        self.tot.append(int(sum(blocks.values())))
+        self._tot, self._by_len = None, None
+
+        Q = set()
+        for bid, l in blocks.items():
+            b = self._block(bid, l)
+            Q.add(b)
+            self.block_count[b] += 1
+            if not self.frequent[b]:
+                self.lists[b].append(n)
+
+        # the new isolate lacks all other frequent blocks
+        for b in self.freq_blocks - Q:
+            self.lists[b].append(n)
+
+        # update the list type of the blocks whose frequency crossed a threshold
+        for b in Q | self.freq_blocks:
+            f = self.block_count[b] / self.N
+            if f > self.hi if not self.frequent[b] else f < self.lo:
+                self._switch(b)
+
+    def by_len(self):
+        """array of total lengths, and isolates sorted by total length. Both are
+        updated lazily after inserts."""
+        if self._by_len is None:
+            self._tot = np.array(self.tot, dtype=np.int64)
+            self._by_len = np.argsort(self._tot, kind="stable")
+        return self._tot, self._by_len
+
+    def query(self, block_ids, block_len, k=5, exclude=None):
+        """returns the k closest isolates to a path, given the ids and lengths
+        of its blocks, as a list of pairs (name, distance) sorted by distance.
+        The isolate named `exclude` (e.g. the query itself) is skipped."""
+        blocks = dict(zip(block_ids, block_len))
+        LQ = sum(blocks.values())
+        tot, by_len = self.by_len()
+
+        # corrections from the lists of the (known) blocks of the path
+        C, ids, w = 0, [], []
+        for bid in blocks:
+            b = self.block_idx.get(bid)
+            if b is None:
+                continue
+            lst = np.frombuffer(self.lists[b], dtype=np.int32)
+            if self.frequent[b]:
+                C += self.block_len[b]
+                w.append(np.full(len(lst), 2 * self.block_len[b], dtype=np.int64))
+            else:
+                w.append(np.full(len(lst), -2 * self.block_len[b], dtype=np.int64))
+            ids.append(lst)
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32)
+        w = np.concatenate(w) if w else np.zeros(0, dtype=np.int64)
+        touched, inv = np.unique(ids, return_inverse=True)
+        delta = np.bincount(inv, weights=w, minlength=len(touched)).astype(np.int64)
+
+        # closest untouched isolates, in order of total length
+        skip = set(touched.tolist())
+        if exclude in self.name_idx:
+            skip.add(self.name_idx[exclude])
+        untouched = []
+        for x in by_len:
+            if len(untouched) >= k:
+                break
+            if x not in skip:
+                untouched.append(x)
+
+        cand = np.concatenate([touched, untouched]).astype(np.int64)
+        d = LQ + tot[cand] - 2 * C + np.r_[delta, np.zeros(len(untouched), np.int64)]
+        if exclude in self.name_idx:
+            keep = cand != self.name_idx[exclude]
+            cand, d = cand[keep], d[keep]
+        order = np.lexsort((cand, d))[:k]
+        return [(self.names[c], int(d[o])) for o, c in zip(order, cand[order])]
+
+    def save(self, path):
+        """saves the index as a directory of .npy columns. The directory is
+        written in a temporary location and then renamed."""
+        path = pathlib.Path(path)
+        lengths = np.array([len(l) for l in self.lists], dtype=np.int64)
+        items = [np.frombuffer(l, dtype=np.int32) for l in self.lists]
+        columns = {
+            "names": np.array(self.names, dtype=str),
+            "tot": np.array(self.tot, dtype=np.int64),
+            "block_ids": np.array(self.block_ids, dtype=str),
+            "block_len": np.array(self.block_len, dtype=np.int64),
+            "block_count": np.array(self.block_count, dtype=np.int64),
+            "frequent": np.array(self.frequent, dtype=bool),
+            "list_offsets": np.concatenate([[0], np.cumsum(lengths)]),
+            "list_items": np.concatenate(items) if items else np.zeros(0, np.int32),
+        }
+        tmp = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        tmp.mkdir(parents=True, exist_ok=True)
+        for name, col in columns.items():
+            np.save(tmp / f"{name}.npy", col)
+        with open(tmp / "meta.json", "w") as f:
+            meta = {
+                "n_isolates": self.N,
+                "n_blocks": len(self.block_ids),
+                "block_signature": self.signature(),
+            }
+            json.dump(meta, f)
+        if path.exists():
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, min_known=0.5):
+        """loads an index saved with `save`"""
+        path = pathlib.Path(path)
+        col = {f.stem: np.load(f) for f in path.glob("*.npy")}
+        idx = cls(min_known)
+        idx.names = col["names"].tolist()
+        idx.tot = col["tot"].tolist()
+        idx.name_idx = {n: i for i, n in enumerate(idx.names)}
+        idx.block_ids = col["block_ids"].tolist()
+        idx.block_len = col["block_len"].tolist()
+        idx.block_count = col["block_count"].tolist()
+        idx.block_idx = {b: i for i, b in enumerate(idx.block_ids)}
+        idx.frequent = col["frequent"].tolist()
+        idx.freq_blocks = set(np.flatnonzero(col["frequent"]).tolist())
+        off, items = col["list_offsets"], col["list_items"].astype(np.int32)
+        idx.lists = [
+            array("i", items[off[b] : off[b + 1]].tobytes())
+            for b in range(len(idx.block_ids))
+        ]
+        return idx
+
+
+def block_signature(block_ids):
+    """sha1 signature of a set of block ids"""
+    ids = "\n".join(sorted(set(str(b) for b in block_ids)))
+    return hashlib.sha1(ids.encode()).hexdigest()
+
+
+def path_blocks(pan, path):
+    """ids and lengths of the blocks of a path of a cached pangraph"""
+    bidx = np.unique(path.block_idx)
+    return pan.block_ids[bidx], pan.block_len[bidx]
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    prof = Profiler(
+        inputs=[args.pangraph, cache_dir(args.pangraph)],
+        outputs=[args.index, args.neighbors],
+    )
+
+    # load pangraph and index
+    prof.stage("load")
+    pan = load_pangraph(args.pangraph)
+    index_exists = pathlib.Path(args.index, "meta.json").exists()
+    if index_exists:
+        index = IsolateIndex.load(args.index, min_known=args.min_known)
+    else:
+        index = IsolateIndex(min_known=args.min_known)
+
+    # paths of a graph with a different block-id set are checked against the
+    # blocks of the index
+    same_blocks = index.signature() == block_signature(pan.block_ids)
+
+    def __unknown(paths):
+        if same_blocks:
+            return []
+        fs = [(p.name, index.known_fraction(*path_blocks(pan, p))) for p in paths]
+        return [(n, f) for n, f in fs if f < args.min_known]
+
+    # insert new isolates, without rebuilding the index. Nothing is inserted if
+    # any of them has block ids not consistent with the index.
+    if args.insert or not index_exists:
+        prof.stage("insert")
+        new = [p for p in pan.paths if p.name not in index.name_idx]
+        unknown = __unknown(new)
+        if len(unknown) > 0:
+            sys.exit(
+                f"error: {len(unknown)} isolates have less than {args.min_known:.0%} "
+                "of their length in blocks known to the index, e.g. "
+                f"{unknown[0][0]} ({unknown[0][1]:.0%}). Block ids of "
+                f"{args.pangraph} are not consistent with the index."
+            )
+        for p in new:
+            index.insert(p.name, *path_blocks(pan, p))
+        index.save(args.index)
+        print(f"inserted {len(new)} isolates, index size = {index.N}")
+
+    # k nearest neighbors of the query paths
+    if args.query is not None:
+        prof.stage("query")
+        names = pan.path_names if args.query == ["all"] else args.query
+        for name, f in __unknown([pan.paths[n] for n in names]):
+            print(
+                f"warning: query {name} has only {f:.0%} of its length in blocks "
+                "known to the index, distances are not reliable"
+            )
+        rows = []
+        for name in names:
+            nn = index.query(*path_blocks(pan, pan.paths[name]), k=args.k, exclude=name)
+            for rank, (other, d) in enumerate(nn):
+                rows.append((name, rank + 1, other, d))
+        df = pd.DataFrame(rows, columns=["query", "rank", "isolate", "private_seq"])
+        if args.neighbors is not None:
+            df.to_csv(args.neighbors, sep="\t", index=False)
+        else:
+            print(df.to_string(index=False))
+
+    prof.save()
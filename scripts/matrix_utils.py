@@ -0,0 +1,292 @@
+# Utilities to store pairwise matrices (e.g. private sequence distance or shared
+# path length) in a compact binary format. A matrix `name.npy` is saved as a
+# square float32 array that can be memory-mapped, together with a
+# `name.labels.txt` file containing one label per line, in row/column order.
+#
+# Large matrices can be downsampled for plotting with `pooled_matrix`.
+#
+# Values for several anchors (e.g. the shared path length around different
+# blocks) are saved as a (anchor x pair) tensor `name.npy`, with one row per
+# anchor and pairs of distinct labels in condensed order (as
+# `np.triu_indices(N, k=1)`), together with the labels file and a
+# `name.anchors.txt` file containing one anchor per line.
+#
+# Matrices can be updated incrementally when items are added. The result is
+# kept in a state directory together with a fingerprint of each item (e.g. of
+# the blocks of a path) and the parameters of the computation. At the next run
+# only the rows and columns of new or changed items are evaluated, and the
+# other entries are copied from the stored matrix. If the parameters differ or
+# too many items changed, e.g. after a graph rebuild, the matrix is recomputed
+# from scratch.
+#
+# The script can also be executed to export a matrix to the long-form csv format
+# (p1, p2, value) with one row per ordered pair.
+
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import numpy as np
+import pandas as pd
+
+from profiling import Profiler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="export a binary pairwise matrix to a long-form csv file"
+    )
+    parser.add_argument("--matrix", type=str, required=True, help="input .npy file")
+    parser.add_argument("--csv", type=str, required=True, help="output csv file")
+    parser.add_argument("--value_name", type=str, default="value")
+    parser.add_argument("--as_int", action="store_true", help="write integer values")
+    return parser.parse_args()
+
+
+def labels_file(fname):
+    """name of the file containing the labels of a matrix"""
+    return pathlib.Path(fname).with_suffix(".labels.txt")
+
+
+def create_matrix(fname, labels, dtype=np.float32):
+    """creates a memory-mapped square matrix on disk, together with its labels
+    file, and returns it. Tiles can then be written on the matrix in bounded
+    memory. Call `flush` on the returned array when done."""
+    N = len(labels)
+    # remove the previous file instead of overwriting it, since it can be
+    # hard-linked in an incremental state
+    pathlib.Path(fname).unlink(missing_ok=True)
+    with open(labels_file(fname), "w") as f:
+        f.write("".join(f"{l}\n" for l in labels))
+    return np.lib.format.open_memmap(fname, mode="w+", dtype=dtype, shape=(N, N))
+
+
+def save_matrix(fname, labels, M, dtype=np.float32):
+    """saves an in-memory matrix and its labels"""
+    out = create_matrix(fname, labels, dtype=dtype)
+    out[:] = M
+    out.flush()
+
+
+def load_labels(fname):
+    """loads the labels of a matrix"""
+    with open(labels_file(fname), "r") as f:
+        return np.array(f.read().splitlines())
+
+
+def load_matrix(fname, mmap=True):
+    """loads a pairwise matrix and returns a pair (labels, matrix). For .npy
+    files the matrix is memory-mapped (if `mmap` is True), so that slices are
+    only read when accessed. For backward compatibility long-form .csv files
+    with columns (p1, p2, value) are also accepted and pivoted in memory."""
+    if str(fname).endswith(".csv"):
+        df = pd.read_csv(fname)
+        value = df.columns[2]
+        M = df.pivot(index="p1", columns="p2", values=value)
+        M = M.loc[M.index, M.index]
+        return M.index.to_numpy(), M.to_numpy()
+
+    labels = load_labels(fname)
+    M = np.load(fname, mmap_mode="r" if mmap else None)
+    assert M.shape == (len(labels), len(labels)), "matrix and labels do not match"
+    return labels, M
+
+
+def anchors_file(fname):
+    """name of the file containing the anchors of a pair tensor"""
+    return pathlib.Path(fname).with_suffix(".anchors.txt")
+
+
+def create_pair_tensor(fname, anchors, labels, dtype=np.int32):
+    """creates a memory-mapped (anchor x pair) tensor on disk, together with its
+    anchors and labels files, and returns it. Call `flush` on the returned
+    array when done."""
+    N = len(labels)
+    with open(labels_file(fname), "w") as f:
+        f.write("".join(f"{l}\n" for l in labels))
+    with open(anchors_file(fname), "w") as f:
+        f.write("".join(f"{a}\n" for a in anchors))
+    shape = (len(anchors), N * (N - 1) // 2)
+    return np.lib.format.open_memmap(fname, mode="w+", dtype=dtype, shape=shape)
+
+
+def load_pair_tensor(fname, mmap=True):
+    """loads a pair tensor and returns a tuple (anchors, labels, tensor)"""
+    labels = load_labels(fname)
+    with open(anchors_file(fname), "r") as f:
+        anchors = np.array(f.read().splitlines())
+    T = np.load(fname, mmap_mode="r" if mmap else None)
+    N = len(labels)
+    assert T.shape == (len(anchors), N * (N - 1) // 2), "tensor and labels do not match"
+    return anchors, labels, T
+
+
+def upper_triangle(M, block_size=1024):
+    """condensed array of the entries above the diagonal of a square matrix,
+    in the order of `np.triu_indices(N, k=1)`. The matrix (e.g. memory-mapped)
+    is read in blocks of `block_size` rows."""
+    N = len(M)
+    out = np.empty(N * (N - 1) // 2, dtype=M.dtype)
+    c = 0
+    for b in range(0, N, block_size):
+        tile = np.asarray(M[b : b + block_size])
+        for k, row in enumerate(tile):
+            row = row[b + k + 1 :]
+            out[c : c + len(row)] = row
+            c += len(row)
+    return out
+
+
+def upper_triangle_df(labels, M, value_name):
+    """returns a dataframe with one entry (p1, p2, value) per unordered pair of
+    distinct labels, corresponding to the upper triangle of the matrix"""
+    labels = np.asarray(labels)
+    i, j = np.triu_indices(len(labels), k=1)
+    return pd.DataFrame({"p1": labels[i], "p2": labels[j], value_name: M[i, j]})
+
+
+def pool_edges(N, size):
+    """edges of `size` contiguous bins (as equal as possible) partitioning the
+    range [0, N). Requires size <= N."""
+    return np.linspace(0, N, size + 1).astype(int)
+
+
+def pooled_matrix(M, order, size, how="mean", block_size=1024):
+    """downsamples the square matrix M, with rows and columns in the given
+    order, to a `size` x `size` grid, by mean or max pooling over contiguous
+    bins. The matrix is read in blocks of about `block_size` rows, so that it
+    can be memory-mapped. Returns the pooled matrix and the bin edges."""
+    order = np.asarray(order)
+    N = len(order)
+    size = min(size, N)
+    edges = pool_edges(N, size)
+    reduce = {"mean": np.add, "max": np.maximum}[how]
+    P = np.empty((size, size), dtype=float)
+    b = 0
+    while b < size:
+        # group consecutive row bins up to block_size rows
+        e = max(np.searchsorted(edges, edges[b] + block_size, side="right") - 1, b + 1)
+        e = min(e, size)
+        tile = np.asarray(M[order[edges[b] : edges[e]]], dtype=float)[:, order]
+        tile = reduce.reduceat(tile, edges[:-1], axis=1)
+        P[b:e] = reduce.reduceat(tile, edges[b:e] - edges[b], axis=0)
+        b = e
+    if how == "mean":
+        n = np.diff(edges)
+        P /= n[:, None] * n[None, :]
+    return P, edges
+
+
+def fingerprint(*columns):
+    """hex digest of the content of a sequence of arrays (of numbers or
+    strings)"""
+    h = hashlib.blake2b(digest_size=16)
+    for c in columns:
+        c = np.asarray(c)
+        if c.dtype.kind in "US":
+            h.update("\x00".join(c.astype(str).tolist()).encode())
+        else:
+            h.update(c.astype(np.int64).tobytes())
+        h.update(b"\x01")
+    return h.hexdigest()
+
+
+def load_state(state_dir):
+    """metadata of the incremental state stored in a directory (labels,
+    fingerprints and parameters), or None if there is no state"""
+    meta_file = pathlib.Path(state_dir) / "meta.json"
+    if not meta_file.exists():
+        return None
+    with open(meta_file, "r") as f:
+        return json.load(f)
+
+
+def incremental_plan(state, labels, fingerprints, params, max_changed=0.5):
+    """compares the current labels and fingerprints with the stored state (see
+    `load_state`). Returns None if the matrix must be recomputed from scratch:
+    no state, different parameters, or more than a fraction `max_changed` of
+    the stored labels that are still present have a different fingerprint.
+    Otherwise returns a pair (src, rows): for each label the row of the stored
+    matrix to copy from (-1 for new or changed labels), and the indices of the
+    rows and columns to evaluate."""
+    if state is None or state["params"] != params:
+        return None
+    old = {l: (i, fp) for i, (l, fp) in enumerate(zip(state["labels"], state["fp"]))}
+    src = np.full(len(labels), -1, dtype=np.int64)
+    for n, (l, fp) in enumerate(zip(labels, fingerprints)):
+        if l in old and old[l][1] == fp:
+            src[n] = old[l][0]
+    n_common = sum(l in old for l in labels)
+    n_changed = n_common - np.sum(src >= 0)
+    if n_common == 0 or n_changed > max_changed * n_common:
+        return None
+    return src, np.flatnonzero(src < 0)
+
+
+def copy_from_state(state_dir, out, src, block_size=1024):
+    """copies the entries of the stored matrix between labels with `src >= 0`
+    (see `incremental_plan`) in the new matrix, in blocks of rows"""
+    _, M = load_matrix(pathlib.Path(state_dir) / "matrix.npy")
+    keep = np.flatnonzero(src >= 0)
+    for b in range(0, len(keep), block_size):
+        r = keep[b : b + block_size]
+        out[np.ix_(r, keep)] = np.asarray(M[src[r]])[:, src[keep]]
+
+
+def save_state(state_dir, M, labels, fingerprints, params):
+    """stores a matrix, given as an in-memory array or as the name of a .npy
+    file, as the incremental state for the next update. Files are hard-linked
+    if possible. The state is written in a temporary directory that is then
+    renamed."""
+    state_dir = pathlib.Path(state_dir)
+    tmp = state_dir.with_name(f"{state_dir.name}.tmp-{os.getpid()}")
+    tmp.mkdir(parents=True, exist_ok=True)
+    if isinstance(M, np.ndarray):
+        save_matrix(tmp / "matrix.npy", labels, M, dtype=M.dtype)
+    else:
+        with open(labels_file(tmp / "matrix.npy"), "w") as f:
+            f.write("".join(f"{l}\n" for l in labels))
+        try:
+            os.link(M, tmp / "matrix.npy")
+        except OSError:
+            shutil.copyfile(M, tmp / "matrix.npy")
+    meta = {"params": params, "labels": list(labels), "fp": list(fingerprints)}
+    with open(tmp / "meta.json", "w") as f:
+        json.dump(meta, f)
+    if state_dir.exists():
+        shutil.rmtree(state_dir)
+    os.rename(tmp, state_dir)
+
+
+def export_csv(fname, csv_fname, value_name, as_int=False, block_size=1024):
+    """exports a binary matrix to a long-form csv with one row per ordered pair.
+    The matrix is read and written in blocks of `block_size` rows."""
+    labels, M = load_matrix(fname)
+    N = len(labels)
+    with open(csv_fname, "w") as f:
+        f.write(f"p1,p2,{value_name}\n")
+        for b in range(0, N, block_size):
+            e = min(b + block_size, N)
+            tile = np.asarray(M[b:e])
+            if as_int:
+                tile = np.rint(tile).astype(np.int64)
+            df = pd.DataFrame(
+                {
+                    "p1": np.repeat(labels[b:e], N),
+                    "p2": np.tile(labels, e - b),
+                    value_name: tile.ravel(),
+                }
+            )
+            df.to_csv(f, index=False, header=False)
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    prof = Profiler(inputs=[args.matrix], outputs=[args.csv])
+    prof.stage("write")
+    export_csv(args.matrix, args.csv, args.value_name, as_int=args.as_int)
+    prof.save()
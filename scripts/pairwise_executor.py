@@ -0,0 +1,235 @@
+# Parallel executor for all-pairs computations. The square result matrix is
+# split in tiles of equal size covering its upper triangle, and each tile is
+# evaluated by a kernel function of the form
+#
+#     kernel(arrays, i0, i1, j0, j1) -> block of shape (i1 - i0, j1 - j0)
+#
+# where `arrays` is a dictionary of the (encoded) input arrays. The lower
+# triangle is filled by symmetry. Alternatively, only a subset of rows (and, by
+# symmetry, of columns) can be evaluated, e.g. to update a matrix when new items
+# are added. The result can also be written in condensed form, i.e. as the 1D
+# array of the entries above the diagonal (in the order of
+# `np.triu_indices(N, k=1)`), without allocating the square matrix.
+#
+# With more than one thread the input arrays are placed in
+# `multiprocessing.shared_memory`, and tiles are evaluated on a pool of worker
+# processes. Only the tile coordinates are sent to the workers, which write
+# their blocks directly in the result matrix if it is memory-mapped on disk,
+# each worker mapping the same file. Tiles are disjoint, so no locking is
+# needed. For an in-memory output the blocks are sent back and written by the
+# main process, so that the matrix is never duplicated. Workers are started
+# with single-threaded BLAS, to avoid oversubscription of the cores.
+
+import mmap
+import multiprocessing as mp
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+
+BLAS_THREADS_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+]
+
+
+def triangle_tiles(N, tile_size):
+    """list of tiles (i0, i1, j0, j1) covering the upper triangle (diagonal
+    included) of an N x N matrix"""
+    starts = range(0, N, tile_size)
+    return [
+        (i0, min(i0 + tile_size, N), j0, min(j0 + tile_size, N))
+        for i0 in starts
+        for j0 in starts
+        if j0 >= i0
+    ]
+
+
+def row_tiles(rows, N, tile_size):
+    """list of tiles (i0, i1, j0, j1) covering the given rows of an N x N
+    matrix. Consecutive rows are grouped in tiles of at most `tile_size`."""
+    rows = np.unique(rows)
+    if len(rows) == 0:
+        return []
+    start = np.flatnonzero(np.r_[True, np.diff(rows) > 1])
+    end = np.r_[start[1:], len(rows)]
+    tiles = []
+    for s, e in zip(rows[start], rows[end - 1] + 1):
+        for i0 in range(s, e, tile_size):
+            for j0 in range(0, N, tile_size):
+                tiles.append((i0, min(i0 + tile_size, e), j0, min(j0 + tile_size, N)))
+    return tiles
+
+
+class SharedArrays:
+    """Set of numpy arrays stored in shared memory. The `specs` attribute can
+    be sent to other processes, that access the arrays with `attach`. Use as a
+    context manager to release the memory at the end."""
+
+    def __init__(self, arrays):
+        """copies the given dictionary of arrays in shared memory. Entries that
+        are a (shape, dtype) tuple are allocated without being initialized."""
+        self.shm, self.arrays, self.specs = [], {}, {}
+        for name, a in arrays.items():
+            if isinstance(a, tuple):
+                shape, dtype = a
+            else:
+                a = np.asarray(a)
+                shape, dtype = a.shape, a.dtype
+            dtype = np.dtype(dtype)
+            size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.append(shm)
+            self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            if not isinstance(a, tuple):
+                self.arrays[name][...] = a
+            self.specs[name] = (shm.name, shape, dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.arrays = {}
+        for shm in self.shm:
+            shm.close()
+            shm.unlink()
+
+
+# arrays attached by each worker process
+_worker_shm, _worker_arrays = [], {}
+
+
+def file_spec(out):
+    """spec (file name, offset, shape, dtype, order) of an array memory-mapped
+    on a file, or None if `out` is neither a whole writable memory-mapped array
+    nor a contiguous view of one (e.g. a row of a memory-mapped tensor)"""
+    root = out
+    while isinstance(root, np.ndarray) and isinstance(root.base, np.ndarray):
+        root = root.base
+    if not isinstance(root, np.memmap) or not isinstance(root.base, mmap.mmap):
+        return None
+    if root.filename is None or root.mode not in ("r+", "w+"):
+        return None
+    if out is root:
+        order = "F" if out.flags.f_contiguous and not out.flags.c_contiguous else "C"
+        return (out.filename, out.offset, out.shape, out.dtype.str, order)
+    if not out.flags.c_contiguous:
+        return None
+    offset = root.offset + out.ctypes.data - root.ctypes.data
+    return (root.filename, offset, out.shape, out.dtype.str, "C")
+
+
+def condensed_index(i, j, N):
+    """index of the entry (i, j), with i < j, in the condensed form of an N x N
+    matrix"""
+    return i * (2 * N - i - 1) // 2 + j - i - 1
+
+
+def write_block(out, block, tile, N=None):
+    """writes the block of a tile in the result matrix, and its transpose. If
+    `N` is given, `out` is the condensed form of the N x N matrix, and only the
+    entries above the diagonal are written, one row of the tile at a time."""
+    i0, i1, j0, j1 = tile
+    if N is None:
+        out[i0:i1, j0:j1] = block
+        out[j0:j1, i0:i1] = block.T
+        return
+    # entries (i, j) with j > i, then the ones below the diagonal, which are
+    # not covered by another row of the tile only if j0 < i0
+    for i in range(i0, min(i1, j1 - 1)):
+        j = max(j0, i + 1)
+        c = condensed_index(i, j, N)
+        out[c : c + j1 - j] = block[i - i0, j - j0 :]
+    for j in range(j0, min(j1, i0, i1 - 1)):
+        i = max(i0, j + 1)
+        c = condensed_index(j, i, N)
+        out[c : c + i1 - i] = block[i - i0 :, j - j0]
+
+
+def attach(specs, out_file=None):
+    """attaches to arrays in shared memory, given their specs, and to the
+    result matrix on file if its spec is given (see `file_spec`)"""
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_shm.append(shm)
+        _worker_arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    if out_file is not None:
+        fname, offset, shape, dtype, order = out_file
+        _worker_arrays["__out__"] = np.memmap(
+            fname, dtype=dtype, mode="r+", offset=offset, shape=shape, order=order
+        )
+
+
+def _run_tile(kernel, N, tile):
+    """evaluates a tile in a worker. The block is written in the result matrix
+    if the worker has access to it, otherwise it is returned."""
+    block = kernel(_worker_arrays, *tile)
+    if "__out__" not in _worker_arrays:
+        return block
+    write_block(_worker_arrays["__out__"], block, tile, N)
+
+
+def pairwise_matrix(
+    kernel,
+    arrays,
+    N,
+    out=None,
+    dtype=np.float64,
+    threads=1,
+    tile_size=1024,
+    rows=None,
+    condensed=False,
+):
+    """evaluates the symmetric N x N matrix defined by a tile kernel (see
+    above) over the given dictionary of input arrays. The result is written in
+    `out` if provided (e.g. a memory-mapped array), otherwise a new matrix of
+    the given dtype is allocated. If `rows` is passed, only these rows and
+    columns are evaluated, and the other entries of `out` are left unchanged.
+    With `condensed` the result is the 1D array of the N * (N - 1) / 2 entries
+    above the diagonal. With more than one thread, tiles are evaluated in
+    parallel on shared-memory copies of the inputs, and written directly in
+    `out` if it is memory-mapped on disk."""
+    if out is None:
+        shape = (N * (N - 1) // 2,) if condensed else (N, N)
+        out = np.empty(shape, dtype=dtype)
+    n_cond = N if condensed else None
+    if rows is None:
+        tiles = triangle_tiles(N, tile_size)
+    else:
+        tiles = row_tiles(rows, N, tile_size)
+
+    if threads <= 1 or len(tiles) <= 1:
+        for tile in tiles:
+            write_block(out, kernel(arrays, *tile), tile, n_cond)
+        return out
+
+    # spawned workers with single-threaded BLAS
+    env = {v: os.environ.get(v) for v in BLAS_THREADS_VARS}
+    os.environ.update({v: "1" for v in BLAS_THREADS_VARS})
+    try:
+        # workers write on the file of a memory-mapped output, otherwise the
+        # blocks are written here as they are returned
+        out_file = file_spec(out)
+        if out_file is not None:
+            out.flush()
+        with SharedArrays(arrays) as sa:
+            with ProcessPoolExecutor(
+                max_workers=min(threads, len(tiles)),
+                mp_context=mp.get_context("spawn"),
+                initializer=attach,
+                initargs=(sa.specs, out_file),
+            ) as executor:
+                blocks = executor.map(partial(_run_tile, kernel, n_cond), tiles)
+                for tile, block in zip(tiles, blocks):
+                    if block is not None:
+                        write_block(out, block, tile, n_cond)
+    finally:
+        for v, val in env.items():
+            if val is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = val
+    return out
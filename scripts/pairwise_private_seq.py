@@ -1,58 +1,160 @@
 import argparse
 import numpy as np
 import pandas as pd
-import pypangraph as pp
-from itertools import combinations
+
+from pangraph_cache import cache_dir, load_pangraph
+from private_seq_utils import (
+    PresenceAbsence,
+    approx_private_seq_matrix,
+    sketch_error_bound,
+    sparse_private_seq_matrix,
+)
+from matrix_utils import (
+    copy_from_state,
+    create_matrix,
+    export_csv,
+    fingerprint,
+    incremental_plan,
+    load_state,
+    save_state,
+)
+from profiling import Profiler
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pangraph", type=str, help="pangraph file")
     parser.add_argument(
-        "--dist_df", type=str, help="output pairwise distance dataframe"
+        "--dist_mat", type=str, help="output pairwise distance matrix (.npy)"
+    )
+    parser.add_argument(
+        "--dist_df",
+        type=str,
+        default=None,
+        help="optional output pairwise distance dataframe (.csv)",
+    )
+    parser.add_argument("--threads", type=int, default=1, help="n. of processes")
+    parser.add_argument(
+        "--approx",
+        action="store_true",
+        help="estimate the distance from weighted MinHash sketches",
+    )
+    parser.add_argument("--n_hashes", type=int, default=128, help="sketch size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--validate",
+        type=str,
+        default=None,
+        help="with --approx, compare to the exact distance and save a summary (.tsv)",
+    )
+    parser.add_argument(
+        "--incremental",
+        type=str,
+        default=None,
+        help="state directory, to only evaluate the rows of new or changed paths",
     )
     return parser.parse_args()
 
 
-if __name__ == "__main__":
-
-    args = parse_args()
-
-    # load pangraph
-    pan = pp.Pangraph.load_json(args.pangraph)
-
-    # create a presence-absence dataframe for blocks
-    pa_df = pan.to_blockcount_df() > 0
-
-    # create a vector of block lengths. The order is the same as in the presence-absence dataframe
-    Ls = pan.to_blockstats_df()["len"].to_dict()
-    Ls = [Ls[b] for b in pa_df.columns]
-
-    # compute pairwise private sequence distance
-    dist_df = []
-    for p1, p2 in combinations(pan.paths, 2):
-
-        # names of isolates
-        iso1 = p1.name
-        iso2 = p2.name
-
-        # presence-absence binary vector for each isolate
-        vi = pa_df.loc[iso1].to_numpy()
-        vj = pa_df.loc[iso2].to_numpy()
-
-        # total length of private sequence
-        d = np.sum((vi ^ vj) * Ls)
+def path_fingerprints(pan):
+    """fingerprint of the set of blocks of each path, with their lengths"""
+    fps = []
+    for p in pan.paths:
+        bidx = np.unique(p.block_idx)
+        fps.append(fingerprint(pan.block_ids[bidx], pan.block_len[bidx]))
+    return fps
+
+
+def sketch_validation(D_exact, D_approx, tot, n_hashes, delta=0.05):
+    """summary of the error of the approximate distance over all pairs of
+    distinct paths, and fraction of pairs within the error bound"""
+    i, j = np.triu_indices(len(tot), k=1)
+    d, a = np.asarray(D_exact)[i, j], np.asarray(D_approx)[i, j]
+    err = np.abs(a - d)
+    rel = err / np.maximum(d, 1)
+    bound = sketch_error_bound(tot[i], tot[j], n_hashes, delta)
+    return pd.DataFrame(
+        {
+            "n_hashes": [n_hashes],
+            "n_pairs": [len(d)],
+            "mean_abs_err": [err.mean()],
+            "max_abs_err": [err.max()],
+            "mean_rel_err": [rel.mean()],
+            "median_rel_err": [np.median(rel)],
+            "pearson_r": [np.corrcoef(d, a)[0, 1]],
+            "mean_bound": [bound.mean()],
+            f"frac_within_bound_{1 - delta:.2f}": [np.mean(err <= bound)],
+        }
+    )
 
-        # append to dataframe
-        dist_df.append([iso1, iso2, d])
-        dist_df.append([iso2, iso1, d])
 
-    # add distance zero for self-comparisons
-    for p in pan.paths:
-        dist_df.append([p.name, p.name, 0])
+if __name__ == "__main__":
 
-    # transform to dataframe
-    dist_df = pd.DataFrame(dist_df, columns=["p1", "p2", "private_seq"])
+    args = parse_args()
+    prof = Profiler(
+        inputs=[args.pangraph, cache_dir(args.pangraph)],
+        outputs=[args.dist_mat, args.dist_df, args.validate],
+    )
 
-    # save to file
-    dist_df.to_csv(args.dist_df, index=False)
+    # load pangraph (from its binary cache)
+    prof.stage("load")
+    pan = load_pangraph(args.pangraph)
+
+    # sparse block presence-absence, built directly from the path arrays
+    names = pan.strains()
+    pa = PresenceAbsence.from_pangraph(pan)
+
+    # in incremental mode, only the rows of new or changed paths are evaluated
+    # and the rest is copied from the previous result. Sketches depend on the
+    # set of accessory blocks, which must then be unchanged.
+    rows = None
+    if args.incremental is not None:
+        prof.stage("plan")
+        fps = path_fingerprints(pan)
+        params = {"approx": args.approx}
+        if args.approx:
+            params.update(n_hashes=args.n_hashes, seed=args.seed)
+            acc = np.flatnonzero(pa.counts() < pa.N)
+            params["blocks"] = fingerprint(pan.block_ids[acc], pan.block_len[acc])
+        state = load_state(args.incremental)
+        plan = incremental_plan(state, names, fps, params)
+        if plan is not None:
+            src, rows = plan
+            print(f"incremental update: {len(rows)} of {len(names)} paths evaluated")
+
+    # compute pairwise private sequence distance for all pairs at once. Tiles
+    # are written directly on the memory-mapped output matrix.
+    prof.stage("compute")
+    D = create_matrix(args.dist_mat, names)
+    if rows is not None:
+        copy_from_state(args.incremental, D, src)
+    if args.approx:
+        approx_private_seq_matrix(
+            pa,
+            n_hashes=args.n_hashes,
+            seed=args.seed,
+            out=D,
+            threads=args.threads,
+            rows=rows,
+        )
+    else:
+        sparse_private_seq_matrix(pa, out=D, threads=args.threads, rows=rows)
+    D.flush()
+    if args.incremental is not None:
+        save_state(args.incremental, args.dist_mat, names, fps, params)
+
+    # optionally compare the approximate distance to the exact one
+    if args.approx and args.validate is not None:
+        prof.stage("validate")
+        D_exact = sparse_private_seq_matrix(pa, threads=args.threads)
+        tot = pa.accessory().weight()
+        df = sketch_validation(D_exact, D, tot, args.n_hashes)
+        df.to_csv(args.validate, sep="\t", index=False)
+        print(df.T.to_string(header=False))
+
+    # optionally export to long-form dataframe
+    if args.dist_df is not None:
+        prof.stage("write")
+        export_csv(args.dist_mat, args.dist_df, "private_seq", as_int=True)
+
+    prof.save()
@@ -0,0 +1,195 @@
+# Pairwise projections of a pangraph for many pairs of isolates, without one
+# `pangraph marginalize` run per pair. The graph is loaded once (from its
+# binary cache) and a single `PanProjector` is reused for all pairs, or one per
+# worker process with --threads > 1.
+#
+# For each pair the projection splits both paths in common chunks (maximal runs
+# of blocks shared in the same order and relative orientation) and private
+# segments. The summary table reports, for each pair:
+# - shared_len: length of the common chunks (on the first isolate)
+# - private_len_a, private_len_b: length of the private segments
+# - n_chunks: number of common chunks
+# - n_breakpoints: adjacencies between the ends of consecutive common chunks
+#     along the first isolate (skipping private segments) that are not found in
+#     the second isolate, i.e. rearrangements not explained by insertions or
+#     deletions (2 for an inversion, 3 for a transposition)
+# - n_inversions: common chunks whose relative orientation differs from the
+#     one of the majority of the shared length
+#
+# Figures are only drawn for the pairs with the most breakpoints.
+
+import argparse
+import itertools as itt
+import multiprocessing as mp
+import pathlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from pangraph_cache import cache_dir, load_pangraph
+from plot_graph_projection import plot_projection
+from profiling import Profiler
+from pypangraph.pangraph_projector import PanProjector
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="summary statistics of the pairwise projections of many pairs"
+    )
+    parser.add_argument("--pangraph", type=str, required=True, help="pangraph file")
+    parser.add_argument(
+        "--pairs",
+        type=str,
+        default=None,
+        help="tsv file with two columns of path names, default all pairs",
+    )
+    parser.add_argument(
+        "--stats", type=str, required=True, help="output summary table (.tsv)"
+    )
+    parser.add_argument(
+        "--fig_dir", type=str, default=None, help="output folder for the figures"
+    )
+    parser.add_argument(
+        "--n_figs",
+        type=int,
+        default=5,
+        help="n. of pairs with the most breakpoints to draw",
+    )
+    parser.add_argument("--threads", type=int, default=1, help="n. of processes")
+    return parser.parse_args()
+
+
+def chunk_orientation(pr):
+    """dictionary chunk id -> whether the common chunk has the same orientation
+    on the two paths. The orientation is taken from a block occurrence of the
+    chunk, matched between the two paths by block id and duplicate id."""
+    MPA, MPB = pr.MPA, pr.MPB
+    posB = {}
+    for i, (k, b, d) in enumerate(zip(MPB.chunk_id, MPB.pth, MPB.dupl_id)):
+        if k > 0:
+            posB.setdefault((k, b, d), i)
+    same = {}
+    for i, (k, b, d) in enumerate(zip(MPA.chunk_id, MPA.pth, MPA.dupl_id)):
+        if k > 0 and k not in same:
+            same[k] = MPA.s[i] == MPB.s[posB[(k, b, d)]]
+    return same
+
+
+def chunk_adjacencies(chunk_id, same=None):
+    """set of adjacencies between the extremities of consecutive common chunks
+    along a circular path, skipping private segments. Extremities are labeled
+    (chunk, 0) for the start and (chunk, 1) for the end of the chunk in the
+    orientation of the first path: `same` gives whether each chunk has the
+    same orientation on this path (default True)."""
+    seq = [k for k, _ in itt.groupby(chunk_id) if k > 0]
+    # merge the first and last run if they are the same chunk
+    if len(seq) > 1 and seq[0] == seq[-1]:
+        seq = seq[:-1]
+    if len(seq) < 2:
+        return set()
+    fwd = [True if same is None else same[k] for k in seq]
+    exits = [(k, int(f)) for k, f in zip(seq, fwd)]
+    entries = [(k, int(not f)) for k, f in zip(seq, fwd)]
+    return {frozenset(p) for p in zip(exits, entries[1:] + entries[:1])}
+
+
+def projection_stats(pr):
+    """dictionary of summary statistics of a pairwise projection"""
+    MPA, MPB = pr.MPA, pr.MPB
+    commA, commB = np.asarray(MPA.comm, bool), np.asarray(MPB.comm, bool)
+    chunk_id = np.asarray(MPA.chunk_id)
+
+    # orientation of each chunk, relative to the majority of the shared length
+    same = chunk_orientation(pr)
+    chunks = np.array(sorted(same), dtype=int)
+    chunk_len = np.array([MPA.bl_Ls[chunk_id == k].sum() for k in chunks])
+    is_same = np.array([same[k] for k in chunks], dtype=bool)
+    majority = chunk_len[is_same].sum() >= chunk_len[~is_same].sum()
+
+    adjA = chunk_adjacencies(MPA.chunk_id)
+    adjB = chunk_adjacencies(MPB.chunk_id, same)
+    return {
+        "shared_len": int(MPA.bl_Ls[commA].sum()),
+        "private_len_a": int(MPA.bl_Ls[~commA].sum()),
+        "private_len_b": int(MPB.bl_Ls[~commB].sum()),
+        "n_chunks": len(chunks),
+        "n_breakpoints": len(adjA - adjB),
+        "n_inversions": int(np.sum(is_same != majority)),
+    }
+
+
+# projector of each worker process
+_worker_projector = None
+
+
+def _init_worker(pangraph):
+    """loads the graph (from its cache) and creates the projector once per
+    worker"""
+    global _worker_projector
+    _worker_projector = PanProjector(load_pangraph(pangraph))
+
+
+def _pair_stats(pair):
+    pr = _worker_projector.project(*pair, exclude_dupl=False)
+    return projection_stats(pr)
+
+
+def batch_projection_stats(pangraph, pairs, threads=1, chunksize=16):
+    """dataframe of the projection statistics (see `projection_stats`) of a
+    list of pairs of path names, evaluated in parallel on `threads` processes.
+    Each process loads the graph and creates its projector once."""
+    if threads <= 1:
+        _init_worker(pangraph)
+        stats = [_pair_stats(p) for p in pairs]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=threads,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(pangraph,),
+        ) as executor:
+            stats = list(executor.map(_pair_stats, pairs, chunksize=chunksize))
+    df = pd.DataFrame(stats)
+    df.insert(0, "a", [a for a, _ in pairs])
+    df.insert(1, "b", [b for _, b in pairs])
+    return df
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    prof = Profiler(
+        inputs=[args.pangraph, cache_dir(args.pangraph), args.pairs],
+        outputs=[args.stats, args.fig_dir],
+    )
+
+    # list of pairs
+    prof.stage("load")
+    pan = load_pangraph(args.pangraph)
+    if args.pairs is None:
+        pairs = list(itt.combinations(pan.path_names.tolist(), 2))
+    else:
+        pairs_df = pd.read_csv(args.pairs, sep="\t", header=None, comment="#")
+        pairs = list(zip(pairs_df[0], pairs_df[1]))
+
+    # projection statistics of all pairs
+    prof.stage("compute")
+    df = batch_projection_stats(args.pangraph, pairs, threads=args.threads)
+    df = df.sort_values(
+        ["n_breakpoints", "n_inversions", "shared_len"],
+        ascending=[False, False, True],
+        kind="stable",
+    )
+    df.to_csv(args.stats, sep="\t", index=False)
+
+    # figures of the most rearranged pairs only
+    if args.fig_dir is not None:
+        prof.stage("plot")
+        fig_dir = pathlib.Path(args.fig_dir)
+        fig_dir.mkdir(parents=True, exist_ok=True)
+        ppj = PanProjector(pan)
+        for a, b in df[["a", "b"]].head(args.n_figs).itertuples(index=False):
+            pr = ppj.project(a, b, exclude_dupl=False)
+            plot_projection(pr, fig_dir / f"projection_{a}_{b}.png")
+
+    prof.save()
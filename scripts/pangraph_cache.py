@@ -0,0 +1,393 @@
+# Columnar binary cache for pangraph .json files. The graph `name.json` is
+# converted once into a `name.cache` directory containing one .npy file per
+# column:
+# - block_ids, block_len, block_count, block_nstrains: one entry per block
+# - path_names, path_circular: one entry per path
+# - path_offsets: (n. paths + 1) offsets in the path arrays
+# - path_blocks (int32 block index), path_strands (bool): concatenated paths
+# and optionally, with `--alignments`, the consensus sequences and the block
+# alignments (as json lines) with their offsets.
+#
+# The `load_pangraph` function returns a `PangraphCache` object, that memory-maps
+# only the columns that are accessed. The object exposes the part of the
+# pypangraph `Pangraph` interface used by the scripts (paths, strains,
+# to_blockstats_df, to_blockcount_df, to_paths_dict).
+#
+# For graphs too large to be parsed at once, `iter_block_stats` streams the
+# .json file and returns block lengths and n. of isolates in batches, decoding
+# one block at a time.
+
+import argparse
+import json
+import os
+import pathlib
+import re
+import shutil
+import numpy as np
+import pandas as pd
+from functools import cached_property
+
+from profiling import Profiler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="convert a pangraph .json file to a columnar binary cache"
+    )
+    parser.add_argument("--pangraph", type=str, required=True, help="pangraph file")
+    parser.add_argument(
+        "--alignments",
+        action="store_true",
+        help="also store block sequences and alignments",
+    )
+    return parser.parse_args()
+
+
+def cache_dir(fname):
+    """name of the cache directory of a pangraph .json file"""
+    return pathlib.Path(fname).with_suffix(".cache")
+
+
+def source_signature(fname):
+    """size and modification time of the source file, used to detect stale
+    caches"""
+    st = os.stat(fname)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def is_fresh(fname, alignments=False):
+    """check whether the cache of a pangraph file exists and is up to date"""
+    meta_file = cache_dir(fname) / "meta.json"
+    if not meta_file.exists():
+        return False
+    with open(meta_file, "r") as f:
+        meta = json.load(f)
+    if alignments and not meta["alignments"]:
+        return False
+    return meta["source"] == source_signature(fname)
+
+
+def build_cache(fname, alignments=False):
+    """parses the pangraph .json file and writes its columnar cache. The cache
+    is written in a temporary directory that is then renamed, so that
+    concurrent builds do not corrupt it. A previous cache is renamed aside
+    before being removed, so that the cache is missing only between the two
+    renames."""
+    with open(fname, "r") as f:
+        pan_json = json.load(f)
+
+    blocks, paths = pan_json["blocks"], pan_json["paths"]
+    block_ids = np.array([b["id"] for b in blocks])
+    block_idx = {b: n for n, b in enumerate(block_ids)}
+
+    # paths as concatenated arrays of block indices and strands
+    path_len = np.array([len(p["blocks"]) for p in paths], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(path_len)])
+    path_blocks = np.array(
+        [block_idx[b["id"]] for p in paths for b in p["blocks"]], dtype=np.int32
+    )
+    path_strands = np.array([b["strand"] for p in paths for b in p["blocks"]], bool)
+
+    # block counts and n. of paths in which each block is present
+    B = len(block_ids)
+    path_of = np.repeat(np.arange(len(paths)), path_len)
+    count = np.bincount(path_blocks, minlength=B)
+    pairs = np.unique(path_of.astype(np.int64) * B + path_blocks)
+    nstrains = np.bincount(pairs % B, minlength=B)
+
+    columns = {
+        "block_ids": block_ids,
+        "block_len": np.array([len(b["sequence"]) for b in blocks], dtype=np.int64),
+        "block_count": count,
+        "block_nstrains": nstrains,
+        "path_names": np.array([p["name"] for p in paths]),
+        "path_circular": np.array([p["circular"] for p in paths], dtype=bool),
+        "path_offsets": offsets,
+        "path_blocks": path_blocks,
+        "path_strands": path_strands,
+    }
+
+    out = cache_dir(fname)
+    tmp = out.with_name(f"{out.name}.tmp-{os.getpid()}")
+    tmp.mkdir(parents=True, exist_ok=True)
+    for name, col in columns.items():
+        np.save(tmp / f"{name}.npy", col)
+
+    if alignments:
+        # consensus sequences, concatenated as bytes
+        seqs = [b["sequence"].encode() for b in blocks]
+        np.save(tmp / "block_seq.npy", np.frombuffer(b"".join(seqs), dtype=np.uint8))
+        seq_off = np.concatenate([[0], np.cumsum([len(s) for s in seqs])])
+        np.save(tmp / "block_seq_offsets.npy", seq_off)
+        # alignment information, one json line per block
+        aln_off = [0]
+        with open(tmp / "block_aln.jsonl", "wb") as f:
+            for b in blocks:
+                aln = {k: v for k, v in b.items() if k not in ["id", "sequence"]}
+                line = (json.dumps(aln) + "\n").encode()
+                f.write(line)
+                aln_off.append(aln_off[-1] + len(line))
+        np.save(tmp / "block_aln_offsets.npy", np.array(aln_off, dtype=np.int64))
+
+    meta = {"source": source_signature(fname), "alignments": alignments}
+    with open(tmp / "meta.json", "w") as f:
+        json.dump(meta, f)
+
+    # replace previous cache, if any, by renaming it aside first
+    old = out.with_name(f"{out.name}.old-{os.getpid()}")
+    try:
+        os.rename(out, old)
+    except FileNotFoundError:
+        old = None
+    try:
+        os.rename(tmp, out)
+    except OSError:
+        if not out.exists():
+            raise
+        # another process completed the cache first
+        shutil.rmtree(tmp, ignore_errors=True)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+# structural characters, end of a string, separators between array items and
+# start of the value of an object key
+_JSON_TOKEN = re.compile(r'["\[\]{}]')
+_JSON_STRING_END = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+_JSON_ITEM_SEP = re.compile(r"[\s,]*")
+_JSON_ARRAY_START = re.compile(r"\s*:\s*\[")
+
+
+def iter_json_array(fname, key, chunk_size=2**24):
+    """iterates over the items of the array `key` of the top-level object of a
+    json file, decoding one item at a time. The file is read in chunks of
+    `chunk_size` characters and the rest of the file is scanned without being
+    decoded, so that memory is bounded by the chunk size and the size of the
+    largest item."""
+    decoder = json.JSONDecoder()
+    buf, pos, depth, eof, in_array = "", 0, 0, False, False
+    with open(fname, "r") as f:
+        while True:
+            if in_array:
+                # decode the next item, unless it is truncated
+                pos = _JSON_ITEM_SEP.match(buf, pos).end()
+                if pos < len(buf) and buf[pos] == "]":
+                    return
+                if pos < len(buf):
+                    try:
+                        item, end = decoder.raw_decode(buf, pos)
+                        if end < len(buf) or eof:
+                            pos = end
+                            yield item
+                            continue
+                    except json.JSONDecodeError:
+                        if eof:
+                            raise
+            else:
+                # skip strings and track the depth, until the key is found
+                m = _JSON_TOKEN.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                elif m.group() != '"':
+                    depth += 1 if m.group() in "[{" else -1
+                    pos = m.end()
+                    continue
+                else:
+                    e = _JSON_STRING_END.match(buf, m.end())
+                    # wait for more data if the string or what follows is cut
+                    if e is not None and (eof or len(buf) - e.end() > 64):
+                        pos = e.end()
+                        if depth == 1 and buf[m.end() : pos - 1] == key:
+                            a = _JSON_ARRAY_START.match(buf, pos)
+                            if a is not None:
+                                pos, in_array, depth = a.end(), True, 2
+                        continue
+            if eof:
+                raise ValueError(f"array {key} not found or truncated in {fname}")
+            chunk = f.read(chunk_size)
+            eof = chunk == ""
+            buf, pos = buf[pos:] + chunk, 0
+
+
+def iter_block_stats(fname, batch_size=2**16):
+    """iterates over batches of blocks of a pangraph .json file, streaming the
+    file. Returns pairs of arrays (block length, n. of isolates in which the
+    block is present)."""
+    Ls, Ns = [], []
+    for b in iter_json_array(fname, "blocks"):
+        Ls.append(len(b["sequence"]))
+        Ns.append(len({p[0]["name"] for p in b["positions"]}))
+        if len(Ls) == batch_size:
+            yield np.array(Ls, dtype=np.int64), np.array(Ns, dtype=np.int64)
+            Ls, Ns = [], []
+    if len(Ls) > 0:
+        yield np.array(Ls, dtype=np.int64), np.array(Ns, dtype=np.int64)
+
+
+def load_pangraph(fname, alignments=False):
+    """loads a pangraph from its binary cache, building the cache first if it
+    does not exist or is outdated. Accepts either the .json file or the .cache
+    directory."""
+    fname = pathlib.Path(fname)
+    if fname.suffix == ".cache":
+        return PangraphCache(fname)
+    if not is_fresh(fname, alignments=alignments):
+        build_cache(fname, alignments=alignments)
+    return PangraphCache(cache_dir(fname))
+
+
+class PangraphCache:
+    """Lazy loader for the columnar cache of a pangraph. Each column is
+    memory-mapped the first time it is accessed."""
+
+    def __init__(self, cache_path):
+        self.cache_path = pathlib.Path(cache_path)
+        self.paths = CachedPathCollection(self)
+
+    def _column(self, name):
+        return np.load(self.cache_path / f"{name}.npy", mmap_mode="r")
+
+    @cached_property
+    def block_ids(self):
+        return self._column("block_ids")
+
+    @cached_property
+    def block_len(self):
+        return self._column("block_len")
+
+    @cached_property
+    def block_count(self):
+        return self._column("block_count")
+
+    @cached_property
+    def block_nstrains(self):
+        return self._column("block_nstrains")
+
+    @cached_property
+    def block_idx(self):
+        """dictionary block id -> block index"""
+        return {b: n for n, b in enumerate(self.block_ids)}
+
+    @cached_property
+    def path_names(self):
+        return self._column("path_names")
+
+    @cached_property
+    def path_circular(self):
+        return self._column("path_circular")
+
+    @cached_property
+    def path_offsets(self):
+        return self._column("path_offsets")
+
+    @cached_property
+    def path_blocks(self):
+        return self._column("path_blocks")
+
+    @cached_property
+    def path_strands(self):
+        return self._column("path_strands")
+
+    def strains(self):
+        """Return lists of strain names"""
+        return np.array(self.path_names)
+
+    def block_sequence(self, block_id):
+        """consensus sequence of a block (requires cached alignments)"""
+        n = self.block_idx[block_id]
+        off = self._column("block_seq_offsets")
+        seq = self._column("block_seq")[off[n] : off[n + 1]]
+        return seq.tobytes().decode()
+
+    def block_alignment(self, block_id):
+        """alignment information of a block, as in the pangraph .json file
+        (requires cached alignments)"""
+        n = self.block_idx[block_id]
+        off = self._column("block_aln_offsets")
+        with open(self.cache_path / "block_aln.jsonl", "rb") as f:
+            f.seek(off[n])
+            return json.loads(f.read(off[n + 1] - off[n]))
+
+    def to_paths_dict(self):
+        """dictionary strain name -> array of block ids"""
+        return {p.name: p.block_ids for p in self.paths}
+
+    def to_blockcount_df(self):
+        """dataframe (strains x blocks) with the number of occurrences of each
+        block in each strain"""
+        N, B = len(self.path_names), len(self.block_ids)
+        rows = np.repeat(np.arange(N), np.diff(self.path_offsets))
+        counts = np.zeros((N, B), dtype=int)
+        np.add.at(counts, (rows, self.path_blocks), 1)
+        return pd.DataFrame(counts, index=self.strains(), columns=self.block_ids)
+
+    def to_blockstats_df(self):
+        """dataframe with block statistics, as in pypangraph: count, n. strains,
+        len, duplicated and core"""
+        df = pd.DataFrame(
+            {
+                "count": self.block_count,
+                "n. strains": self.block_nstrains,
+                "len": self.block_len,
+            },
+            index=np.array(self.block_ids),
+        )
+        df["duplicated"] = df["count"] > df["n. strains"]
+        df["core"] = (df["n. strains"] == len(self.path_names)) & (~df["duplicated"])
+        return df
+
+
+class CachedPathCollection:
+    """Collection of paths of a cached pangraph, that can be iterated or indexed
+    by path name or position."""
+
+    def __init__(self, pan):
+        self.pan = pan
+
+    @cached_property
+    def id_to_pos(self):
+        return {name: n for n, name in enumerate(self.pan.path_names)}
+
+    def __len__(self):
+        return len(self.pan.path_names)
+
+    def __iter__(self):
+        return (CachedPath(self.pan, n) for n in range(len(self)))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, str):
+            idx = self.id_to_pos[idx]
+        return CachedPath(self.pan, idx)
+
+
+class CachedPath:
+    """View on a single path of a cached pangraph. Has attributes name,
+    circular, block_idx (block indices), block_ids and block_strands."""
+
+    def __init__(self, pan, n):
+        self.pan = pan
+        self.name = pan.path_names[n]
+        self.circular = pan.path_circular[n]
+        b, e = pan.path_offsets[n], pan.path_offsets[n + 1]
+        self.block_idx = pan.path_blocks[b:e]
+        self.block_strands = pan.path_strands[b:e]
+
+    @property
+    def block_ids(self):
+        return self.pan.block_ids[self.block_idx]
+
+    def __len__(self):
+        return len(self.block_idx)
+
+    def __str__(self):
+        return f"path {self.name}, n. blocks = {len(self.block_idx)}"
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    prof = Profiler(inputs=[args.pangraph], outputs=[cache_dir(args.pangraph)])
+    prof.stage("build")
+    build_cache(args.pangraph, alignments=args.alignments)
+    prof.save()
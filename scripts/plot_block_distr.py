@@ -1,73 +1,124 @@
 import argparse
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
-import pypangraph as pp
+
+from pangraph_cache import cache_dir, is_fresh, iter_block_stats, load_pangraph
+from profiling import Profiler
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pangraph", type=str, help="pangraph file")
     parser.add_argument("--fig", type=str, help="output figure")
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default=None,
+        help="optional output table of the histograms (.tsv)",
+    )
     return parser.parse_args()
 
 
-def plot_block_distr(Ls, Ns, fig_savename):
-    """plot block length and frequency distributions"""
-
-    Nmax = Ns.max()
+# bins of the block length distribution
+LEN_BINS = np.logspace(0, 6, 100)
+
+
+def block_batches(fname, batch_size=2**20):
+    """iterates over batches (block lengths, n. of isolates) of the blocks of a
+    pangraph. Columns are read from the binary cache if it is up to date,
+    otherwise the .json file is streamed without building the cache."""
+    if not is_fresh(fname):
+        yield from iter_block_stats(fname, batch_size)
+        return
+    pan = load_pangraph(fname)
+    Ls, Ns = pan.block_len, pan.block_nstrains
+    for b in range(0, len(Ls), batch_size):
+        yield np.asarray(Ls[b : b + batch_size]), np.asarray(Ns[b : b + batch_size])
+
+
+def block_histograms(batches):
+    """accumulates the histograms of block length and of n. of isolates over
+    batches of blocks, both as n. of blocks and as total block size. Returns a
+    dataframe with one row per bin (distr, bin_left, bin_right, n_blocks,
+    block_size), in which the n. of isolates has one bin per integer value."""
+    len_n = np.zeros(len(LEN_BINS) - 1, dtype=np.int64)
+    len_w = np.zeros(len(LEN_BINS) - 1, dtype=np.int64)
+    freq_n, freq_w = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    for Ls, Ns in batches:
+        len_n += np.histogram(Ls, bins=LEN_BINS)[0]
+        len_w += np.histogram(Ls, bins=LEN_BINS, weights=Ls)[0].astype(np.int64)
+        K = max(len(freq_n), Ns.max(initial=-1) + 1)
+        freq_n = np.bincount(Ns, minlength=K) + np.pad(freq_n, (0, K - len(freq_n)))
+        w = np.bincount(Ns, weights=Ls, minlength=K).astype(np.int64)
+        freq_w = w + np.pad(freq_w, (0, K - len(freq_w)))
+    K = len(freq_n)
+    return pd.DataFrame(
+        {
+            "distr": ["len"] * len(len_n) + ["n_isolates"] * K,
+            "bin_left": np.r_[LEN_BINS[:-1], np.arange(K) - 0.5],
+            "bin_right": np.r_[LEN_BINS[1:], np.arange(K) + 0.5],
+            "n_blocks": np.r_[len_n, freq_n],
+            "block_size": np.r_[len_w, freq_w],
+        }
+    )
+
+
+def plot_block_distr(hist, fig_savename):
+    """plot cumulative block length and frequency distributions, given the
+    histograms of `block_histograms`"""
+
+    H_len = hist[hist["distr"] == "len"]
+    H_freq = hist[hist["distr"] == "n_isolates"]
+    Nmax = len(H_freq) - 1
 
     fig, axs = plt.subplots(1, 2, figsize=(10, 5))
 
-    kwargs = {"cumulative": True, "histtype": "step"}
+    def __cumulative_steps(ax, H):
+        edges = np.r_[H["bin_left"].to_numpy(), H["bin_right"].iloc[-1]]
+        ax.stairs(np.cumsum(H["n_blocks"]), edges, color="C0")
+        ax.set_ylabel("n. blocks", color="C0")
+        axt = ax.twinx()
+        axt.stairs(np.cumsum(H["block_size"]), edges, color="C3")
+        axt.set_ylabel("block size", color="C3")
 
     # block length distribution
     ax = axs[0]
-    bins = np.logspace(0, 6, 100)
-
-    ax.hist(Ls, bins=bins, color="C0", **kwargs)
-    ax.set_ylabel("n. blocks", color="C0")
+    __cumulative_steps(ax, H_len)
     ax.set_xlabel("block length (bp)")
     ax.set_title("cumulative block length distr.")
-
-    axt = ax.twinx()
-    axt.hist(Ls, weights=Ls, bins=bins, color="C3", **kwargs)
-    axt.set_ylabel("block size", color="C3")
-
     ax.set_xscale("log")
     ax.set_xlim(1e1, 1e6)
 
     # block n. isolates distribution
     ax = axs[1]
-    bins = np.arange(Nmax + 2) - 0.5
-
-    ax.hist(Ns, bins=bins, color="C0", **kwargs)
-    ax.set_ylabel("n. blocks", color="C0")
+    __cumulative_steps(ax, H_freq)
     ax.set_xlabel("n. isolates")
     ax.set_title("cumulative block frequency distr.")
-
-    axt = ax.twinx()
-    axt.hist(Ns, weights=Ls, bins=bins, color="C3", **kwargs)
-    axt.set_ylabel("block size", color="C3")
     ax.set_xlim(0, Nmax + 1)
 
     plt.tight_layout()
-    plt.savefig("figs/block_distr.png", facecolor="white", dpi=300)
+    plt.savefig(fig_savename, facecolor="white", dpi=300)
     plt.close(fig)
 
 
 if __name__ == "__main__":
 
     args = parse_args()
-
-    # load pangraph
-    pan = pp.Pangraph.load_json(args.pangraph)
-
-    # dataframe with summary statistics for each block
-    df = pan.to_blockstats_df()
-
-    # vectors of block lengths and n. of strains in which the block is present
-    Ls = df["len"].to_numpy()
-    Ns = df["n. strains"].to_numpy()
+    prof = Profiler(
+        inputs=[args.pangraph, cache_dir(args.pangraph)],
+        outputs=[args.fig, args.summary],
+    )
+
+    # histograms of block lengths and n. of strains in which the block is
+    # present, accumulated over batches of blocks
+    prof.stage("load")
+    hist = block_histograms(block_batches(args.pangraph))
+    if args.summary is not None:
+        hist.to_csv(args.summary, sep="\t", index=False)
 
     # plot block length and frequency distributions
-    plot_block_distr(Ls, Ns, args.fig)
+    prof.stage("plot")
+    plot_block_distr(hist, args.fig)
+
+    prof.save()
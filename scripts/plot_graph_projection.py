@@ -3,7 +3,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 from collections import defaultdict
 
-import pypangraph as pp
+from pangraph_cache import cache_dir, load_pangraph
+from profiling import Profiler
 from pypangraph.pangraph_projector import PanProjector
 from pypangraph.visualization_projection import draw_projection
 
@@ -23,18 +24,8 @@ def parse_args():
     return parser.parse_args()
 
 
-if __name__ == "__main__":
-    args = parse_args()
-
-    pan = pp.Pangraph.load_json(args.pangraph)
-    i1, i2 = pan.strains()
-
-    # create projector
-    ppj = PanProjector(pan)
-
-    # project over the pair
-    pr = ppj.project(i1, i2, exclude_dupl=False)
-
+def plot_projection(pr, fig_savename):
+    """draws a pairwise projection, with random colors for duplicated blocks"""
     fig, ax = plt.subplots(1, 1, figsize=(5, 5))
 
     cdict = defaultdict(lambda: plt.get_cmap("rainbow")(np.random.rand()))
@@ -50,5 +41,28 @@ if __name__ == "__main__":
         s.set_visible(False)
 
     plt.tight_layout()
-    plt.savefig(args.fig, dpi=300, facecolor="white")
+    plt.savefig(fig_savename, dpi=300, facecolor="white")
     plt.close(fig)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    prof = Profiler(
+        inputs=[args.pangraph, cache_dir(args.pangraph)], outputs=[args.fig]
+    )
+
+    prof.stage("load")
+    pan = load_pangraph(args.pangraph)
+    i1, i2 = pan.strains()
+
+    # create projector
+    prof.stage("compute")
+    ppj = PanProjector(pan)
+
+    # project over the pair
+    pr = ppj.project(i1, i2, exclude_dupl=False)
+
+    prof.stage("plot")
+    plot_projection(pr, args.fig)
+
+    prof.save()
@@ -5,13 +5,27 @@ import matplotlib.pyplot as plt
 
 from Bio import Phylo
 
+from matrix_utils import load_matrix, upper_triangle_df, pooled_matrix
+from tree_utils import FlatTree
+from profiling import Profiler
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--tree", type=str, help="core-genome tree")
-    parser.add_argument("--dist_df", type=str, help="pairwise distance dataframe")
+    parser.add_argument("--dist_mat", type=str, help="pairwise distance matrix")
     parser.add_argument("--fig_scatter", type=str, help="output scatterplot")
     parser.add_argument("--fig_matrix", type=str, help="output distance matrix")
+    parser.add_argument(
+        "--max_matrix_size",
+        type=int,
+        default=500,
+        help="above this n. of isolates the matrix is downsampled to this size",
+    )
+    parser.add_argument("--pool", choices=["mean", "max"], default="mean")
+    parser.add_argument(
+        "--n_clades", type=int, default=20, help="n. of clade labels for large trees"
+    )
     return parser.parse_args()
 
 
@@ -32,13 +46,8 @@ def prune_tree(tree, keep_leaves):
 def add_tree_distances(tree, df):
     """add tree distances to dataframe"""
 
-    leaves_dict = {leaf.name: leaf for leaf in tree.get_terminals()}
-
-    df["tree_d"] = df.apply(
-        lambda x: tree.distance(leaves_dict[x["p1"]], leaves_dict[x["p2"]]),
-        axis=1,
-        result_type="expand",
-    )
+    ftree = FlatTree(tree)
+    df["tree_d"] = ftree.distance(df["p1"], df["p2"])
 
     return df
 
@@ -46,11 +55,8 @@ def add_tree_distances(tree, df):
 def scatterplot(df, fig_savename):
     """Produce a scatterplot of private sequence vs core genome tree distance"""
 
-    # only select one occurrence per pair
-    sdf = df[df["p1"] > df["p2"]]
-
     fig, ax = plt.subplots(1, 1, figsize=(4, 3))
-    ax.scatter(sdf["tree_d"], sdf["private_seq"] / 1000, alpha=0.4)
+    ax.scatter(df["tree_d"], df["private_seq"] / 1000, alpha=0.4)
     ax.set_xlabel("core genome tree distance")
     ax.set_ylabel("private sequence distance (kbp)")
     for s in ["top", "right"]:
@@ -98,28 +104,93 @@ def matrixplot(tree, M, fig_savename):
     plt.close(fig)
 
 
+def pooled_matrixplot(tree, isolates, M, fig_savename, size, how, n_clades):
+    """Plot a downsampled version of the private sequence distance matrix next
+    to the phylogenetic tree, for a large number of isolates. The matrix is
+    pooled over bins of isolates in tree order, and per-isolate labels are
+    replaced by labels for the main clades of the tree."""
+
+    # order of the matrix rows in the tree
+    ftree = FlatTree(tree)
+    row = {iso: n for n, iso in enumerate(isolates)}
+    order = [row[l] for l in ftree.leaf_names]
+    N = len(order)
+    P, _ = pooled_matrix(M, order, size, how=how)
+
+    fig, axs = plt.subplots(1, 2, figsize=(10, 5))
+
+    ax = axs[0]
+    Phylo.draw(tree, axes=ax, do_show=False, label_func=lambda x: "")
+    for k in ["top", "right", "left"]:
+        ax.spines[k].set_visible(False)
+    ax.set_ylabel("")
+    ax.set_yticks([])
+
+    # matrix in leaf coordinates
+    ax = axs[1]
+    g = ax.matshow(P / 1000, extent=(-0.5, N - 0.5, N - 0.5, -0.5))
+
+    # clade labels and boundaries
+    ticks, labels = [], []
+    for c in ftree.clades(n_clades):
+        b, e = ftree.leaf_range[c]
+        ticks.append((b + e - 1) / 2)
+        name = ftree.leaf_names[b]
+        labels.append(name if e - b == 1 else f"{name} (+{e - b - 1})")
+        if b > 0:
+            ax.axvline(b - 0.5, color="white", lw=0.5)
+            ax.axhline(b - 0.5, color="white", lw=0.5)
+    ax.set_xticks(ticks)
+    ax.set_xticklabels(labels, rotation=90)
+    ax.set_yticks([])
+    plt.colorbar(g, ax=ax, label="private seq. (kbp)", fraction=0.046, pad=0.04)
+
+    plt.tight_layout()
+    fig.subplots_adjust(wspace=-0.2, top=0.65)
+    plt.savefig(fig_savename, facecolor="white", dpi=150)
+    plt.close(fig)
+
+
 if __name__ == "__main__":
 
     args = parse_args()
+    prof = Profiler(
+        inputs=[args.dist_mat, args.tree], outputs=[args.fig_scatter, args.fig_matrix]
+    )
 
-    # load pairwise distance dataframe
-    dist_df = pd.read_csv(args.dist_df)
+    # load pairwise distance matrix
+    prof.stage("load")
+    isolates, M = load_matrix(args.dist_mat)
 
-    # list of selected isolates
-    isolates = dist_df["p1"].unique()
+    # dataframe of pairwise distances, with one entry per pair
+    dist_df = upper_triangle_df(isolates, M, "private_seq")
 
     # load tree and prune all non-selected sequences
     tree = Phylo.read(args.tree, "newick")
     tree = prune_tree(tree, isolates)
 
     # add tree distances to dataframe
+    prof.stage("compute")
     dist_df = add_tree_distances(tree, dist_df)
 
     # produce a scatter-plot of private sequence vs tree distance
+    prof.stage("plot")
     scatterplot(dist_df, args.fig_scatter)
 
-    # compute pairwise distance matrix
-    M = dist_df.pivot(index="p1", columns="p2", values="private_seq")
-
-    # plot distance matrix vs tree
-    matrixplot(tree, M, args.fig_matrix)
+    # plot distance matrix vs tree. Large matrices are downsampled.
+    if len(isolates) > args.max_matrix_size:
+        pooled_matrixplot(
+            tree,
+            isolates,
+            M,
+            args.fig_matrix,
+            args.max_matrix_size,
+            args.pool,
+            args.n_clades,
+        )
+    else:
+        # pairwise distance matrix, indexed by isolate name
+        M = pd.DataFrame(M, index=isolates, columns=isolates)
+        matrixplot(tree, M, args.fig_matrix)
+
+    prof.save()
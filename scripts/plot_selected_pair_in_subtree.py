@@ -2,6 +2,8 @@ import argparse
 import matplotlib.pyplot as plt
 from Bio import Phylo
 
+from profiling import Profiler
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -47,8 +49,10 @@ def prune_tree(tree, keep_leaves):
 if __name__ == "__main__":
 
     args = parse_args()
+    prof = Profiler(inputs=[args.tree], outputs=[args.fig])
 
     # load tree
+    prof.stage("load")
     tree = Phylo.read(args.tree, "newick")
 
     # prune tree
@@ -58,6 +62,7 @@ if __name__ == "__main__":
     i1, i2 = args.pair
 
     # plot the tree, highlighting the pair
+    prof.stage("plot")
     fig, ax = plt.subplots(1, 1, figsize=(5, 5))
     Phylo.draw(
         tree,
@@ -73,3 +78,5 @@ if __name__ == "__main__":
     plt.tight_layout()
     plt.savefig(args.fig, dpi=150, facecolor="white")
     plt.close(fig)
+
+    prof.save()
@@ -0,0 +1,290 @@
+import numpy as np
+from scipy import sparse
+
+from pairwise_executor import pairwise_matrix
+
+
+def presence_absence_matrix(pan):
+    """given a cached pangraph (see `pangraph_cache`), returns the array of path
+    names, the array of block ids, the boolean presence/absence matrix
+    (paths x blocks) and the vector of block lengths, in the same order as the
+    matrix columns"""
+    N, B = len(pan.path_names), len(pan.block_ids)
+    rows = np.repeat(np.arange(N), np.diff(pan.path_offsets))
+    PA = np.zeros((N, B), dtype=bool)
+    PA[rows, pan.path_blocks] = True
+    return pan.strains(), np.array(pan.block_ids), PA, np.array(pan.block_len)
+
+
+def private_seq_tile(arrays, i0, i1, j0, j1):
+    """tile kernel (see `pairwise_executor`) of the private sequence distance,
+    given the arrays `A` (presence/absence as float), `AL` (presence/absence
+    weighted by block length) and `tot` (total length of each path)"""
+    A, AL, tot = arrays["A"], arrays["AL"], arrays["tot"]
+    shared = AL[i0:i1] @ A[j0:j1].T
+    return np.rint(tot[i0:i1, None] + tot[None, j0:j1] - 2 * shared)
+
+
+def private_seq_matrix(PA, Ls, out=None, block_size=1024, threads=1):
+    """given a boolean presence/absence matrix (paths x blocks) and the vector of
+    block lengths, returns the matrix of pairwise private sequence distances.
+
+    The distance is evaluated as d(a,b) = L.a + L.b - 2 L.(a & b), where the last
+    term is computed with a matrix product over tiles of `block_size` rows and
+    columns of the upper triangle, evaluated in parallel on `threads`
+    processes. The result is written in `out` if provided (e.g. a memory
+    mapped array), otherwise a new int64 matrix is allocated."""
+    N = PA.shape[0]
+
+    # float64 represents integer lengths exactly up to 2^53
+    A = PA.astype(np.float64)
+    AL = A * np.asarray(Ls, dtype=np.float64)
+    arrays = {"A": A, "AL": AL, "tot": AL.sum(axis=1)}
+
+    return pairwise_matrix(
+        private_seq_tile,
+        arrays,
+        N,
+        out=out,
+        dtype=np.int64,
+        threads=threads,
+        tile_size=block_size,
+    )
+
+
+class PresenceAbsence:
+    """Sparse presence/absence of blocks in paths, in CSR format: the (sorted)
+    indices of the blocks present in path n are `indices[indptr[n]:indptr[n+1]]`.
+    Blocks are weighted by their length, and the weighted set operations
+    between paths (intersection, symmetric difference, size) return the total
+    length of the blocks in the result. Memory scales with the number of block
+    occurrences, instead of n. paths x n. blocks."""
+
+    def __init__(self, indptr, indices, Ls):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.Ls = np.asarray(Ls, dtype=np.int64)
+        self.N = len(self.indptr) - 1
+
+    @classmethod
+    def from_paths(cls, path_blocks, path_offsets, Ls):
+        """build from the concatenated arrays of block indices of all paths and
+        the (n. paths + 1) offsets of each path in the array"""
+        B = len(Ls)
+        N = len(path_offsets) - 1
+        rows = np.repeat(np.arange(N, dtype=np.int64), np.diff(path_offsets))
+        # unique (path, block) pairs, sorted by path and then block
+        key = np.unique(rows * B + np.asarray(path_blocks, dtype=np.int64))
+        indptr = np.searchsorted(key, np.arange(N + 1) * B)
+        return cls(indptr, key % B, Ls)
+
+    @classmethod
+    def from_pangraph(cls, pan):
+        """build from a cached pangraph (see `pangraph_cache`)"""
+        return cls.from_paths(pan.path_blocks, pan.path_offsets, pan.block_len)
+
+    def blocks(self, n):
+        """sorted indices of the blocks present in path n"""
+        return self.indices[self.indptr[n] : self.indptr[n + 1]]
+
+    def popcount(self, n):
+        """number of blocks present in path n"""
+        return self.indptr[n + 1] - self.indptr[n]
+
+    def rows(self):
+        """path index of each entry of `indices`"""
+        return np.repeat(np.arange(self.N), np.diff(self.indptr))
+
+    def weight(self, n=None):
+        """total length of the blocks present in path n, or in each path"""
+        if n is None:
+            W = np.bincount(self.rows(), self.Ls[self.indices], minlength=self.N)
+            return np.rint(W).astype(np.int64)
+        return self.Ls[self.blocks(n)].sum()
+
+    def weighted_and(self, i, j):
+        """total length of the blocks present in both paths"""
+        common = np.intersect1d(self.blocks(i), self.blocks(j), assume_unique=True)
+        return self.Ls[common].sum()
+
+    def weighted_xor(self, i, j):
+        """total length of the blocks present in only one of the two paths"""
+        private = np.setxor1d(self.blocks(i), self.blocks(j), assume_unique=True)
+        return self.Ls[private].sum()
+
+    def counts(self):
+        """number of paths in which each block is present"""
+        return np.bincount(self.indices, minlength=len(self.Ls))
+
+    def accessory(self):
+        """presence/absence restricted to blocks that are absent from at least
+        one path. Blocks present in all paths do not contribute to differences
+        between paths."""
+        keep = (self.counts() < self.N)[self.indices]
+        indptr = np.r_[0, np.cumsum(np.bincount(self.rows()[keep], minlength=self.N))]
+        return PresenceAbsence(indptr, self.indices[keep], self.Ls)
+
+    def to_csr(self, weighted=False):
+        """scipy sparse matrix (paths x blocks), with entries equal to one or to
+        the block length if `weighted`"""
+        data = self.Ls[self.indices] if weighted else np.ones(len(self.indices), int)
+        shape = (self.N, len(self.Ls))
+        return sparse.csr_matrix((data, self.indices, self.indptr), shape=shape)
+
+    def to_dense(self):
+        """dense boolean presence/absence matrix (paths x blocks)"""
+        PA = np.zeros((self.N, len(self.Ls)), dtype=bool)
+        PA[self.rows(), self.indices] = True
+        return PA
+
+    def arrays(self):
+        """dictionary of the arrays of the structure"""
+        return {"indptr": self.indptr, "indices": self.indices, "Ls": self.Ls}
+
+
+def sparse_private_seq_tile(arrays, i0, i1, j0, j1):
+    """tile kernel (see `pairwise_executor`) of the private sequence distance,
+    given the arrays of a `PresenceAbsence` and the total length `tot` of the
+    blocks in each path"""
+    indptr, indices, Ls, tot = (arrays[k] for k in ["indptr", "indices", "Ls", "tot"])
+
+    def __rows(a, b, weighted):
+        ptr = indptr[a : b + 1]
+        idx = indices[ptr[0] : ptr[-1]]
+        data = Ls[idx] if weighted else np.ones(len(idx), dtype=np.int64)
+        return sparse.csr_matrix((data, idx, ptr - ptr[0]), shape=(b - a, len(Ls)))
+
+    shared = (__rows(i0, i1, True) @ __rows(j0, j1, False).T).toarray()
+    return tot[i0:i1, None] + tot[None, j0:j1] - 2 * shared
+
+
+def sparse_private_seq_matrix(pa, out=None, block_size=1024, threads=1, rows=None):
+    """same as `private_seq_matrix`, but given a sparse `PresenceAbsence`. Blocks
+    present in all paths are dropped, and the length-weighted intersections are
+    evaluated with sparse matrix products in integer arithmetic, without
+    creating the dense presence/absence matrix. If `rows` is passed, only these
+    rows and columns of `out` are evaluated."""
+    pa = pa.accessory()
+    arrays = {**pa.arrays(), "tot": pa.weight()}
+    return pairwise_matrix(
+        sparse_private_seq_tile,
+        arrays,
+        pa.N,
+        out=out,
+        dtype=np.int64,
+        threads=threads,
+        tile_size=block_size,
+        rows=rows,
+    )
+
+
+def uniform_hash(x, seed=0):
+    """deterministic hash of an array of non-negative integers to uniform
+    floats in (0, 1), with the splitmix64 finalizer"""
+    z = np.asarray(x, dtype=np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+    z = z + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    return ((z >> np.uint64(11)).astype(np.float64) + 0.5) / 2.0**53
+
+
+def weighted_minhash_sketch(pa, n_hashes=128, seed=0, chunk_size=2**16):
+    """length-weighted MinHash sketch of each path, given a `PresenceAbsence`.
+    For each of the `n_hashes` hash functions every block receives an
+    exponential rank with rate equal to its length, and the sketch of a path
+    contains the index of the present block with minimum rank (or -1 if the
+    path is empty). For two paths A and B, the probability that a hash has the
+    same minimum is then the weighted Jaccard index J = L(A & B) / L(A | B).
+
+    Ranks are hashed from (block, hash function) and not stored, and the sketch
+    is built in a single pass over chunks of about `chunk_size` block
+    occurrences, so that its cost is linear in the size of the graph."""
+    K = n_hashes
+    sketch = np.full((pa.N, K), -1, dtype=np.int64)
+    Ls = np.maximum(pa.Ls, 1).astype(np.float64)
+    k = np.arange(K, dtype=np.uint64)
+
+    # chunks of consecutive non-empty paths
+    paths = np.flatnonzero(np.diff(pa.indptr) > 0)
+    first = pa.indptr[paths]
+    b = 0
+    while b < len(paths):
+        e = max(np.searchsorted(first, first[b] + chunk_size), b + 1)
+        rows = paths[b:e]
+        starts = pa.indptr[rows] - pa.indptr[rows[0]]
+        idx = pa.indices[pa.indptr[rows[0]] : pa.indptr[rows[-1] + 1]]
+
+        # exponential ranks (occurrences x hash functions), and minimum per path
+        u = uniform_hash(idx.astype(np.uint64)[:, None] * np.uint64(K) + k, seed)
+        rank = -np.log(u) / Ls[idx, None]
+        min_rank = np.minimum.reduceat(rank, starts, axis=0)
+
+        # block with the minimum rank
+        occ_row = np.repeat(np.arange(len(rows)), np.diff(np.r_[starts, len(idx)]))
+        o, h = np.nonzero(rank == min_rank[occ_row])
+        sketch[rows[occ_row[o]], h] = idx[o]
+        b = e
+    return sketch
+
+
+def sketch_tile_counts(sketch, i0, i1, j0, j1):
+    """n. of hash functions with the same minimum block, for all pairs of paths
+    in a tile"""
+    Si, Sj = sketch[i0:i1], sketch[j0:j1]
+    equal = np.zeros((i1 - i0, j1 - j0), dtype=np.int64)
+    for k in range(sketch.shape[1]):
+        equal += Si[:, k, None] == Sj[None, :, k]
+    return equal
+
+
+def sketch_private_seq_tile(arrays, i0, i1, j0, j1):
+    """tile kernel (see `pairwise_executor`) of the approximate private sequence
+    distance, given the `sketch` of each path and the total length `tot` of its
+    blocks"""
+    tot, sketch = arrays["tot"], arrays["sketch"]
+    J = sketch_tile_counts(sketch, i0, i1, j0, j1) / sketch.shape[1]
+    S = tot[i0:i1, None] + tot[None, j0:j1]
+    return np.rint(S * (1 - J) / (1 + J))
+
+
+def sketch_error_bound(tot_a, tot_b, n_hashes, delta=0.05):
+    """bound on the absolute error of the approximate private sequence distance
+    of two paths with total (accessory) lengths `tot_a` and `tot_b`, that holds
+    with probability at least 1 - delta for sketches of `n_hashes` hashes.
+
+    The estimated Jaccard index is an average of `n_hashes` independent
+    indicators, so by Hoeffding's inequality |J' - J| <= eps with
+    eps = sqrt(log(2 / delta) / (2 n_hashes)). Since the distance is
+    d = (L(A) + L(B)) (1 - J) / (1 + J) and the derivative of (1 - J) / (1 + J)
+    is at most 2 in absolute value, the error on the distance is at most
+    2 eps (L(A) + L(B)). The typical error is smaller, of the order of
+    (L(A) + L(B)) sqrt(J (1 - J) / n_hashes)."""
+    eps = np.sqrt(np.log(2 / delta) / (2 * n_hashes))
+    return 2 * eps * (np.asarray(tot_a) + np.asarray(tot_b))
+
+
+def approx_private_seq_matrix(
+    pa, n_hashes=128, seed=0, out=None, block_size=256, threads=1, rows=None
+):
+    """approximate version of `sparse_private_seq_matrix` for very large
+    collections, from weighted MinHash sketches (see `weighted_minhash_sketch`)
+    of the blocks that are not present in all paths. The distance is estimated
+    as (L(A) + L(B)) (1 - J) / (1 + J), where the total lengths L are exact and
+    the weighted Jaccard index J is estimated from the sketches, with the error
+    bound of `sketch_error_bound`. The cost is linear in the size of the graph
+    for the sketches, and O(n_hashes) per pair. If `rows` is passed, only these
+    rows and columns of `out` are evaluated."""
+    pa = pa.accessory()
+    sketch = weighted_minhash_sketch(pa, n_hashes, seed)
+    arrays = {"sketch": sketch, "tot": pa.weight()}
+    return pairwise_matrix(
+        sketch_private_seq_tile,
+        arrays,
+        pa.N,
+        out=out,
+        dtype=np.int64,
+        threads=threads,
+        tile_size=block_size,
+        rows=rows,
+    )
@@ -0,0 +1,59 @@
+# Runs an external command (pangraph, minimap2, mafft, bandage) and, if
+# profiling is enabled (see `profiling.py`), saves a sidecar with the same
+# schema as the analysis scripts, with a single `run` stage. The command and its
+# arguments follow `--`, and its standard output can be redirected to a file:
+#
+#   python3 scripts/profile_cmd.py --name "pangraph build" --inputs in.fa \
+#       --outputs out.json --stdout out.json -- pangraph build in.fa
+#
+# Pipelines are run with `bash -c "..."`. The exit status of the command is
+# returned, and no sidecar is saved if the command fails.
+
+import argparse
+import subprocess
+import sys
+
+from profiling import Profiler
+
+
+def parse_args(argv):
+    if "--" not in argv:
+        sys.exit("error: the command must follow --")
+    sep = argv.index("--")
+    parser = argparse.ArgumentParser(
+        description="run an external command and profile it"
+    )
+    parser.add_argument("--name", type=str, required=True, help="name of the tool")
+    parser.add_argument("--inputs", type=str, nargs="*", default=[])
+    parser.add_argument("--outputs", type=str, nargs="+", required=True)
+    parser.add_argument(
+        "--stdout", type=str, default=None, help="redirect the standard output"
+    )
+    args = parser.parse_args(argv[:sep])
+    args.cmd = argv[sep + 1 :]
+    if len(args.cmd) == 0:
+        parser.error("empty command")
+    return args
+
+
+def run(cmd, stdout=None):
+    """runs the command, returns its exit status"""
+    if stdout is None:
+        return subprocess.run(cmd).returncode
+    with open(stdout, "w") as f:
+        return subprocess.run(cmd, stdout=f).returncode
+
+
+if __name__ == "__main__":
+
+    args = parse_args(sys.argv[1:])
+    prof = Profiler(
+        inputs=args.inputs, outputs=args.outputs, script=args.name, children=True
+    )
+
+    prof.stage("run")
+    status = run(args.cmd, args.stdout)
+    if status != 0:
+        sys.exit(status)
+
+    prof.save()
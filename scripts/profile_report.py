@@ -0,0 +1,180 @@
+# Aggregates the profiling sidecars saved by the scripts (see `profiling.py`)
+# into a single table, with one row per stage of each job. Jobs are connected
+# when an output of one is an input of another, and the critical path is the
+# chain of dependent jobs with the largest total wall time. Jobs on the critical
+# path are reported first, in order of execution.
+#
+# External tools run through `profile_cmd.py` save sidecars with the same schema
+# and are included. Targets of the workflow, and intermediate files consumed by
+# a profiled job, that were not produced by any profiled job are reported as
+# `unprofiled` rows: the critical path does not include their cost.
+
+import argparse
+import json
+import pathlib
+import pandas as pd
+
+from profiling import profile_dir
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="aggregate profiling sidecars into a critical-path report"
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=str(profile_dir()),
+        help="folder of the sidecars, default $WCS_PROFILE_DIR or results/profile",
+    )
+    parser.add_argument("--report", type=str, required=True, help="output tsv")
+    parser.add_argument(
+        "--targets", type=str, nargs="*", default=[], help="targets of the workflow"
+    )
+    parser.add_argument(
+        "--output_dirs",
+        type=str,
+        nargs="*",
+        default=["results", "figs"],
+        help="folders of the workflow outputs, for the coverage check",
+    )
+    return parser.parse_args()
+
+
+def load_sidecars(profile_dir):
+    """list of job records from the json sidecars in the profiling folder"""
+    jobs = []
+    for fname in sorted(pathlib.Path(profile_dir).rglob("*.json")):
+        with open(fname, "r") as f:
+            jobs.append(json.load(f))
+    return jobs
+
+
+def producers(jobs):
+    """dictionary output file -> index of the job that produced it"""
+    return {
+        str(pathlib.PurePath(o)): i
+        for i, job in enumerate(jobs)
+        for o in job["outputs"]
+    }
+
+
+def find_producer(producer, fname):
+    """index of the job that produced a file (or a folder containing it), or
+    None"""
+    for p in [pathlib.PurePath(fname), *pathlib.PurePath(fname).parents]:
+        if str(p) in producer:
+            return producer[str(p)]
+    return None
+
+
+def unprofiled_files(jobs, targets=(), output_dirs=("results", "figs")):
+    """sorted list of files without a profiled producer: the targets, and the
+    inputs of profiled jobs that are workflow outputs (in one of
+    `output_dirs`)"""
+    producer = producers(jobs)
+    dirs = [pathlib.PurePath(d) for d in output_dirs]
+    files = set(targets)
+    for job in jobs:
+        for x in job["inputs"]:
+            if any(d in pathlib.PurePath(x).parents for d in dirs):
+                files.add(x)
+    return sorted(f for f in files if find_producer(producer, f) is None)
+
+
+def critical_path(jobs):
+    """returns the indices of the jobs on the critical path, in execution
+    order. Job j depends on job i if one of the outputs of i is an input of j
+    (or contains it, for directory outputs)."""
+
+    producer = producers(jobs)
+
+    def __dependencies(job):
+        deps = {find_producer(producer, x) for x in job["inputs"]}
+        return deps - {None}
+
+    deps = [__dependencies(job) - {j} for j, job in enumerate(jobs)]
+
+    # longest path by wall time, memoized over the (acyclic) dependency graph
+    best, prev = {}, {}
+
+    def __longest(j):
+        if j not in best:
+            best[j], prev[j] = jobs[j]["wall_s"], None
+            for i in deps[j]:
+                w = __longest(i) + jobs[j]["wall_s"]
+                if w > best[j]:
+                    best[j], prev[j] = w, i
+        return best[j]
+
+    if len(jobs) == 0:
+        return []
+    end = max(range(len(jobs)), key=__longest)
+    path = []
+    while end is not None:
+        path.append(end)
+        end = prev[end]
+    return path[::-1]
+
+
+def report_table(jobs, unprofiled=()):
+    """table with one row per stage of each job. Jobs on the critical path come
+    first, with the cumulative wall time along the path. Files without a
+    profiled producer are appended as `unprofiled` rows with no measures."""
+    path = critical_path(jobs)
+    on_path = set(path)
+    others = sorted(set(range(len(jobs))) - on_path, key=lambda j: -jobs[j]["wall_s"])
+
+    rows, cum = [], 0.0
+    for j in path + others:
+        job = jobs[j]
+        if j in on_path:
+            cum += job["wall_s"]
+        for s in job["stages"]:
+            rows.append(
+                {
+                    "script": job["script"],
+                    "output": job["outputs"][0] if job["outputs"] else "",
+                    "stage": s["stage"],
+                    "wall_s": s["wall_s"],
+                    "cpu_s": s["cpu_s"],
+                    "peak_rss_mb": s["peak_rss_mb"],
+                    "job_wall_s": job["wall_s"],
+                    "critical_path": j in on_path,
+                    "path_wall_s": cum if j in on_path else None,
+                }
+            )
+    for f in unprofiled:
+        rows.append(
+            {"script": "", "output": f, "stage": "unprofiled", "critical_path": False}
+        )
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    # load sidecars
+    jobs = load_sidecars(args.profile_dir)
+    if len(jobs) == 0:
+        print(f"warning: no sidecars in {args.profile_dir}. Set WCS_PROFILE=1.")
+
+    unprofiled = unprofiled_files(jobs, args.targets, args.output_dirs)
+    df = report_table(jobs, unprofiled)
+    df.to_csv(args.report, sep="\t", index=False, float_format="%.3f")
+
+    # print a summary of the critical path
+    if len(jobs) > 0:
+        crit = df[df["critical_path"]].groupby(["script", "output"], sort=False)
+        print("critical path:")
+        for (script, output), g in crit:
+            print(f"  {g['job_wall_s'].iloc[0]:8.2f} s  {script}  ->  {output}")
+        print(f"total: {df['path_wall_s'].max():.2f} s")
+
+    # files whose producing job was not measured
+    if len(unprofiled) > 0:
+        print(f"warning: {len(unprofiled)} files have no profiled producer,")
+        print("the critical path does not include their cost:")
+        for f in unprofiled:
+            print(f"  {f}")
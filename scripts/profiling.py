@@ -0,0 +1,146 @@
+# Lightweight instrumentation of the analysis scripts. A script declares its
+# inputs and outputs and marks the beginning of each named stage (e.g. load,
+# compute, write, plot). For each stage the wall time, the cpu time (including
+# terminated child processes) and the peak resident memory are recorded.
+#
+# Profiling is disabled by default, and is enabled by setting the environment
+# variable `WCS_PROFILE=1`. In this case a json sidecar file is saved for each
+# job in the profiling folder (`WCS_PROFILE_DIR`, default `results/profile`),
+# with the same path as the first output of the job and `.json` extension.
+# Sidecars are aggregated by `profile_report.py`.
+#
+# External tools (pangraph, minimap2, mafft, bandage) are run through
+# `profile_cmd.py`, which writes a sidecar with the same schema. For these jobs
+# the peak memory is the one of the largest child process.
+
+import json
+import os
+import pathlib
+import resource
+import sys
+import time
+
+PROFILE_DIR = "results/profile"
+
+
+def is_enabled():
+    """whether profiling is enabled by the WCS_PROFILE environment variable"""
+    return os.environ.get("WCS_PROFILE", "0").lower() not in ("", "0", "false", "no")
+
+
+def profile_dir():
+    return pathlib.Path(os.environ.get("WCS_PROFILE_DIR", PROFILE_DIR))
+
+
+def sidecar_file(output):
+    """path of the sidecar file for a job with the given first output"""
+    out = pathlib.Path(output)
+    if out.is_absolute():
+        out = out.relative_to(out.anchor)
+    return profile_dir() / f"{out}.json"
+
+
+def reset_peak_rss():
+    """resets the peak resident memory of the process (linux only). Returns
+    False if not supported, in which case the peak is the one of the whole
+    process lifetime."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """peak resident memory of the process, in MB"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on linux, and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 1024
+
+
+def children_peak_rss_mb():
+    """peak resident memory of the largest terminated child process, in MB"""
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 1024
+
+
+def cpu_time():
+    """cpu time of the process and of its terminated children"""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Profiler:
+    """Records wall time, cpu time and peak memory for a sequence of named
+    stages of a script. A new stage is started with `stage(name)`, which ends
+    the previous one, and `save()` ends the last stage and writes the sidecar.
+    If profiling is disabled all methods do nothing. With `children` the peak
+    memory also accounts for terminated child processes."""
+
+    def __init__(self, inputs=(), outputs=(), script=None, children=False):
+        self.enabled = is_enabled()
+        self.children = children
+        self.script = script or pathlib.Path(sys.argv[0]).stem
+        self.inputs = [str(i) for i in inputs if i is not None]
+        self.outputs = [str(o) for o in outputs if o is not None]
+        self.stages = []
+        self._current = None
+        if self.enabled:
+            self.t_start = time.time()
+
+    def stage(self, name):
+        """ends the current stage (if any) and starts a new one"""
+        if not self.enabled:
+            return
+        self._end()
+        reset_peak_rss()
+        self._current = (name, time.perf_counter(), cpu_time())
+
+    def _end(self):
+        if self._current is None:
+            return
+        name, wall, cpu = self._current
+        peak = peak_rss_mb()
+        if self.children:
+            peak = max(peak, children_peak_rss_mb())
+        self.stages.append(
+            {
+                "stage": name,
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": cpu_time() - cpu,
+                "peak_rss_mb": peak,
+            }
+        )
+        self._current = None
+
+    def save(self, outputs=None):
+        """ends the current stage and writes the json sidecar. The list of
+        outputs can be passed here if it is only known at the end."""
+        if not self.enabled:
+            return
+        if outputs is not None:
+            self.outputs = [str(o) for o in outputs]
+        self._end()
+        record = {
+            "script": self.script,
+            "argv": sys.argv,
+            "inputs": self.inputs,
+            "outputs": self.outputs,
+            "start": self.t_start,
+            "stages": self.stages,
+            "wall_s": sum(s["wall_s"] for s in self.stages),
+            "cpu_s": sum(s["cpu_s"] for s in self.stages),
+            "peak_rss_mb": max((s["peak_rss_mb"] for s in self.stages), default=0),
+        }
+        fname = sidecar_file(self.outputs[0] if self.outputs else self.script)
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        with open(fname, "w") as f:
+            json.dump(record, f, indent=2)
@@ -0,0 +1,279 @@
+# Local HTTP/JSON query server that keeps a pangraph resident in memory, for
+# interactive exploration without reloading the graph at every question.
+#
+# The graph is loaded once (from its binary cache) together with the block
+# statistics, the sparse block presence/absence of each path and a pairwise
+# projector. The server answers GET requests with JSON responses:
+#
+#   /strains                          names of the paths
+#   /block_stats?block=B              statistics of a block, or a summary of
+#                                     all blocks if `block` is omitted
+#   /private_seq?a=A&b=B              private sequence between two isolates
+#   /shared_path?a=A&b=B&anchor=C     shared path length from an anchor block
+#   /projection?a=A&b=B               summary of the pairwise projection
+#   /cache                            statistics of the response cache
+#
+# Responses are kept in a least-recently-used cache, and so are the shared path
+# indices of the last anchors queried. The server only binds to localhost by
+# default, e.g.:
+#
+#   python3 scripts/query_server.py --pangraph results/pangraph/subset.json
+#   curl "localhost:8765/private_seq?a=NZ_CP000001&b=NZ_CP000002"
+
+import argparse
+import asyncio
+import json
+import traceback
+import numpy as np
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+from pangraph_cache import load_pangraph
+from private_seq_utils import PresenceAbsence
+from shared_path_utils import AnchorSharedPaths
+from pypangraph.pangraph_projector import PanProjector
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="local query server over a pangraph kept in memory"
+    )
+    parser.add_argument("--pangraph", type=str, required=True, help="pangraph file")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=8765, help="port, 0 for any free port"
+    )
+    parser.add_argument(
+        "--cache_size", type=int, default=1024, help="n. of cached responses"
+    )
+    parser.add_argument(
+        "--max_anchors", type=int, default=8, help="n. of cached anchor indices"
+    )
+    return parser.parse_args()
+
+
+class LRUCache:
+    """Dictionary with a maximum size, that evicts the least recently used
+    items. Counts hits and misses."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        """returns the cached value, or None if not present"""
+        if key not in self.items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def stats(self):
+        return {
+            "size": len(self.items),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class QueryError(Exception):
+    """invalid query, answered with status 400"""
+
+
+class PangraphQueries:
+    """Precomputed indices over a pangraph, and the functions answering each
+    type of query. Each function takes the dictionary of query parameters and
+    returns a json-serializable object."""
+
+    def __init__(self, pan, max_anchors=8):
+        self.pan = pan
+        self.bdf = pan.to_blockstats_df()
+        self.Ls = self.bdf["len"].to_numpy()
+        self.path_idx = {name: n for n, name in enumerate(pan.path_names)}
+        self.pa = PresenceAbsence.from_pangraph(pan)
+        self.enc_paths = [(p.block_idx, p.block_strands) for p in pan.paths]
+        self.projector = PanProjector(pan)
+        self.anchor_indices = LRUCache(max_anchors)
+
+    def _path(self, params, key):
+        """index of the path named by a query parameter"""
+        name = self._param(params, key)
+        if name not in self.path_idx:
+            raise QueryError(f"unknown path {name}")
+        return self.path_idx[name]
+
+    def _param(self, params, key):
+        if key not in params:
+            raise QueryError(f"missing parameter {key}")
+        return params[key]
+
+    def strains(self, params):
+        return {"strains": self.pan.path_names.tolist()}
+
+    def block_stats(self, params):
+        if "block" not in params:
+            df = self.bdf
+            return {
+                "n_blocks": len(df),
+                "n_core": int(df["core"].sum()),
+                "n_duplicated": int(df["duplicated"].sum()),
+                "total_len": int(df["len"].sum()),
+                "core_len": int(df["len"][df["core"]].sum()),
+            }
+        block = params["block"]
+        if block not in self.bdf.index:
+            raise QueryError(f"unknown block {block}")
+        row = self.bdf.loc[block]
+        return {"block": block, **{k: row[k].item() for k in self.bdf.columns}}
+
+    def private_seq(self, params):
+        i, j = self._path(params, "a"), self._path(params, "b")
+        return {
+            "a": params["a"],
+            "b": params["b"],
+            "private_seq": int(self.pa.weighted_xor(i, j)),
+            "shared_seq": int(self.pa.weighted_and(i, j)),
+        }
+
+    def shared_path(self, params):
+        i, j = self._path(params, "a"), self._path(params, "b")
+        anchor = self._param(params, "anchor")
+        if anchor not in self.bdf.index or not self.bdf["core"][anchor]:
+            raise QueryError(f"the anchor {anchor} must be a core block")
+        index = self.anchor_indices.get(anchor)
+        if index is None:
+            a = self.pan.block_idx[anchor]
+            index = AnchorSharedPaths(self.enc_paths, a, self.Ls)
+            self.anchor_indices.put(anchor, index)
+        L = index.shared_length(np.array([i]), np.array([j]))[0]
+        return {
+            "a": params["a"],
+            "b": params["b"],
+            "anchor": anchor,
+            "shared_L": int(L),
+        }
+
+    def projection(self, params):
+        self._path(params, "a"), self._path(params, "b")
+        pr = self.projector.project(params["a"], params["b"], exclude_dupl=False)
+        res = {}
+        for key, mp in [("a", pr.MPA), ("b", pr.MPB)]:
+            comm = np.asarray(mp.comm, dtype=bool)
+            res[key] = {
+                "name": params[key],
+                "n_blocks": int(mp.L),
+                "common_len": int(mp.bl_Ls[comm].sum()),
+                "private_len": int(mp.bl_Ls[~comm].sum()),
+            }
+        res["n_common_chunks"] = len(np.unique(pr.MPA.chunk_id[pr.MPA.comm]))
+        return res
+
+
+class QueryServer:
+    """asyncio HTTP server answering GET requests with the functions of a
+    `PangraphQueries` object. Responses are cached by endpoint and parameters.
+    Queries are evaluated in a worker thread, so that the event loop keeps
+    accepting connections."""
+
+    endpoints = ["strains", "block_stats", "private_seq", "shared_path", "projection"]
+    reasons = {
+        200: "OK",
+        400: "Bad Request",
+        404: "Not Found",
+        405: "Method Not Allowed",
+        500: "Internal Server Error",
+    }
+
+    def __init__(self, queries, cache_size=1024):
+        self.queries = queries
+        self.cache = LRUCache(cache_size)
+        # indices are shared between queries and not thread-safe
+        self.lock = asyncio.Lock()
+
+    async def answer(self, target):
+        """status and json body of the response to a request target"""
+        url = urlsplit(target)
+        endpoint = url.path.strip("/")
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if endpoint == "cache":
+            return 200, json.dumps(self.cache.stats())
+        if endpoint not in self.endpoints:
+            return 404, json.dumps({"error": f"unknown endpoint {url.path}"})
+
+        key = (endpoint, tuple(sorted(params.items())))
+        body = self.cache.get(key)
+        if body is not None:
+            return 200, body
+        fn = getattr(self.queries, endpoint)
+        try:
+            async with self.lock:
+                res = await asyncio.to_thread(fn, params)
+            body = json.dumps(res)
+        except QueryError as e:
+            return 400, json.dumps({"error": str(e)})
+        except Exception as e:
+            # unexpected failure: log it and keep serving
+            print(f"error answering {target}", flush=True)
+            traceback.print_exc()
+            return 500, json.dumps({"error": f"{type(e).__name__}: {e}"})
+        self.cache.put(key, body)
+        return 200, body
+
+    async def handle(self, reader, writer):
+        """reads one request and writes the response, then closes the
+        connection"""
+        try:
+            request = (await reader.readline()).decode("latin-1").split()
+            # skip headers, requests have no body
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if len(request) != 3:
+                status, body = 400, json.dumps({"error": "malformed request"})
+            elif request[0] != "GET":
+                status, body = 405, json.dumps({"error": "only GET is supported"})
+            else:
+                status, body = await self.answer(request[1])
+            data = body.encode()
+            head = (
+                f"HTTP/1.1 {status} {self.reasons[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                "Connection: close\r\n\r\n"
+            )
+            writer.write(head.encode() + data)
+            await writer.drain()
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"serving on http://{host}:{port}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    # load the graph and precompute the indices once
+    pan = load_pangraph(args.pangraph)
+    queries = PangraphQueries(pan, max_anchors=args.max_anchors)
+    print(f"loaded {args.pangraph}: {len(pan.path_names)} paths", flush=True)
+
+    server = QueryServer(queries, cache_size=args.cache_size)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,479 @@
+import os
+import tempfile
+import numpy as np
+
+from pairwise_executor import pairwise_matrix
+
+
+def encode_paths(paths, block_idx):
+    """encodes each path as a pair of integer arrays (block index, strand),
+    given a dictionary block id -> block index"""
+    enc = []
+    for p in paths:
+        B = np.array([block_idx[b] for b in p.block_ids], dtype=np.int32)
+        S = np.asarray(p.block_strands, dtype=bool)
+        enc.append((B, S))
+    return enc
+
+
+def anchor_oriented_halves(B, S, anchor):
+    """given a path encoded as (block index, strand) arrays and the index of the
+    anchor block, orients the path so that the anchor is on the forward strand
+    and returns the backward half (from the anchor, included, towards the
+    beginning of the path) and the forward half (from the block after the
+    anchor to the end of the path). Each half is returned as a pair of arrays
+    (tokens, block index), where tokens encode block and strand as 2*block +
+    strand."""
+    a = np.flatnonzero(B == anchor)[0]
+    if not S[a]:
+        B, S = B[::-1], ~S[::-1]
+        a = np.flatnonzero(B == anchor)[0]
+    T = 2 * B.astype(np.int64) + S
+    return (T[a::-1], B[a::-1]), (T[a + 1 :], B[a + 1 :])
+
+
+def sparse_table(a):
+    """sparse table of an array for range-minimum queries: the k-th level
+    contains the minimum of each window of 2^k elements"""
+    table = [a]
+    w = 1
+    while 2 * w <= len(a):
+        prev = table[-1]
+        table.append(np.minimum(prev[:-w], prev[w:]))
+        w *= 2
+    return table
+
+
+def pack_table(table, n):
+    """sparse table (list of arrays) packed in a single 2D array, with each
+    level padded to length n"""
+    packed = np.zeros((len(table), n), dtype=np.int64)
+    for k, t in enumerate(table):
+        packed[k, : len(t)] = t
+    return packed
+
+
+def range_min(table, l, r):
+    """vectorized minimum of the array in the ranges [l, r], given its sparse
+    table (a list of arrays, or a 2D array padded to the same length)"""
+    k = np.log2(r - l + 1).astype(int)
+    res = np.empty_like(l)
+    for kk in np.unique(k):
+        m = k == kk
+        a = table[kk][l[m]]
+        b = table[kk][r[m] - (1 << kk) + 1]
+        res[m] = np.minimum(a, b)
+    return res
+
+
+def lce(rank, seq_len, table, i, j):
+    """vectorized longest common extension of arrays of sequence indices, given
+    the rank of each sequence, their lengths and the sparse table of the lcp
+    array (see `SharedExtensionIndex`)"""
+    i, j = np.asarray(i), np.asarray(j)
+    ri, rj = rank[i], rank[j]
+
+    # the extension of a sequence with itself is the full sequence
+    res = seq_len[i].copy()
+
+    # otherwise minimum of the lcp array in the range of ranks (l, r]
+    d = ri != rj
+    l = np.minimum(ri[d], rj[d]) + 1
+    r = np.maximum(ri[d], rj[d])
+    res[d] = range_min(table, l, r)
+    return res
+
+
+class SharedExtensionIndex:
+    """Longest-common-extension index over a set of token sequences, all of
+    which are compared from their first element. Sequences are sorted
+    lexicographically, and the longest common prefix (LCP) of adjacent
+    sequences is stored. The LCE of any two sequences is then the minimum of the
+    LCP array between their ranks, found in O(1) with a sparse table.
+
+    Each sequence is associated to a vector of weights (block lengths), and the
+    prefix sums of the weights are stored so that the weight of a common prefix
+    can also be returned in O(1).
+    """
+
+    def __init__(self, seqs, weights):
+        """build the index given a list of token arrays and a list of weight
+        arrays with the same lengths"""
+        n = len(seqs)
+        self.n = n
+        self.seq_len = np.array([len(s) for s in seqs], dtype=np.int64)
+
+        # lexicographic order of the sequences, and rank of each sequence
+        order = sorted(range(n), key=lambda i: seqs[i].tolist())
+        self.rank = np.empty(n, dtype=np.int64)
+        self.rank[order] = np.arange(n)
+
+        # lcp[r] = longest common prefix of sorted sequences r-1 and r
+        lcp = np.zeros(n, dtype=np.int64)
+        for r in range(1, n):
+            s1, s2 = seqs[order[r - 1]], seqs[order[r]]
+            m = min(len(s1), len(s2))
+            neq = np.flatnonzero(s1[:m] != s2[:m])
+            lcp[r] = neq[0] if len(neq) > 0 else m
+
+        # sparse table for range-minimum queries on the lcp array
+        self.table = sparse_table(lcp)
+
+        # prefix sums of weights, concatenated. The weight of the first k
+        # elements of sequence i is cumw[offset[i] + k]
+        self.offset = np.zeros(n, dtype=np.int64)
+        self.offset[1:] = np.cumsum(self.seq_len + 1)[:-1]
+        cumw = [np.concatenate([[0], np.cumsum(w)]) for w in weights]
+        self.cumw = np.concatenate(cumw) if n > 0 else np.zeros(0)
+
+    def lce(self, i, j):
+        """vectorized longest common extension (in n. of tokens) of arrays of
+        sequence indices"""
+        return lce(self.rank, self.seq_len, self.table, i, j)
+
+    def shared_weight(self, i, j):
+        """vectorized total weight of the common prefix of arrays of sequence
+        indices"""
+        i = np.asarray(i)
+        return self.cumw[self.offset[i] + self.lce(i, j)]
+
+    def arrays(self, prefix=""):
+        """dictionary of the arrays of the index, with the sparse table packed
+        in a single 2D array"""
+        names = ["rank", "seq_len", "offset", "cumw"]
+        arrays = {prefix + k: getattr(self, k) for k in names}
+        arrays[prefix + "table"] = pack_table(self.table, self.n)
+        return arrays
+
+
+def shared_weight(arrays, prefix, i, j):
+    """vectorized weight of the common prefix of arrays of sequence indices,
+    from the arrays of a `SharedExtensionIndex`"""
+    a = {k: arrays[prefix + k] for k in ["rank", "seq_len", "offset", "cumw", "table"]}
+    ext = lce(a["rank"], a["seq_len"], a["table"], i, j)
+    return a["cumw"][a["offset"][i] + ext]
+
+
+def shared_length_tile(arrays, i0, i1, j0, j1):
+    """tile kernel (see `pairwise_executor`) of the shared path length, given
+    the arrays of the backward and forward indices (see
+    `AnchorSharedPaths.arrays`)"""
+    i = np.repeat(np.arange(i0, i1), j1 - j0)
+    j = np.tile(np.arange(j0, j1), i1 - i0)
+    L = shared_weight(arrays, "bwd_", i, j) + shared_weight(arrays, "fwd_", i, j)
+    return L.reshape(i1 - i0, j1 - j0)
+
+
+class AnchorSharedPaths:
+    """Index to evaluate the length of the shared path from an anchor block for
+    any pair of paths. Each path is oriented according to the anchor block
+    strand, and split in a backward and forward half. The shared length is the
+    sum of the weight of the longest common extension of the backward halves
+    (including the anchor) and of the forward halves.
+
+    Paths that are identical after orientation are collapsed in equivalence
+    classes, and the index is built on one representative per class. The
+    attribute `cls` gives the class of each path, and `reps` the path index of
+    the representative of each class.
+    """
+
+    def __init__(self, encoded_paths, anchor, Ls):
+        """build the index given the encoded paths (see `encode_paths`), the
+        index of the anchor block and the array of block lengths"""
+        Ls = np.asarray(Ls)
+        halves = [anchor_oriented_halves(B, S, anchor) for B, S in encoded_paths]
+        self.N = len(encoded_paths)
+
+        # equivalence classes of identical oriented paths, in order of first
+        # occurrence
+        classes = {}
+        self.cls = np.empty(self.N, dtype=np.int64)
+        for n, ((tb, _), (tf, _)) in enumerate(halves):
+            key = (tb.tobytes(), tf.tobytes())
+            self.cls[n] = classes.setdefault(key, len(classes))
+        self.U = len(classes)
+        self.reps = np.unique(self.cls, return_index=True)[1]
+
+        bwd, fwd = zip(*[halves[r] for r in self.reps])
+        self.bwd = SharedExtensionIndex([t for t, _ in bwd], [Ls[b] for _, b in bwd])
+        self.fwd = SharedExtensionIndex([t for t, _ in fwd], [Ls[b] for _, b in fwd])
+
+    def shared_length(self, i, j):
+        """vectorized shared path length for arrays of path indices"""
+        i, j = self.cls[i], self.cls[j]
+        return self.bwd.shared_weight(i, j) + self.fwd.shared_weight(i, j)
+
+    def arrays(self):
+        """dictionary of the arrays of the backward and forward indices, over
+        the class representatives"""
+        return {**self.bwd.arrays("bwd_"), **self.fwd.arrays("fwd_")}
+
+    def class_matrix(self, out=None, block_size=1024, threads=1, rows=None):
+        """matrix of shared path lengths between class representatives,
+        written in `out` if provided. If `rows` is passed, only these rows and
+        columns are evaluated."""
+        return pairwise_matrix(
+            shared_length_tile,
+            self.arrays(),
+            self.U,
+            out=out,
+            dtype=np.int64,
+            threads=threads,
+            tile_size=block_size,
+            rows=rows,
+        )
+
+    def shared_length_matrix(self, out=None, block_size=1024, threads=1, rows=None):
+        """returns the matrix of shared path lengths for all pairs of paths.
+        The kernel is evaluated only between class representatives, in tiles
+        of `block_size` rows and columns on `threads` processes. If all paths
+        are distinct the result is written directly in `out` (if provided).
+        Otherwise the class matrix is saved in a temporary memory-mapped file,
+        next to `out` if it is memory-mapped, and expanded to all paths by
+        blocks of rows. If `rows` is passed, only these rows and columns are
+        evaluated."""
+        if out is None:
+            out = np.empty((self.N, self.N), dtype=np.int64)
+        if self.U == self.N:
+            return self.class_matrix(out, block_size, threads, rows)
+
+        if rows is None:
+            rows = np.arange(self.N)
+            cls_rows = None
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            cls_rows = np.unique(self.cls[rows])
+        tmp_dir = None
+        if isinstance(out, np.memmap) and out.filename is not None:
+            tmp_dir = os.path.dirname(out.filename)
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+            M = np.lib.format.open_memmap(
+                os.path.join(tmp, "class_matrix.npy"),
+                mode="w+",
+                dtype=np.int64,
+                shape=(self.U, self.U),
+            )
+            self.class_matrix(M, block_size, threads, cls_rows)
+            for b in range(0, len(rows), block_size):
+                r = rows[b : b + block_size]
+                block = M[self.cls[r]][:, self.cls]
+                out[r, :] = block
+                out[:, r] = block.T
+            del M
+        return out
+
+
+class OrientedPathText:
+    """Longest-common-extension index between any two positions of the paths,
+    each read in both orientations. All paths are concatenated in forward
+    orientation (tokens 2*block + strand) and in reverse orientation (reversed,
+    with flipped strands), each followed by a unique separator. Positions are
+    named with the Karp-Miller-Rosenberg doubling scheme: at level k two
+    positions have the same name if the 2^k tokens starting from them are
+    equal. The extension of two positions is found by descending the levels.
+
+    The names at the last level are the lexicographic ranks of the suffixes.
+    The index stores one int32 array per level, with size twice the total
+    number of block occurrences.
+    """
+
+    def __init__(self, encoded_paths, Ls):
+        """build the index given the encoded paths (see `encode_paths`) and the
+        array of block lengths"""
+        Ls = np.asarray(Ls)
+        self.N = len(encoded_paths)
+        self.path_len = np.array([len(B) for B, _ in encoded_paths], dtype=np.int64)
+
+        # start of the forward and reverse text of each path
+        self.fwd_start = np.zeros(self.N, dtype=np.int64)
+        self.fwd_start[1:] = np.cumsum(2 * (self.path_len + 1))[:-1]
+        self.rev_start = self.fwd_start + self.path_len + 1
+
+        text, weights = [], []
+        for n, (B, S) in enumerate(encoded_paths):
+            T = 2 * np.asarray(B, dtype=np.int64) + S
+            text += [T, [-2 * n - 1], (T ^ 1)[::-1], [-2 * n - 2]]
+            weights += [Ls[B], [0], Ls[B][::-1], [0]]
+        text = np.concatenate(text) if self.N > 0 else np.zeros(0, dtype=np.int64)
+        weights = np.concatenate(weights) if self.N > 0 else np.zeros(0)
+
+        # prefix sums of the weights along the text
+        self.cumw = np.concatenate([[0], np.cumsum(weights)]).astype(np.int64)
+
+        # names of each position at increasing levels, until all are distinct
+        n = len(text)
+        _, name = np.unique(text, return_inverse=True)
+        self.names = [name.astype(np.int32)]
+        w = 1
+        while n > 0 and self.names[-1].max() + 1 < n:
+            prev = self.names[-1].astype(np.int64)
+            nxt = np.full(n, -1, dtype=np.int64)
+            nxt[:-w] = prev[w:]
+            _, name = np.unique(prev * (n + 1) + nxt + 1, return_inverse=True)
+            self.names.append(name.astype(np.int32))
+            w *= 2
+
+        # occurrences of each block: path, position and strand, grouped by block
+        B = np.concatenate([B for B, _ in encoded_paths]).astype(np.int64)
+        S = np.concatenate([S for _, S in encoded_paths]).astype(bool)
+        path = np.repeat(np.arange(self.N), self.path_len)
+        offset = np.cumsum(self.path_len) - self.path_len
+        pos = np.arange(len(B)) - np.repeat(offset, self.path_len)
+        order = np.argsort(B, kind="stable")
+        self.occ_path, self.occ_pos, self.occ_strand = path[order], pos[order], S[order]
+        self.occ_ptr = np.searchsorted(B[order], np.arange(len(Ls) + 1))
+
+    def lce(self, p, q):
+        """vectorized longest common extension (in n. of tokens) of arrays of
+        distinct text positions"""
+        p, q = np.asarray(p), np.asarray(q)
+        ext = np.zeros(len(p), dtype=np.int64)
+        for k in range(len(self.names) - 1, -1, -1):
+            names = self.names[k]
+            ext += (names[p + ext] == names[q + ext]).astype(np.int64) << k
+        return ext
+
+    def anchor_halves(self, anchor):
+        """returns the occurrences of the anchor block as arrays (path, start
+        and length of the backward half, start and length of the forward half).
+        Halves are taken with the path oriented so that the anchor is on the
+        forward strand. The backward half (from the anchor, included, towards
+        the beginning of the path) is read forward in the opposite orientation
+        of the path, i.e. with all strands flipped, which does not change its
+        extensions."""
+        k = slice(self.occ_ptr[anchor], self.occ_ptr[anchor + 1])
+        n, a, s = self.occ_path[k], self.occ_pos[k], self.occ_strand[k]
+        L = self.path_len[n]
+        f, r = self.fwd_start[n], self.rev_start[n]
+        bwd = np.where(s, r + L - 1 - a, f + a)
+        fwd = np.where(s, f + a + 1, r + L - a)
+        bwd_len = np.where(s, a + 1, L - a)
+        return n, bwd, bwd_len, fwd, L - bwd_len
+
+    def extension_arrays(self, starts, lengths, prefix=""):
+        """dictionary of the arrays of a longest-common-extension index over
+        the given text positions, given the n. of tokens from each position to
+        the end of its path: the rank of each position, the lengths, the
+        positions and the packed sparse table of the lcp array of adjacent
+        ranks (see `text_shared_weight`)"""
+        M = len(starts)
+        order = np.argsort(self.names[-1][starts])
+        rank = np.empty(M, dtype=np.int64)
+        rank[order] = np.arange(M)
+        lcp = np.zeros(M, dtype=np.int64)
+        lcp[1:] = self.lce(starts[order[:-1]], starts[order[1:]])
+        return {
+            prefix + "rank": rank,
+            prefix + "seq_len": np.asarray(lengths, dtype=np.int64),
+            prefix + "start": np.asarray(starts, dtype=np.int64),
+            prefix + "table": pack_table(sparse_table(lcp), M),
+        }
+
+
+def text_shared_weight(arrays, prefix, p, q):
+    """vectorized weight of the longest common extension of arrays of indices
+    of text positions, from the arrays of `OrientedPathText.extension_arrays`
+    and the prefix sums `cumw` of the weights along the text"""
+    a = {k: arrays[prefix + k] for k in ["rank", "seq_len", "start", "table"]}
+    ext = lce(a["rank"], a["seq_len"], a["table"], p, q)
+    start = a["start"][p]
+    return arrays["cumw"][start + ext] - arrays["cumw"][start]
+
+
+def anchor_shared_length_tile(arrays, i0, i1, j0, j1):
+    """tile kernel (see `pairwise_executor`) of the shared path length from an
+    anchor block, given the arrays of `MultiAnchorSharedPaths.anchor_arrays`.
+    All pairs of anchor occurrences in the paths of the tile are evaluated, and
+    reduced to the maximum over the occurrences of each path. Paths without
+    the anchor get -1."""
+    ptr_i, ptr_j = arrays["path_ptr"][i0 : i1 + 1], arrays["path_ptr"][j0 : j1 + 1]
+    block = np.full((i1 - i0, j1 - j0), -1, dtype=np.int64)
+    p = np.arange(ptr_i[0], ptr_i[-1])
+    q = np.arange(ptr_j[0], ptr_j[-1])
+    if len(p) == 0 or len(q) == 0:
+        return block
+    pp, qq = np.repeat(p, len(q)), np.tile(q, len(p))
+    W = text_shared_weight(arrays, "bwd_", pp, qq)
+    W += text_shared_weight(arrays, "fwd_", pp, qq)
+    W = W.reshape(len(p), len(q))
+
+    # maximum over occurrences in the same path (grouped by path)
+    ri, rj = np.flatnonzero(np.diff(ptr_i)), np.flatnonzero(np.diff(ptr_j))
+    W = np.maximum.reduceat(W, ptr_i[ri] - ptr_i[0], axis=0)
+    W = np.maximum.reduceat(W, ptr_j[rj] - ptr_j[0], axis=1)
+    block[np.ix_(ri, rj)] = W
+    return block
+
+
+class MultiAnchorSharedPaths:
+    """Shared path length from several anchor blocks, for any pair of paths.
+    The paths are encoded once in an `OrientedPathText`, and the backward and
+    forward halves around each occurrence of an anchor are positions in this
+    text. Anchors can be missing from some paths, or occur more than once: the
+    shared length of two paths is then the maximum over pairs of occurrences
+    of the anchor, and -1 if either path does not contain it. For each anchor,
+    pairs of occurrences are evaluated in tiles of paths (see
+    `pairwise_executor`), so that memory is bounded by the tile size.
+    """
+
+    def __init__(self, encoded_paths, Ls):
+        """build the index given the encoded paths (see `encode_paths`) and the
+        array of block lengths"""
+        self.text = OrientedPathText(encoded_paths, Ls)
+        self.N = self.text.N
+
+    def anchor_arrays(self, anchor):
+        """dictionary of the arrays of the tile kernel (see
+        `anchor_shared_length_tile`) for the anchor with the given block index,
+        or None if no path contains it. Occurrences are grouped by path, and
+        `path_ptr` gives the first occurrence of each path."""
+        n, bwd, bwd_len, fwd, fwd_len = self.text.anchor_halves(anchor)
+        if len(n) == 0:
+            return None
+        return {
+            "path_ptr": np.searchsorted(n, np.arange(self.N + 1)),
+            "cumw": self.text.cumw,
+            **self.text.extension_arrays(bwd, bwd_len, "bwd_"),
+            **self.text.extension_arrays(fwd, fwd_len, "fwd_"),
+        }
+
+    def shared_length_matrix(
+        self, anchor, out=None, condensed=False, block_size=1024, threads=1
+    ):
+        """N x N matrix of shared path lengths from the anchor with the given
+        block index, or its condensed form (see `pairwise_executor`). Tiles of
+        `block_size` paths are evaluated on `threads` processes, and written in
+        `out` if provided."""
+        arrays = self.anchor_arrays(anchor)
+        if arrays is None:
+            if out is None:
+                shape = (self.N * (self.N - 1) // 2,) if condensed else (self.N,) * 2
+                out = np.empty(shape, dtype=np.int64)
+            out[...] = -1
+            return out
+        return pairwise_matrix(
+            anchor_shared_length_tile,
+            arrays,
+            self.N,
+            out=out,
+            dtype=np.int64,
+            threads=threads,
+            tile_size=block_size,
+            condensed=condensed,
+        )
+
+    def shared_length_tensor(
+        self, anchors, out=None, dtype=np.int32, block_size=1024, threads=1
+    ):
+        """returns the (anchor x pair) array of shared path lengths for the
+        given list of anchor block indices. Pairs of distinct paths are in
+        condensed order (as `np.triu_indices(N, k=1)`). The result is written
+        in `out` if provided (e.g. a memory-mapped array), one row per anchor,
+        without building the square matrices."""
+        if out is None:
+            out = np.empty((len(anchors), self.N * (self.N - 1) // 2), dtype=dtype)
+        for k, a in enumerate(anchors):
+            self.shared_length_matrix(
+                a, out=out[k], condensed=True, block_size=block_size, threads=threads
+            )
+        return out
@@ -1,31 +1,64 @@
 import argparse
+import os
+import tempfile
 import pandas as pd
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from Bio import Phylo
-from itertools import product, combinations
+
+from matrix_utils import (
+    copy_from_state,
+    create_matrix,
+    fingerprint,
+    incremental_plan,
+    load_matrix,
+    load_state,
+    save_state,
+    upper_triangle,
+    upper_triangle_df,
+)
+from tree_utils import FlatTree
+from profiling import Profiler
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--shared_len_df", type=str, required=True)
+    parser.add_argument("--shared_len_mat", type=str, required=True)
     parser.add_argument("--tree", type=str, required=True)
     parser.add_argument("--leaves_colors", type=str, required=True)
     parser.add_argument("--fig_scatter", type=str, required=True)
     parser.add_argument("--fig_tree", type=str, required=True)
+    parser.add_argument(
+        "--min_shared_len",
+        type=float,
+        default=None,
+        help="only draw links between paths sharing at least this length (bp)",
+    )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=None,
+        help="only draw the links with the k largest shared lengths",
+    )
+    parser.add_argument("--threads", type=int, default=1, help="n. of processes")
+    parser.add_argument(
+        "--incremental",
+        type=str,
+        default=None,
+        help="state directory, to only evaluate the tree distances of new paths",
+    )
     return parser.parse_args()
 
 
-def tree_leaves_distances(tree):
-    """given a phylogenetic tree evaluates all pairwise distances for
-    the leaves and returns them in a dictionary"""
-    leaves = tree.get_terminals()
-    d = {}
-    for (i, j) in product(leaves, repeat=2):
-        label = (i.name, j.name)
-        d[label] = tree.distance(i, j)
-    return d
+def tree_params(ftree, isolates):
+    """parameters of the incremental state: fingerprint of the subtree induced
+    by the given isolates, or None if some of them are not in the tree"""
+    isolates = sorted(set(isolates))
+    if any(l not in ftree.leaf_idx for l in isolates):
+        return {"tree": None}
+    return {"tree": fingerprint([ftree.induced_newick(isolates)])}
 
 
 def scatterplot(df, fig_savename):
@@ -41,20 +74,33 @@ def scatterplot(df, fig_savename):
     plt.close(fig)
 
 
-def __draw_ellipse(y1, y2, color, ax):
-    """utility function to draw a half-ellipse between two points"""
-    theta = np.linspace(0, np.pi, 30)
-    dy = np.abs(y2 - y1) / 2
-    y0 = np.mean([y1, y2])
+def arcs(y1, y2, n=30):
+    """returns an array (n. arcs x n points x 2) of half-ellipses between pairs
+    of points on the y-axis"""
+    theta = np.linspace(0, np.pi, n)
+    y1, y2 = np.asarray(y1, dtype=float), np.asarray(y2, dtype=float)
+    dy = np.abs(y2 - y1)[:, None] / 2
+    y0 = (y1 + y2)[:, None] / 2
     dx = dy / 2
     x = np.sin(theta) * dx
     y = np.cos(theta) * dy + y0
-    ax.plot(x, y, color=color)
+    return np.stack([x, y], axis=2)
 
 
-def tree_plot(tree, df, fig_savename):
+def select_links(df, min_shared_len=None, top_k=None):
+    """selects the pairs to be drawn, with shared length above a threshold
+    and/or among the k largest. Returns pairs sorted by shared length."""
+    if min_shared_len is not None:
+        df = df[df["shared_L"] >= min_shared_len]
+    if top_k is not None:
+        df = df.nlargest(top_k, "shared_L")
+    return df.sort_values("shared_L")
+
+
+def tree_plot(tree, df, leaves_colors, fig_savename, min_shared_len=None, top_k=None):
     """Draw a plot to compare the distance on core-genome tree to the length of
-    shared paths"""
+    shared paths. Links can be restricted to the most informative pairs with a
+    threshold or top-k filter on the shared length."""
 
     # set of bla-containing isolates
     leaves_idx = {l.name: n + 1 for n, l in enumerate(tree.get_terminals())}
@@ -77,21 +123,20 @@ def tree_plot(tree, df, fig_savename):
     ax.spines["top"].set_visible(False)
     ax.grid(True, axis="y", alpha=0.5)
 
-    # draw links between isolates, color representing the shared path length
+    # draw links between isolates, color representing the shared path length.
+    # The color scale is set by all pairs, including those filtered out.
     ax = axs[1]
 
     cmap = plt.get_cmap("Blues")
     Lmin, Lmax = df["shared_L"].min() / 1000, df["shared_L"].max() / 1000
     norm = plt.Normalize(vmin=Lmin, vmax=Lmax)
-    
-    for _, x in df.sort_values("shared_L").iterrows():
-        l1 = x["p1"].split("-")[0]
-        l2 = x["p2"].split("-")[0]
-        L = x["shared_L"] / 1000
-        i1 = leaves_idx[l1]
-        i2 = leaves_idx[l2]
-        color = cmap(norm(L))
-        __draw_ellipse(i1, i2, color, ax)
+
+    links = select_links(df, min_shared_len, top_k)
+    i1 = links["p1"].str.split("-").str[0].map(leaves_idx).to_numpy()
+    i2 = links["p2"].str.split("-").str[0].map(leaves_idx).to_numpy()
+    colors = cmap(norm(links["shared_L"].to_numpy() / 1000))
+    ax.add_collection(LineCollection(arcs(i1, i2), colors=colors))
+    ax.autoscale_view()
 
     ax.set_xticks([])
     for sp in ax.spines:
@@ -109,25 +154,71 @@ def tree_plot(tree, df, fig_savename):
 if __name__ == "__main__":
 
     args = parse_args()
+    prof = Profiler(
+        inputs=[args.shared_len_mat, args.tree, args.leaves_colors],
+        outputs=[args.fig_scatter, args.fig_tree],
+    )
 
     # load core genome tree
+    prof.stage("load")
     tree = Phylo.read(args.tree, "newick")
 
     # load shared path distance (select only one item per pair)
-    df_l = pd.read_csv(args.shared_len_df)
-    df_l = df_l[df_l["p1"] > df_l["p2"]]
+    labels, S = load_matrix(args.shared_len_mat)
+    df_l = upper_triangle_df(labels, S, "shared_L")
 
     # load leaves colors
     leaves_colors = pd.read_csv(args.leaves_colors, index_col=0)["color"].to_dict()
 
-    # evaluate tree distance
-    tree_d = tree_leaves_distances(tree)
-
-    # add tree distance to dataframe
-    df_l["tree_dist"] = df_l.apply(
-        lambda x: tree_d[(x["p1"].split("-")[0], x["p2"].split("-")[0])], axis=1
-    )
+    # flat representation of the tree, to evaluate leaves distances
+    prof.stage("compute")
+    ftree = FlatTree(tree)
+
+    # add tree distance to dataframe. Distances between the isolates of all
+    # pairs of paths are evaluated in parallel, directly in the condensed order
+    # of the pairs of the dataframe
+    isolates = [l.split("-")[0] for l in labels]
+    if args.incremental is None:
+        df_l["tree_dist"] = ftree.leaf_distance_matrix(
+            isolates, threads=args.threads, condensed=True
+        )
+    else:
+        # the full matrix is kept for the next update, memory-mapped in a
+        # temporary file next to the state and then hard-linked in it
+        state_parent = os.path.dirname(os.path.abspath(args.incremental))
+        os.makedirs(state_parent, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=state_parent) as tmp:
+            fname = os.path.join(tmp, "tree_dist.npy")
+            T = create_matrix(fname, labels, dtype=np.float64)
+            rows = None
+            # stored distances are still valid if the tree restricted to the
+            # previous isolates is unchanged
+            state = load_state(args.incremental)
+            if state is not None:
+                old = [l.split("-")[0] for l in state["labels"]]
+                params = tree_params(ftree, old)
+                plan = incremental_plan(state, labels, isolates, params)
+                if plan is not None:
+                    src, rows = plan
+                    copy_from_state(args.incremental, T, src)
+                    print(f"incremental update: {len(rows)} of {len(labels)} paths")
+            ftree.leaf_distance_matrix(isolates, out=T, threads=args.threads, rows=rows)
+            T.flush()
+            params = tree_params(ftree, isolates)
+            save_state(args.incremental, fname, labels, isolates, params)
+            df_l["tree_dist"] = upper_triangle(T)
+            del T
 
     # perform plots
+    prof.stage("plot")
     scatterplot(df_l, args.fig_scatter)
-    tree_plot(tree, df_l, args.fig_tree)
+    tree_plot(
+        tree,
+        df_l,
+        leaves_colors,
+        args.fig_tree,
+        min_shared_len=args.min_shared_len,
+        top_k=args.top_k,
+    )
+
+    prof.save()
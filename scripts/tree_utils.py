@@ -0,0 +1,224 @@
+import heapq
+import numpy as np
+from Bio import Phylo
+
+from pairwise_executor import pairwise_matrix
+
+
+def lca(first, level, euler, table, u, v):
+    """vectorized lowest common ancestor of arrays of node indices, given the
+    euler tour of the tree (see `FlatTree`). The sparse table can be a list of
+    arrays or a 2D array padded to the same length."""
+    l, r = first[u], first[v]
+    l, r = np.minimum(l, r), np.maximum(l, r)
+    k = np.log2(r - l + 1).astype(int)
+    a = np.empty_like(l)
+    b = np.empty_like(l)
+    for kk in np.unique(k):
+        m = k == kk
+        a[m] = table[kk][l[m]]
+        b[m] = table[kk][r[m] - (1 << kk) + 1]
+    pos = np.where(level[a] <= level[b], a, b)
+    return euler[pos]
+
+
+def leaf_distance_tile(arrays, i0, i1, j0, j1):
+    """tile kernel (see `pairwise_executor`) of the distance between leaves,
+    given the arrays of `FlatTree.arrays` and the array `idx` of node indices
+    of the selected leaves"""
+    idx, depth = arrays["idx"], arrays["depth"]
+    u = np.repeat(idx[i0:i1], j1 - j0)
+    v = np.tile(idx[j0:j1], i1 - i0)
+    w = lca(arrays["first"], arrays["level"], arrays["euler"], arrays["table"], u, v)
+    d = depth[u] + depth[v] - 2 * depth[w]
+    return d.reshape(i1 - i0, j1 - j0)
+
+
+class FlatTree:
+    """Flat array representation of a phylogenetic tree, used to answer leaf
+    distance queries in a vectorized way. Nodes are numbered in pre-order and
+    the object has attributes:
+    - parent (int): index of the parent node (-1 for the root)
+    - depth (float): distance of each node from the root
+    - leaves (int): indices of the leaves, in the order in which they appear
+        in the tree
+    - leaf_names (str): names of the leaves, in the same order
+    - leaf_idx (dict): leaf name -> node index
+    - children (list): indices of the children of each node
+    - leaf_range (int): for each node, interval [start, end) of the positions
+        in `leaves` of the leaves of its subtree
+
+    The lowest common ancestor (LCA) of two nodes is found with a range minimum
+    query on the Euler tour of the tree, using a sparse table.
+    """
+
+    def __init__(self, tree):
+        """build the flat representation from a Bio.Phylo tree"""
+
+        # pre-order traversal: parent, depth and children of each node
+        parent, depth, children, leaves, names = [-1], [0.0], [[]], [], []
+        stack = [(tree.root, 0)]
+        while stack:
+            clade, n = stack.pop()
+            if clade.is_terminal():
+                leaves.append(n)
+                names.append(clade.name)
+            # push in reverse order, to visit children from first to last
+            for child in reversed(clade.clades):
+                m = len(parent)
+                parent.append(n)
+                depth.append(depth[n] + (child.branch_length or 0.0))
+                children.append([])
+                children[n].insert(0, m)
+                stack.append((child, m))
+
+        self.parent = np.array(parent)
+        self.depth = np.array(depth)
+        self.leaves = np.array(leaves)
+        self.leaf_names = np.array(names)
+        self.leaf_idx = {l: n for l, n in zip(names, leaves)}
+        self.children = children
+
+        # leaves of each subtree are contiguous in pre-order. Children have
+        # larger indices than their parent, so ranges are propagated upwards
+        # in reverse order.
+        lo = np.full(len(parent), len(leaves))
+        hi = np.zeros(len(parent), dtype=int)
+        lo[self.leaves] = np.arange(len(leaves))
+        hi[self.leaves] = np.arange(1, len(leaves) + 1)
+        for n in range(len(parent) - 1, 0, -1):
+            p = parent[n]
+            lo[p] = min(lo[p], lo[n])
+            hi[p] = max(hi[p], hi[n])
+        self.leaf_range = np.stack([lo, hi], axis=1)
+
+        # euler tour, with level of each visited node and first occurrence
+        euler, level = [], []
+        first = np.zeros(len(parent), dtype=int)
+        stack = [(0, 0, 0)]
+        while stack:
+            n, lev, k = stack.pop()
+            if k == 0:
+                first[n] = len(euler)
+            euler.append(n)
+            level.append(lev)
+            if k < len(children[n]):
+                stack.append((n, lev, k + 1))
+                stack.append((children[n][k], lev + 1, 0))
+        self.euler = np.array(euler)
+        self.level = np.array(level)
+        self.first = first
+
+        # sparse table: table[k][i] is the position of the minimum level in
+        # the window [i, i + 2^k) of the euler tour
+        table = [np.arange(len(euler))]
+        w = 1
+        while 2 * w <= len(euler):
+            prev = table[-1]
+            a, b = prev[:-w], prev[w:]
+            table.append(np.where(self.level[a] <= self.level[b], a, b))
+            w *= 2
+        self.table = table
+
+    @staticmethod
+    def from_newick(fname):
+        """parse a newick file and return its flat representation"""
+        return FlatTree(Phylo.read(fname, "newick"))
+
+    def lca(self, u, v):
+        """vectorized lowest common ancestor of arrays of node indices"""
+        return lca(self.first, self.level, self.euler, self.table, u, v)
+
+    def node_distance(self, u, v):
+        """vectorized distance between arrays of node indices"""
+        u, v = np.asarray(u), np.asarray(v)
+        return self.depth[u] + self.depth[v] - 2 * self.depth[self.lca(u, v)]
+
+    def distance(self, l1, l2):
+        """vectorized distance between arrays of leaf names"""
+        u = np.array([self.leaf_idx[l] for l in np.atleast_1d(l1)], dtype=np.int64)
+        v = np.array([self.leaf_idx[l] for l in np.atleast_1d(l2)], dtype=np.int64)
+        return self.node_distance(u, v)
+
+    def clades(self, k):
+        """partitions the leaves in (at most) k clades, by repeatedly splitting
+        the largest clade into its children. Returns the list of node indices
+        of the clades, in the order in which they appear in the tree."""
+        size = self.leaf_range[:, 1] - self.leaf_range[:, 0]
+        heap = [(-size[0], 0)]
+        while True:
+            n = heap[0][1]
+            ch = self.children[n]
+            # stop if the largest clade is a leaf or splitting exceeds k
+            if len(ch) == 0 or len(heap) + len(ch) - 1 > k:
+                break
+            heapq.heappop(heap)
+            for c in ch:
+                heapq.heappush(heap, (-size[c], c))
+        return sorted((n for _, n in heap), key=lambda n: self.leaf_range[n, 0])
+
+    def induced_newick(self, names):
+        """canonical newick string of the subtree induced by the given leaves:
+        nodes with a single selected descendant branch are suppressed (summing
+        branch lengths) and children are sorted. Two trees give the same string
+        when they induce the same rooted tree on these leaves, and in particular
+        the same distances between them."""
+        keep = {self.leaf_idx[l]: l for l in names}
+        # (newick string, depth) of the induced subtree of each node
+        sub = [None] * len(self.parent)
+        for n in range(len(self.parent) - 1, -1, -1):
+            if len(self.children[n]) == 0:
+                sub[n] = (keep[n], self.depth[n]) if n in keep else None
+                continue
+            ch = [sub[c] for c in self.children[n] if sub[c] is not None]
+            if len(ch) <= 1:
+                sub[n] = ch[0] if ch else None
+                continue
+            br = sorted(f"{s}:{d - self.depth[n]:.10g}" for s, d in ch)
+            sub[n] = ("(" + ",".join(br) + ")", self.depth[n])
+        return "" if sub[0] is None else sub[0][0] + ";"
+
+    def arrays(self):
+        """dictionary of the arrays needed to evaluate distances, with the
+        sparse table packed in a single 2D array"""
+        table = np.zeros((len(self.table), len(self.euler)), dtype=np.int64)
+        for k, t in enumerate(self.table):
+            table[k, : len(t)] = t
+        return {
+            "first": self.first,
+            "level": self.level,
+            "euler": self.euler,
+            "depth": self.depth,
+            "table": table,
+        }
+
+    def leaf_distance_matrix(
+        self,
+        names=None,
+        out=None,
+        block_size=256,
+        threads=1,
+        rows=None,
+        condensed=False,
+    ):
+        """returns the matrix of pairwise distances between leaves. If `names`
+        is passed only the selected leaves are considered, in the given order.
+        Tiles of `block_size` rows and columns are evaluated in parallel on
+        `threads` processes, and written in `out` if provided. If `rows` is
+        passed, only these rows and columns are evaluated. With `condensed`
+        only the distances of distinct pairs are returned, in the order of
+        `np.triu_indices(N, k=1)`."""
+        if names is None:
+            names = self.leaf_names
+        idx = np.array([self.leaf_idx[l] for l in names])
+        return pairwise_matrix(
+            leaf_distance_tile,
+            {**self.arrays(), "idx": idx},
+            len(idx),
+            out=out,
+            dtype=float,
+            threads=threads,
+            tile_size=block_size,
+            rows=rows,
+            condensed=condensed,
+        )